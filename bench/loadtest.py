@@ -0,0 +1,179 @@
+"""Carga HTTP nos endpoints principais e relatório p50/p95/p99 + throughput.
+
+Roda contra um servidor já no ar (uvicorn main:app) com a base do seed.py.
+
+Exemplo:
+    python bench/loadtest.py --base-url http://127.0.0.1:8000 \\
+        --requests 200 --concurrency 8 --out bench/results/local.json
+
+Comparar duas execuções:
+    python bench/loadtest.py --compare bench/results/antes.json bench/results/depois.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+from seed import BENCH_PASSWORD, BENCH_USER
+
+ENDPOINTS = {
+    "faturas": "/faturas",
+    "faturas_filtro": "/faturas?transportadora=DHL",
+    "dashboard_resumo": "/dashboard/resumo",
+    "historico": "/historico",
+    "transportadoras": "/transportadoras",
+    "faturas_exportar": "/faturas/exportar",
+    "historico_exportar": "/historico/exportar",
+}
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    if lo == hi:
+        return ordenados[lo]
+    return ordenados[lo] + (ordenados[hi] - ordenados[lo]) * (k - lo)
+
+async def login(client: httpx.AsyncClient, username: str, password: str):
+    await client.get("/login")
+    csrf = client.cookies.get("mshop_csrf")
+    r = await client.post("/login", data={"username": username, "password": password, "csrf": csrf})
+    if r.status_code != 302 or r.headers.get("location") == "/change-password":
+        raise SystemExit(f"login falhou ({r.status_code}); rode o seed.py antes")
+
+async def medir(client: httpx.AsyncClient, path: str, total: int, concorrencia: int) -> dict:
+    latencias = []
+    erros = 0
+    bytes_total = 0
+    fila = asyncio.Queue()
+    for _ in range(total):
+        fila.put_nowait(None)
+
+    async def worker():
+        nonlocal erros, bytes_total
+        while True:
+            try:
+                fila.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t0 = time.perf_counter()
+            try:
+                r = await client.get(path)
+                corpo = r.content
+                if r.status_code >= 400:
+                    erros += 1
+                bytes_total += len(corpo)
+            except httpx.HTTPError:
+                erros += 1
+            latencias.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concorrencia)))
+    duracao = time.perf_counter() - t0
+
+    return {
+        "path": path,
+        "requests": total,
+        "concurrency": concorrencia,
+        "errors": erros,
+        "p50_ms": round(percentil(latencias, 50), 2),
+        "p95_ms": round(percentil(latencias, 95), 2),
+        "p99_ms": round(percentil(latencias, 99), 2),
+        "mean_ms": round(sum(latencias) / len(latencias), 2) if latencias else 0.0,
+        "max_ms": round(max(latencias), 2) if latencias else 0.0,
+        "throughput_rps": round(total / duracao, 2) if duracao else 0.0,
+        "avg_bytes": int(bytes_total / total) if total else 0,
+    }
+
+async def rodar(base_url: str, endpoints: list, total: int, concorrencia: int, aquecimento: int,
+                username: str = BENCH_USER, password: str = BENCH_PASSWORD) -> dict:
+    limites = httpx.Limits(max_connections=concorrencia, max_keepalive_connections=concorrencia)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limites) as client:
+        await login(client, username, password)
+        resultados = {}
+        for nome in endpoints:
+            path = ENDPOINTS[nome]
+            if aquecimento:
+                await medir(client, path, aquecimento, 1)
+            resultados[nome] = await medir(client, path, total, concorrencia)
+            r = resultados[nome]
+            print(f"{nome:22s} p50={r['p50_ms']:>9.1f}ms p95={r['p95_ms']:>9.1f}ms "
+                  f"p99={r['p99_ms']:>9.1f}ms {r['throughput_rps']:>8.1f} req/s erros={r['errors']}")
+        return resultados
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+def meta(extra: dict = None) -> dict:
+    m = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+    }
+    m.update(extra or {})
+    return m
+
+def salvar(path: str, dados: dict):
+    destino = Path(path)
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    destino.write_text(json.dumps(dados, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"resultado salvo em {destino}")
+
+def _achatar(dados: dict) -> dict:
+    # aceita tanto um loadtest simples quanto a saída do suite.py (por tamanho)
+    if "sizes" in dados:
+        return {
+            f"{tam}/{nome}": r
+            for tam, bloco in dados["sizes"].items()
+            for nome, r in bloco["results"].items()
+        }
+    return dados.get("results", {})
+
+def comparar(a_path: str, b_path: str):
+    a = _achatar(json.loads(Path(a_path).read_text(encoding="utf-8")))
+    b = _achatar(json.loads(Path(b_path).read_text(encoding="utf-8")))
+    print(f"{'endpoint':34s} {'p50 antes':>10s} {'p50 depois':>10s} {'Δp95':>8s} {'Δrps':>8s}")
+    for chave in sorted(set(a) & set(b)):
+        ra, rb = a[chave], b[chave]
+        dp95 = (rb["p95_ms"] - ra["p95_ms"]) / ra["p95_ms"] * 100 if ra["p95_ms"] else 0.0
+        drps = (rb["throughput_rps"] - ra["throughput_rps"]) / ra["throughput_rps"] * 100 if ra["throughput_rps"] else 0.0
+        print(f"{chave:34s} {ra['p50_ms']:>10.1f} {rb['p50_ms']:>10.1f} {dp95:>+7.1f}% {drps:>+7.1f}%")
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Load test dos endpoints principais")
+    p.add_argument("--base-url", default="http://127.0.0.1:8000")
+    p.add_argument("--requests", type=int, default=100, help="requisições por endpoint")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--warmup", type=int, default=5)
+    p.add_argument("--endpoints", default=",".join(ENDPOINTS), help="lista separada por vírgula")
+    p.add_argument("--out", default="", help="arquivo JSON de saída")
+    p.add_argument("--compare", nargs=2, metavar=("ANTES", "DEPOIS"))
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.compare:
+        comparar(*args.compare)
+        sys.exit(0)
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    resultados = asyncio.run(rodar(args.base_url, endpoints, args.requests, args.concurrency, args.warmup))
+    if args.out:
+        salvar(args.out, {
+            "meta": meta({"base_url": args.base_url, "requests": args.requests, "concurrency": args.concurrency}),
+            "results": resultados,
+        })
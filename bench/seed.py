@@ -0,0 +1,213 @@
+"""Gera uma base sintética pra benchmark (NUNCA rode contra produção).
+
+Usa os mesmos modelos/migrações do main.py. O R2 pode ser substituído por
+qualquer S3 local (ex: `moto_server -p 5055`) apontando R2_ENDPOINT pra ele.
+
+Exemplo:
+    DATABASE_URL=postgresql://localhost/faturas_bench \\
+    R2_ENDPOINT=http://127.0.0.1:5055 R2_BUCKET_NAME=bench \\
+    R2_ACCESS_KEY_ID=x R2_SECRET_ACCESS_KEY=y \\
+    python bench/seed.py --faturas 10000 --truncate
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, time as dtime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert, text  # noqa: E402
+
+import main  # noqa: E402
+
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench-senha-123"
+
+BASE_TRANSPORTADORAS = ["DHL", "Pannan", "Garcia", "Excargo", "Transbritto", "PDA", "GLM"]
+OBSERVACOES = [
+    None,
+    None,
+    "frete aéreo urgente",
+    "cobrança referente a reentrega",
+    "aguardando comprovante do financeiro",
+    "divergência de valor com a cotação",
+    "pagamento parcial negociado",
+]
+
+# todas as tabelas dos modelos (fila, exportações, auditoria... inclusive):
+# schema_migrations não é modelo, então a versão do schema fica
+TABELAS = [t.name for t in main.Base.metadata.sorted_tables]
+
+def truncar(conn):
+    conn.execute(text(f"TRUNCATE {', '.join(TABELAS)} RESTART IDENTITY CASCADE"))
+
+def gerar_usuarios(conn, n: int) -> list:
+    salt, pwd_hash = main.hash_password(BENCH_PASSWORD)
+    agora = main.agora_br()
+    rows = [
+        {
+            "username": BENCH_USER if i == 0 else f"op{i:03d}",
+            "email": None,
+            "role": "admin" if i == 0 else "user",
+            "pwd_salt": salt,
+            "pwd_hash": pwd_hash,
+            "must_change_password": 0,
+            "password_expires_at": agora + timedelta(days=3650),
+            "created_at": agora,
+        }
+        for i in range(n)
+    ]
+    res = conn.execute(
+        insert(main.UserDB.__table__).returning(main.UserDB.__table__.c.id, sort_by_parameter_order=True),
+        rows,
+    )
+    return [r[0] for r in res]
+
+def gerar_transportadoras(conn, rnd: random.Random, n: int, user_ids: list) -> list:
+    nomes = list(BASE_TRANSPORTADORAS)
+    i = 1
+    while len(nomes) < n:
+        nomes.append(f"Transp{i:03d}")
+        i += 1
+    nomes = nomes[:n]
+    rows = [{"nome": nome, "responsavel_user_id": rnd.choice(user_ids[1:] or user_ids)} for nome in nomes]
+    conn.execute(insert(main.TransportadoraDB.__table__), rows)
+    # filiais no formato "BASE-UF" (o get_responsavel corta no "-")
+    return nomes + [f"{nome}-{uf}" for nome in nomes[:5] for uf in ("SP", "RJ")]
+
+def gerar_faturas(conn, rnd: random.Random, n: int, transportadoras: list, pagas_ratio: float, lote: int) -> list:
+    hoje = main.hoje_local_br()
+    inicio = hoje - timedelta(days=730)
+    janela = (hoje + timedelta(days=90) - inicio).days
+
+    ids_pagas = []
+    for ini in range(0, n, lote):
+        rows = []
+        for j in range(ini, min(n, ini + lote)):
+            venc = inicio + timedelta(days=rnd.randrange(janela))
+            pago = venc <= hoje and rnd.random() < pagas_ratio
+            data_pag = None
+            if pago:
+                dia = venc + timedelta(days=rnd.randint(-5, 10))
+                data_pag = datetime.combine(min(dia, hoje), dtime(12, 0), tzinfo=main.BR_TZ)
+            rows.append({
+                "transportadora": rnd.choice(transportadoras),
+                "numero_fatura": f"{rnd.randint(100000, 999999)}-{j}",
+                "valor": round(rnd.uniform(50, 25000), 2),
+                "data_vencimento": venc,
+                "status": "pago" if pago else "pendente",
+                "observacao": rnd.choice(OBSERVACOES),
+                "data_pagamento": data_pag,
+            })
+        res = conn.execute(
+            insert(main.FaturaDB.__table__).returning(main.FaturaDB.__table__.c.id, sort_by_parameter_order=True),
+            rows,
+        )
+        for row, (fid,) in zip(rows, res):
+            if row["status"] == "pago":
+                ids_pagas.append((fid, row))
+    return ids_pagas
+
+def gerar_historico(conn, pagas: list, resp_por_transp: dict, lote: int):
+    if pagas:
+        # o histórico vai ~2 anos pra trás: sem as partições mensais tudo
+        # cairia no DEFAULT e o benchmark não mediria o pruning por mês
+        desde = min(row["data_pagamento"] for _, row in pagas).astimezone(main.BR_TZ).date()
+        main.garantir_particoes_historico(conn, desde=desde)
+    for ini in range(0, len(pagas), lote):
+        rows = [
+            {
+                "fatura_id": fid,
+                "pago_em": row["data_pagamento"],
+                "transportadora": row["transportadora"],
+                "responsavel": resp_por_transp.get(row["transportadora"].split("-")[0].strip()),
+                "numero_fatura": row["numero_fatura"],
+                "valor": row["valor"],
+                "data_vencimento": row["data_vencimento"],
+            }
+            for fid, row in pagas[ini:ini + lote]
+        ]
+        conn.execute(insert(main.HistoricoPagamentoDB.__table__), rows)
+
+def gerar_anexos(conn, rnd: random.Random, fatura_ids: list, ratio: float):
+    escolhidas = [fid for fid in fatura_ids if rnd.random() < ratio]
+    rows = []
+    for fid in escolhidas:
+        nome = f"boleto_{fid}.pdf"
+        key = main._r2_key(fid, nome)
+        main.r2_call(
+            "put_object",
+            Bucket=main.R2_BUCKET_NAME,
+            Key=key,
+            Body=b"%PDF-1.4 bench\n" + bytes(rnd.getrandbits(8) for _ in range(256)),
+            ContentType="application/pdf",
+        )
+        rows.append({"fatura_id": fid, "filename": key, "original_name": nome, "content_type": "application/pdf"})
+    if rows:
+        conn.execute(insert(main.AnexoDB.__table__), rows)
+    return len(rows)
+
+def seed(faturas: int, transportadoras: int = 30, usuarios: int = 10, pagas_ratio: float = 0.6,
+         anexos_ratio: float = 0.02, truncate: bool = False, seed_value: int = 42, lote: int = 5000) -> dict:
+    rnd = random.Random(seed_value)
+    t0 = time.perf_counter()
+
+    main.run_migrations()
+    with main.get_engine().begin() as conn:
+        if truncate:
+            truncar(conn)
+
+        user_ids = gerar_usuarios(conn, max(2, usuarios))
+        nomes = gerar_transportadoras(conn, rnd, transportadoras, user_ids)
+
+        resp_por_transp = {
+            nome: username
+            for nome, username in conn.execute(text("""
+                SELECT t.nome, u.username
+                FROM transportadoras t JOIN users u ON u.id = t.responsavel_user_id
+            """))
+        }
+
+        pagas = gerar_faturas(conn, rnd, faturas, nomes, pagas_ratio, lote)
+        gerar_historico(conn, pagas, resp_por_transp, lote)
+
+        fatura_ids = [r[0] for r in conn.execute(text("SELECT id FROM faturas"))]
+        qtd_anexos = gerar_anexos(conn, rnd, fatura_ids, anexos_ratio)
+
+    with main.get_engine().connect() as conn:
+        conn.execute(text("ANALYZE"))
+
+    return {
+        "faturas": faturas,
+        "historico": len(pagas),
+        "anexos": qtd_anexos,
+        "transportadoras": len(nomes),
+        "usuarios": max(2, usuarios),
+        "segundos": round(time.perf_counter() - t0, 2),
+    }
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Gera base sintética pra benchmark")
+    p.add_argument("--faturas", type=int, default=1000)
+    p.add_argument("--transportadoras", type=int, default=30)
+    p.add_argument("--usuarios", type=int, default=10)
+    p.add_argument("--pagas-ratio", type=float, default=0.6)
+    p.add_argument("--anexos-ratio", type=float, default=0.02)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--truncate", action="store_true", help="apaga TODOS os dados antes de gerar")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    resumo = seed(
+        faturas=args.faturas,
+        transportadoras=args.transportadoras,
+        usuarios=args.usuarios,
+        pagas_ratio=args.pagas_ratio,
+        anexos_ratio=args.anexos_ratio,
+        truncate=args.truncate,
+        seed_value=args.seed,
+    )
+    print(resumo)
@@ -0,0 +1,121 @@
+"""Suite reprodutível: para cada tamanho, recria a base, sobe o app e mede.
+
+Precisa de um Postgres local dedicado (DATABASE_URL) — a base é TRUNCADA.
+Se R2_ENDPOINT não estiver definido, sobe um moto_server local como R2.
+
+Exemplo:
+    DATABASE_URL=postgresql://localhost/faturas_bench \\
+    python bench/suite.py --sizes 1000,10000,100000 --out bench/results/$(git rev-parse --short HEAD).json
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def esperar(url: str, timeout: float = 60):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.3)
+    raise SystemExit(f"timeout esperando {url}")
+
+def subir_r2_local(env: dict) -> subprocess.Popen:
+    porta = porta_livre()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-p", str(porta)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    endpoint = f"http://127.0.0.1:{porta}"
+    esperar(endpoint)
+
+    import boto3
+
+    boto3.client(
+        "s3", endpoint_url=endpoint, region_name="us-east-1",
+        aws_access_key_id="bench", aws_secret_access_key="bench",
+    ).create_bucket(Bucket="bench")
+    env.update(
+        R2_ENDPOINT=endpoint,
+        R2_BUCKET_NAME="bench",
+        R2_ACCESS_KEY_ID="bench",
+        R2_SECRET_ACCESS_KEY="bench",
+    )
+    return proc
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark por tamanho de base")
+    p.add_argument("--sizes", default="1000,10000,100000")
+    p.add_argument("--requests", type=int, default=50)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--workers", type=int, default=1, help="workers do uvicorn")
+    p.add_argument("--out", default=f"bench/results/suite-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    args = p.parse_args()
+
+    if not os.getenv("DATABASE_URL"):
+        raise SystemExit("defina DATABASE_URL (banco dedicado, será truncado)")
+
+    env = dict(os.environ)
+    env.setdefault("SESSION_SECRET", "bench")
+    env.setdefault("DEBUG", "1")  # cookie sem Secure (http local)
+    env.setdefault("LIMITE_ATIVO", "0")  # um usuário só martelando: senão mede o 429
+    procs = []
+    if not env.get("R2_ENDPOINT"):
+        procs.append(subir_r2_local(env))
+    os.environ.update(env)
+
+    # importa só depois do env pronto (main lê config no import)
+    import loadtest
+    import seed
+
+    saida = {"meta": loadtest.meta({"requests": args.requests, "concurrency": args.concurrency,
+                                    "workers": args.workers}), "sizes": {}}
+    try:
+        for tamanho in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            print(f"\n=== {tamanho} faturas ===")
+            info = seed.seed(faturas=tamanho, truncate=True)
+            print("seed:", info)
+
+            porta = porta_livre()
+            app = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--port", str(porta),
+                 "--workers", str(args.workers), "--log-level", "warning"],
+                cwd=str(RAIZ),
+                env=env,
+            )
+            try:
+                base = f"http://127.0.0.1:{porta}"
+                esperar(f"{base}/health")
+                resultados = asyncio.run(loadtest.rodar(
+                    base, list(loadtest.ENDPOINTS), args.requests, args.concurrency, aquecimento=3,
+                ))
+            finally:
+                app.terminate()
+                app.wait(timeout=30)
+
+            saida["sizes"][str(tamanho)] = {"seed": info, "results": resultados}
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+    loadtest.salvar(args.out, saida)
+
+if __name__ == "__main__":
+    main()
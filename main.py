@@ -1,11 +1,24 @@
+import time
+
+_IMPORT_T0 = time.perf_counter()
+
 from datetime import date, datetime, timedelta
+from decimal import Decimal
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
 import os
+import re
+import threading
 import uuid
 import base64
 import json
 import hmac
 import hashlib
+import math
 import secrets
+import contextvars
+import gzip
+import mimetypes
 from typing import List, Optional, Tuple
 
 from zoneinfo import ZoneInfo
@@ -25,8 +38,12 @@ from fastapi.responses import HTMLResponse, Response, StreamingResponse, Redirec
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware  # ✅ NOVO (opcional)
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
 
 from pydantic import BaseModel
+import orjson
 
 from sqlalchemy import (
     create_engine,
@@ -35,31 +52,231 @@ from sqlalchemy import (
     String,
     Date,
     DateTime,
+    Float,
     Numeric,
     ForeignKey,
+    LargeBinary,
+    BigInteger,
+    Text,
     func,
     and_,
     or_,
     text,
+    event,
 )
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship
 
-import boto3
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
 from botocore.exceptions import ClientError
-from botocore.config import Config
+
+try:
+    import brotli  # opcional: sem ele fica só gzip
+except ImportError:
+    brotli = None
 
 # =========================
 # CONFIG BANCO
 # =========================
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL não configurada nas variáveis de ambiente do Render.")
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "").strip()
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
 
+# =========================
+# ✅ CLIENTES LAZY / POR PROCESSO (engine + R2)
+# =========================
+# Nada abre conexão no import: engine e cliente S3 nascem no primeiro uso,
+# dentro do processo que vai usá-los. Depois de um fork (gunicorn --preload)
+# o filho descarta as referências herdadas e cria as suas.
+
+_clients_lock = threading.Lock()
+_engine = None
+_engine_replica = None
+_s3 = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _clients_lock:
+            if _engine is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL não configurada nas variáveis de ambiente do Render.")
+                _engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+    return _engine
+
+def get_engine_replica():
+    global _engine_replica
+    if _engine_replica is None:
+        with _clients_lock:
+            if _engine_replica is None:
+                # connect_timeout curto: réplica fora do ar cai pro primário rápido
+                _engine_replica = create_engine(
+                    DATABASE_REPLICA_URL,
+                    pool_pre_ping=True,
+                    connect_args={"connect_timeout": 3},
+                )
+    return _engine_replica
+
+def new_session() -> Session:
+    return SessionLocal(bind=get_engine())
+
+def _reset_clients_after_fork():
+    global _engine, _engine_replica, _s3, _clients_lock
+    _clients_lock = threading.Lock()
+    for eng in (_engine, _engine_replica):
+        if eng is not None:
+            # close=False: não fecha os sockets do processo pai, só larga o pool
+            eng.dispose(close=False)
+    _engine = None
+    _engine_replica = None
+    _s3 = None
+
+os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+# =========================
+# ✅ MÉTRICAS (Prometheus)
+# =========================
+# Com vários workers, defina PROMETHEUS_MULTIPROC_DIR (diretório vazio e
+# gravável) pra /metrics somar os processos.
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "").strip()
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+HTTP_LATENCIA = Histogram(
+    "http_request_duration_seconds",
+    "Latência das requisições HTTP por rota",
+    ["method", "route", "status"],
+)
+HTTP_EM_VOO = Gauge(
+    "http_requests_in_flight",
+    "Requisições em andamento por rota",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+DB_QUERY_LATENCIA = Histogram(
+    "db_query_duration_seconds",
+    "Duração de cada statement SQL, pela rota que o disparou",
+    ["route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+DB_QUERIES = Counter(
+    "db_queries_total",
+    "Statements SQL executados por rota",
+    ["route"],
+)
+R2_LATENCIA = Histogram(
+    "r2_request_duration_seconds",
+    "Latência das chamadas ao R2 por operação",
+    ["operation", "outcome"],
+)
+DB_QUERIES_POR_REQ = Histogram(
+    "db_queries_per_request",
+    "Quantidade de statements SQL por requisição",
+    ["route"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 500),
+)
+PBKDF2_LATENCIA = Histogram(
+    "pbkdf2_duration_seconds",
+    "Tempo gasto no PBKDF2 (hash/verificação de senha)",
+    buckets=(0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0),
+)
+CACHE_CONSULTAS = Counter(
+    "cache_lookups_total",
+    "Consultas aos caches locais por tópico e resultado (hit/miss)",
+    ["topico", "resultado"],
+)
+DB_LEITURAS = Counter(
+    "db_read_routing_total",
+    "Sessões de leitura por destino (replica/primario) e motivo",
+    ["destino", "motivo"],
+)
+TAREFAS_LATENCIA = Histogram(
+    "jobs_duration_seconds",
+    "Duração das tarefas em background por tipo e resultado",
+    ["tipo", "resultado"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0),
+)
+LIMITE_REJEICOES = Counter(
+    "rate_limit_rejections_total",
+    "Requisições recusadas com 429: por taxa (rota) ou por bulkhead (recurso)",
+    ["motivo", "alvo"],
+)
+
+# rota (template, ex: /faturas/{fatura_id}) da requisição em andamento;
+# fora de requisição (lifespan, jobs) fica "-"
+_rota_atual: contextvars.ContextVar[str] = contextvars.ContextVar("rota_atual", default="-")
+
+# =========================
+# ✅ CONTADOR DE SQL POR REQUISIÇÃO / SLOW QUERY
+# =========================
+# DEBUG=1 -> respostas levam X-DB-Queries / X-DB-Time (ms).
+# SLOW_QUERY_MS -> statements acima disso vão pro log com a rota.
+# DB_QUERY_BUDGETS="GET /faturas=3;GET /dashboard/resumo=4" define orçamento
+# por rota (DB_QUERY_BUDGET_DEFAULT pras demais, 0 = sem limite). Estourou:
+# WARN no log; com DB_QUERY_BUDGET_ASSERT=1 (testes) a requisição falha.
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+DB_QUERY_BUDGET_DEFAULT = int(os.getenv("DB_QUERY_BUDGET_DEFAULT", "0"))
+DB_QUERY_BUDGET_ASSERT = os.getenv("DB_QUERY_BUDGET_ASSERT", "0").strip() == "1"
+
+def _parse_budgets(raw: str) -> dict:
+    budgets = {}
+    for item in raw.split(";"):
+        if "=" not in item:
+            continue
+        chave, n = item.rsplit("=", 1)
+        try:
+            budgets[" ".join(chave.split())] = int(n)
+        except ValueError:
+            print("WARN DB_QUERY_BUDGETS: valor inválido:", repr(item))
+    return budgets
+
+DB_QUERY_BUDGETS = _parse_budgets(os.getenv("DB_QUERY_BUDGETS", ""))
+
+class ConsultasRequisicao:
+    __slots__ = ("queries", "segundos")
+
+    def __init__(self):
+        self.queries = 0
+        self.segundos = 0.0
+
+_db_stats: contextvars.ContextVar[Optional[ConsultasRequisicao]] = contextvars.ContextVar("db_stats", default=None)
+
+def orcamento_queries(metodo: str, rota: str) -> int:
+    return DB_QUERY_BUDGETS.get(f"{metodo} {rota}", DB_QUERY_BUDGET_DEFAULT)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_antes(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_sql_t0", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_depois(conn, cursor, statement, parameters, context, executemany):
+    dur = time.perf_counter() - conn.info["_sql_t0"].pop()
+    rota = _rota_atual.get()
+    DB_QUERIES.labels(rota).inc()
+    DB_QUERY_LATENCIA.labels(rota).observe(dur)
+
+    stats = _db_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.segundos += dur
+
+    if dur * 1000 >= SLOW_QUERY_MS:
+        sql = " ".join(statement.split())
+        print(f"SLOW SQL ({dur * 1000:.0f} ms) rota={rota}: {sql[:500]}")
+
 # =========================
 # ✅ DETECTA PASTAS (static/templates vs estático/modelos)
 # =========================
@@ -123,23 +340,47 @@ R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
 R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
 R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 
-if not all([R2_ENDPOINT, R2_BUCKET_NAME, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]):
-    raise RuntimeError(
-        "R2 não configurado. Verifique as env vars: "
-        "R2_ENDPOINT, R2_BUCKET_NAME, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY"
-    )
+def verificar_config_r2():
+    if not all([R2_ENDPOINT, R2_BUCKET_NAME, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]):
+        raise RuntimeError(
+            "R2 não configurado. Verifique as env vars: "
+            "R2_ENDPOINT, R2_BUCKET_NAME, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY"
+        )
 
-s3 = boto3.client(
-    "s3",
-    endpoint_url=R2_ENDPOINT,
-    aws_access_key_id=R2_ACCESS_KEY_ID,
-    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-    region_name="auto",
-    config=Config(
-        signature_version="s3v4",
-        s3={"addressing_style": "path"},
-    ),
-)
+def get_s3():
+    global _s3
+    if _s3 is None:
+        with _clients_lock:
+            if _s3 is None:
+                verificar_config_r2()
+                # boto3 é pesado pra importar; só carrega quando o R2 é usado
+                import boto3
+                from botocore.config import Config
+
+                _s3 = boto3.client(
+                    "s3",
+                    endpoint_url=R2_ENDPOINT,
+                    aws_access_key_id=R2_ACCESS_KEY_ID,
+                    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                    region_name="auto",
+                    config=Config(
+                        signature_version="s3v4",
+                        s3={"addressing_style": "path"},
+                    ),
+                )
+    return _s3
+
+def r2_call(operation: str, **kwargs):
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        return getattr(get_s3(), operation)(**kwargs)
+    except Exception:
+        # ClientError, falha de conexão/timeout, S3UploadFailedError do upload_fileobj...
+        outcome = "erro"
+        raise
+    finally:
+        R2_LATENCIA.labels(operation, outcome).observe(time.perf_counter() - t0)
 
 def _r2_key(fatura_id: int, original_filename: str) -> str:
     safe_name = (original_filename or "arquivo").replace("/", "_").replace("\\", "_")
@@ -172,6 +413,7 @@ class FaturaDB(Base):
     status = Column(String, default="pendente")
     observacao = Column(String, nullable=True)
     data_pagamento = Column(DateTime(timezone=True), nullable=True)
+    atualizado_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())  # trigger no UPDATE
 
     anexos = relationship(
         "AnexoDB",
@@ -206,6 +448,94 @@ class HistoricoPagamentoDB(Base):
     valor = Column(Numeric(10, 2), nullable=False)
     data_vencimento = Column(Date, nullable=False)
 
+class ArquivoLoteDB(Base):
+    __tablename__ = "arquivo_lotes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    chave = Column(String, nullable=False, unique=True)   # KEY do R2 (.jsonl.gz)
+    periodo = Column(String, nullable=False, index=True)  # AAAA-MM do pagamento (BR)
+    qtd_faturas = Column(Integer, nullable=False)
+    qtd_historico = Column(Integer, nullable=False)
+    bytes = Column(Integer, nullable=False)
+    pago_de = Column(DateTime(timezone=True), nullable=True)
+    pago_ate = Column(DateTime(timezone=True), nullable=True)
+    criado_em = Column(DateTime(timezone=True), nullable=False, default=agora_br)
+
+class IdempotenciaDB(Base):
+    __tablename__ = "idempotency_keys"
+
+    usuario_id = Column(Integer, primary_key=True)
+    chave = Column(String(200), primary_key=True)
+    rota = Column(String, nullable=False)
+    impressao = Column(String(64), nullable=False)  # sha256 do pedido original
+    estado = Column(String(16), nullable=False)     # em_andamento | concluida
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(String, nullable=True)
+    corpo = Column(LargeBinary, nullable=True)
+    criado_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    expira_em = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class LimiteTaxaDB(Base):
+    __tablename__ = "rate_limits"
+
+    chave = Column(String(200), primary_key=True)   # u:<id> ou ip:<endereço>
+    fichas = Column(Float, nullable=False)
+    atualizado_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+
+class TarefaDB(Base):
+    __tablename__ = "jobs"
+
+    id = Column(BigInteger, primary_key=True)
+    tipo = Column(String(64), nullable=False)
+    payload = Column(JSONB, nullable=False, server_default=text("'{}'::jsonb"))
+    estado = Column(String(16), nullable=False, server_default="pendente")  # pendente | executando | concluida | falhou
+    tentativas = Column(Integer, nullable=False, server_default="0")
+    max_tentativas = Column(Integer, nullable=False, server_default="5")
+    executar_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    chave_unica = Column(String(200), nullable=True, unique=True)  # tarefas periódicas: uma por janela
+    travada_por = Column(String(64), nullable=True)
+    travada_em = Column(DateTime(timezone=True), nullable=True)
+    ultimo_erro = Column(Text, nullable=True)
+    criado_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    concluida_em = Column(DateTime(timezone=True), nullable=True)
+
+class RemocaoDB(Base):
+    __tablename__ = "remocoes"
+
+    id = Column(BigInteger, primary_key=True)
+    tabela = Column(String(64), nullable=False)
+    registro_id = Column(BigInteger, nullable=False)
+    removido_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class AuditoriaFaturaDB(Base):
+    __tablename__ = "auditoria_faturas"
+
+    id = Column(BigInteger, primary_key=True)
+    fatura_id = Column(Integer, nullable=False)     # sem FK: o registro sobrevive à fatura apagada
+    acao = Column(String(16), nullable=False)       # criar | atualizar | remover
+    usuario_id = Column(Integer, nullable=True)     # None = sistema (virada automática de status)
+    usuario = Column(String, nullable=True)         # username na hora da mudança
+    mudancas = Column(JSONB, nullable=False)        # {campo: [antes, depois]}
+    criado_em = Column(DateTime(timezone=True), nullable=False)
+
+class ExportacaoDB(Base):
+    __tablename__ = "exportacoes"
+
+    id = Column(Integer, primary_key=True)
+    usuario_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    tipo = Column(String(16), nullable=False)        # faturas | historico
+    filtros = Column(JSONB, nullable=False)
+    impressao = Column(String(64), nullable=False)  # sha256(tipo + filtros): reaproveitar pedidos iguais
+    estado = Column(String(16), nullable=False, server_default="pendente")  # pendente | executando | concluida | falhou
+    linhas_total = Column(Integer, nullable=True)
+    linhas_feitas = Column(Integer, nullable=False, server_default="0")
+    chave_r2 = Column(String, nullable=True)
+    bytes = Column(BigInteger, nullable=True)
+    erro = Column(Text, nullable=True)
+    criado_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    atualizado_em = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    concluida_em = Column(DateTime(timezone=True), nullable=True)
+
 # =========================
 # MODELOS AUTH / ADMIN
 # =========================
@@ -248,128 +578,503 @@ class PasswordResetDB(Base):
     expires_at = Column(DateTime(timezone=True), nullable=False)
     used_at = Column(DateTime(timezone=True), nullable=True)
 
-Base.metadata.create_all(bind=engine)
-
 # =========================
-# ✅ MIGRAÇÃO AUTOMÁTICA (Render)
+# ✅ MIGRAÇÕES VERSIONADAS
 # =========================
+# Cada migração roda UMA vez (registrada em schema_migrations), em ordem,
+# sob advisory lock pra vários workers subindo juntos não brigarem.
+# Boot "quente" (tudo aplicado) faz só uma leitura da versão atual.
+
+MIGRATION_LOCK_KEY = 7_305_001  # pg_advisory_xact_lock (qualquer int64 fixo)
+
+def _coluna_sem_tz(conn, tabela: str, coluna: str) -> bool:
+    tipo = conn.execute(
+        text("""
+            SELECT data_type
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = :t AND column_name = :c
+        """),
+        {"t": tabela, "c": coluna},
+    ).scalar()
+    return tipo == "timestamp without time zone"
+
+# DDL congelado das seis tabelas originais, como o create_all antigo gerava.
+# Não usar os modelos aqui: eles crescem a cada migração nova, e a 001 tem
+# que criar a mesma coisa num banco novo e num banco antigo.
+BASELINE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS faturas (
+        id SERIAL PRIMARY KEY,
+        transportadora VARCHAR,
+        numero_fatura VARCHAR,
+        valor NUMERIC(10, 2),
+        data_vencimento DATE,
+        status VARCHAR,
+        observacao VARCHAR,
+        data_pagamento TIMESTAMPTZ
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_faturas_id ON faturas (id);",
+    "CREATE INDEX IF NOT EXISTS ix_faturas_numero_fatura ON faturas (numero_fatura);",
+    "CREATE INDEX IF NOT EXISTS ix_faturas_transportadora ON faturas (transportadora);",
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        username VARCHAR NOT NULL,
+        email VARCHAR,
+        role VARCHAR,
+        pwd_salt VARCHAR,
+        pwd_hash VARCHAR,
+        must_change_password INTEGER,
+        first_password_changed_at TIMESTAMPTZ,
+        last_password_changed_at TIMESTAMPTZ,
+        password_expires_at TIMESTAMPTZ,
+        created_at TIMESTAMPTZ,
+        last_login_at TIMESTAMPTZ
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_users_id ON users (id);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username);",
+    """
+    CREATE TABLE IF NOT EXISTS anexos (
+        id SERIAL PRIMARY KEY,
+        fatura_id INTEGER REFERENCES faturas (id) ON DELETE CASCADE,
+        filename VARCHAR,
+        original_name VARCHAR,
+        content_type VARCHAR,
+        criado_em DATE
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_anexos_id ON anexos (id);",
+    """
+    CREATE TABLE IF NOT EXISTS historico_pagamentos (
+        id SERIAL PRIMARY KEY,
+        fatura_id INTEGER REFERENCES faturas (id) ON DELETE CASCADE,
+        pago_em TIMESTAMPTZ NOT NULL,
+        transportadora VARCHAR NOT NULL,
+        responsavel VARCHAR,
+        numero_fatura VARCHAR NOT NULL,
+        valor NUMERIC(10, 2) NOT NULL,
+        data_vencimento DATE NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_historico_pagamentos_id ON historico_pagamentos (id);",
+    """
+    CREATE TABLE IF NOT EXISTS password_resets (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        token_hash VARCHAR NOT NULL,
+        expires_at TIMESTAMPTZ NOT NULL,
+        used_at TIMESTAMPTZ
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_password_resets_id ON password_resets (id);",
+    """
+    CREATE TABLE IF NOT EXISTS transportadoras (
+        id SERIAL PRIMARY KEY,
+        nome VARCHAR NOT NULL,
+        responsavel_user_id INTEGER
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_transportadoras_id ON transportadoras (id);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_transportadoras_nome ON transportadoras (nome);",
+]
+
+def _mig_001_baseline(conn):
+    # esquema que o ensure_schema() antigo garantia a cada boot (tudo idempotente)
+    for ddl in BASELINE_DDL:
+        conn.execute(text(ddl))
+
+    # --- faturas
+    conn.execute(text("ALTER TABLE faturas ADD COLUMN IF NOT EXISTS observacao TEXT;"))
+    conn.execute(text("ALTER TABLE faturas ADD COLUMN IF NOT EXISTS data_pagamento TIMESTAMPTZ;"))
+    # só converte se ainda for TIMESTAMP sem fuso (antes reescrevia a tabela todo boot)
+    if _coluna_sem_tz(conn, "faturas", "data_pagamento"):
+        conn.execute(text("""
+            ALTER TABLE faturas
+            ALTER COLUMN data_pagamento TYPE TIMESTAMPTZ
+            USING (data_pagamento AT TIME ZONE 'UTC');
+        """))
 
-def ensure_schema():
-    with engine.begin() as conn:
-        # --- faturas
-        conn.execute(text("ALTER TABLE faturas ADD COLUMN IF NOT EXISTS observacao TEXT;"))
-        conn.execute(text("ALTER TABLE faturas ADD COLUMN IF NOT EXISTS data_pagamento TIMESTAMPTZ;"))
-        try:
-            conn.execute(text("""
-                ALTER TABLE faturas
-                ALTER COLUMN data_pagamento TYPE TIMESTAMPTZ
-                USING (data_pagamento AT TIME ZONE 'UTC');
-            """))
-        except Exception as e:
-            print("WARN schema: alter faturas.data_pagamento -> timestamptz:", repr(e))
+    # --- anexos
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_anexos_fatura_id ON anexos(fatura_id);"))
 
-        # --- anexos
+    # --- historico_pagamentos
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_historico_pagamentos_fatura_id ON historico_pagamentos(fatura_id);"))
+    if _coluna_sem_tz(conn, "historico_pagamentos", "pago_em"):
         conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS anexos (
-                id SERIAL PRIMARY KEY,
-                fatura_id INTEGER REFERENCES faturas(id) ON DELETE CASCADE,
-                filename TEXT,
-                original_name TEXT,
-                content_type TEXT,
-                criado_em DATE DEFAULT CURRENT_DATE
-            );
+            ALTER TABLE historico_pagamentos
+            ALTER COLUMN pago_em TYPE TIMESTAMPTZ
+            USING (pago_em AT TIME ZONE 'UTC');
         """))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_anexos_fatura_id ON anexos(fatura_id);"))
 
-        # --- historico_pagamentos
+    # --- users (colunas que bancos antigos podem não ter)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username ON users(username);"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS email TEXT;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT DEFAULT 'user';"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS pwd_salt TEXT;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS pwd_hash TEXT;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS must_change_password INTEGER DEFAULT 1;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS first_password_changed_at TIMESTAMPTZ;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_password_changed_at TIMESTAMPTZ;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS password_expires_at TIMESTAMPTZ;"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT NOW();"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMPTZ;"))
+
+    # --- transportadoras
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transportadoras_nome ON transportadoras(nome);"))
+    conn.execute(text("ALTER TABLE transportadoras ADD COLUMN IF NOT EXISTS responsavel_user_id INTEGER;"))
+    conn.execute(text("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1
+                FROM pg_constraint
+                WHERE conname = 'transportadoras_responsavel_user_id_fkey'
+            ) THEN
+                ALTER TABLE transportadoras
+                ADD CONSTRAINT transportadoras_responsavel_user_id_fkey
+                FOREIGN KEY (responsavel_user_id) REFERENCES users(id);
+            END IF;
+        END $$;
+    """))
+
+    # --- password_resets
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_password_resets_token_hash ON password_resets(token_hash);"))
+
+# expressão do search_tsv do histórico (migração 2 e tabela particionada da 3)
+HISTORICO_TSV_SQL = """
+    setweight(to_tsvector('mshop_simples'::regconfig, regexp_replace(coalesce(numero_fatura, ''), '[^[:alnum:]]+', ' ', 'g')), 'A')
+    || setweight(to_tsvector('mshop_simples'::regconfig, coalesce(transportadora, '') || ' ' || coalesce(responsavel, '')), 'B')
+"""
+
+def _mig_002_busca_textual(conn):
+    # unaccent precisa de permissão de CREATE EXTENSION; sem ela segue sem
+    tem_unaccent = True
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent;"))
+    except Exception as e:
+        tem_unaccent = False
+        print("WARN schema: extensão unaccent indisponível, busca vai diferenciar acentos:", repr(e))
+
+    # mshop_pt: português com stemming (observação); mshop_simples: sem
+    # stemming (número da fatura, nome de transportadora/responsável)
+    conn.execute(text("CREATE TEXT SEARCH CONFIGURATION mshop_pt (COPY = portuguese);"))
+    conn.execute(text("CREATE TEXT SEARCH CONFIGURATION mshop_simples (COPY = simple);"))
+    if tem_unaccent:
         conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS historico_pagamentos (
-                id SERIAL PRIMARY KEY,
-                fatura_id INTEGER NOT NULL REFERENCES faturas(id) ON DELETE CASCADE,
-                pago_em TIMESTAMPTZ NOT NULL,
-                transportadora TEXT NOT NULL,
-                responsavel TEXT,
-                numero_fatura TEXT NOT NULL,
-                valor NUMERIC(10,2) NOT NULL,
-                data_vencimento DATE NOT NULL
-            );
+            ALTER TEXT SEARCH CONFIGURATION mshop_pt
+            ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem;
         """))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_historico_pagamentos_fatura_id ON historico_pagamentos(fatura_id);"))
-        try:
-            conn.execute(text("""
-                ALTER TABLE historico_pagamentos
-                ALTER COLUMN pago_em TYPE TIMESTAMPTZ
-                USING (pago_em AT TIME ZONE 'UTC');
-            """))
-        except Exception as e:
-            print("WARN schema: alter historico_pagamentos.pago_em -> timestamptz:", repr(e))
-
-        # --- users (garante existência e colunas)
         conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL
-            );
+            ALTER TEXT SEARCH CONFIGURATION mshop_simples
+            ALTER MAPPING FOR hword, hword_part, word WITH unaccent, simple;
         """))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username ON users(username);"))
 
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS email TEXT;"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT DEFAULT 'user';"))
+    # separadores viram espaço: "NF-12345/24" -> nf 12345 24 (senão "-12345" vira número negativo)
+    conn.execute(text("""
+        ALTER TABLE faturas ADD COLUMN search_tsv tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('mshop_simples'::regconfig, regexp_replace(coalesce(numero_fatura, ''), '[^[:alnum:]]+', ' ', 'g')), 'A')
+            || setweight(to_tsvector('mshop_simples'::regconfig, coalesce(transportadora, '')), 'B')
+            || setweight(to_tsvector('mshop_pt'::regconfig, coalesce(observacao, '')), 'C')
+        ) STORED;
+    """))
+    conn.execute(text(f"""
+        ALTER TABLE historico_pagamentos ADD COLUMN search_tsv tsvector
+        GENERATED ALWAYS AS ({HISTORICO_TSV_SQL}) STORED;
+    """))
+    conn.execute(text("CREATE INDEX ix_faturas_search_tsv ON faturas USING GIN (search_tsv);"))
+    conn.execute(text("CREATE INDEX ix_historico_pagamentos_search_tsv ON historico_pagamentos USING GIN (search_tsv);"))
 
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS pwd_salt TEXT;"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS pwd_hash TEXT;"))
+# =========================
+# ✅ PARTIÇÕES MENSAIS DO HISTÓRICO
+# =========================
+# historico_pagamentos é particionada por mês de pago_em (mês no fuso BR_TZ):
+# historico_pagamentos_pAAAAMM + historico_pagamentos_default (pega o que
+# cair fora). Filtro por faixa de pago_em só lê as partições do período.
+# O startup garante o mês atual + HISTORICO_PARTICOES_FUTURAS à frente.
 
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS must_change_password INTEGER DEFAULT 1;"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS first_password_changed_at TIMESTAMPTZ;"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_password_changed_at TIMESTAMPTZ;"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS password_expires_at TIMESTAMPTZ;"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT NOW();"))
-        conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMPTZ;"))
+HISTORICO_PARTICOES_FUTURAS = int(os.getenv("HISTORICO_PARTICOES_FUTURAS", "3"))
 
-        # --- transportadoras (CRIA e também ALTERA se já existia sem coluna)
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS transportadoras (
-                id SERIAL PRIMARY KEY,
-                nome TEXT UNIQUE NOT NULL
-            );
+# colunas "de verdade" (sem a gerada search_tsv), pra copiar entre tabelas
+HISTORICO_COLUNAS_SQL = "id, fatura_id, pago_em, transportadora, responsavel, numero_fatura, valor, data_vencimento"
+
+# ligado (SET LOCAL) enquanto linhas mudam de partição: o trigger de
+# remoção (migração 13) não grava nada
+GUC_MOVENDO_PARTICAO = "mshop.movendo_particao"
+
+def _somar_meses(d: date, n: int) -> date:
+    m = d.month - 1 + n
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+def _inicio_mes_br(d: date) -> str:
+    return datetime(d.year, d.month, 1, tzinfo=BR_TZ).isoformat()
+
+def nome_particao_historico(d: date) -> str:
+    return f"historico_pagamentos_p{d.year:04d}{d.month:02d}"
+
+def garantir_particoes_historico(conn, desde: Optional[date] = None, meses_futuros: Optional[int] = None) -> List[str]:
+    """Cria as partições mensais que faltam, de `desde` (ou do mês atual) até N meses à frente."""
+    if meses_futuros is None:
+        meses_futuros = HISTORICO_PARTICOES_FUTURAS
+
+    hoje = agora_br().date()
+    mes = date((desde or hoje).year, (desde or hoje).month, 1)
+    ate = max(mes, _somar_meses(date(hoje.year, hoje.month, 1), meses_futuros))
+
+    existentes = {
+        row[0]
+        for row in conn.execute(text("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'historico_pagamentos'::regclass
         """))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transportadoras_nome ON transportadoras(nome);"))
+    }
 
-        # ✅ CORREÇÃO DO ERRO (coluna não existia)
-        conn.execute(text("ALTER TABLE transportadoras ADD COLUMN IF NOT EXISTS responsavel_user_id INTEGER;"))
+    criadas = []
+    while mes <= ate:
+        nome = nome_particao_historico(mes)
+        if nome not in existentes:
+            params = {"de": _inicio_mes_br(mes), "ate": _inicio_mes_br(_somar_meses(mes, 1))}
+            no_default = conn.execute(
+                text("SELECT EXISTS (SELECT 1 FROM historico_pagamentos_default WHERE pago_em >= :de AND pago_em < :ate)"),
+                params,
+            ).scalar()
+
+            if not no_default:
+                conn.execute(text(f"""
+                    CREATE TABLE {nome} PARTITION OF historico_pagamentos
+                    FOR VALUES FROM ('{params["de"]}') TO ('{params["ate"]}');
+                """))
+            else:
+                # linhas do mês caíram no default: tira de lá antes de anexar
+                conn.execute(text(f"CREATE TABLE {nome} (LIKE historico_pagamentos INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED);"))
+                # as linhas só mudam de partição: o trigger de remoção não
+                # pode gravar tombstone (sumiriam do cache do app.js)
+                conn.execute(text(f"SELECT set_config('{GUC_MOVENDO_PARTICAO}', 'on', true)"))
+                conn.execute(text(f"""
+                    WITH movidas AS (
+                        DELETE FROM historico_pagamentos_default
+                        WHERE pago_em >= :de AND pago_em < :ate
+                        RETURNING {HISTORICO_COLUNAS_SQL}
+                    )
+                    INSERT INTO {nome} ({HISTORICO_COLUNAS_SQL}) SELECT * FROM movidas;
+                """), params)
+                conn.execute(text(f"SELECT set_config('{GUC_MOVENDO_PARTICAO}', 'off', true)"))
+                conn.execute(text(f"""
+                    ALTER TABLE historico_pagamentos ATTACH PARTITION {nome}
+                    FOR VALUES FROM ('{params["de"]}') TO ('{params["ate"]}');
+                """))
+            criadas.append(nome)
+        mes = _somar_meses(mes, 1)
+
+    return criadas
+
+def desanexar_particao_historico(conn, mes: date) -> Optional[str]:
+    """Tira a partição do mês da tabela (vira tabela comum, pronta pra arquivar/dropar)."""
+    nome = nome_particao_historico(mes)
+    anexada = conn.execute(text("""
+        SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'historico_pagamentos'::regclass AND c.relname = :nome
+    """), {"nome": nome}).first()
+    if not anexada:
+        return None
+    conn.execute(text(f"ALTER TABLE historico_pagamentos DETACH PARTITION {nome};"))
+    return nome
 
-        # tenta criar FK (se já existir, ignora)
-        try:
-            conn.execute(text("""
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1
-                        FROM pg_constraint
-                        WHERE conname = 'transportadoras_responsavel_user_id_fkey'
-                    ) THEN
-                        ALTER TABLE transportadoras
-                        ADD CONSTRAINT transportadoras_responsavel_user_id_fkey
-                        FOREIGN KEY (responsavel_user_id) REFERENCES users(id);
-                    END IF;
-                END $$;
-            """))
-        except Exception as e:
-            print("WARN schema: FK transportadoras.responsavel_user_id -> users(id):", repr(e))
+def manter_particoes_historico():
+    try:
+        with get_engine().begin() as conn:
+            # mesmo lock das migrações: vários workers sobem juntos
+            conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
+            criadas = garantir_particoes_historico(conn)
+        if criadas:
+            print("PARTIÇÕES: criadas", ", ".join(criadas))
+    except Exception as e:
+        print("WARN partições do histórico:", repr(e))
+
+def _mig_003_historico_particionado(conn):
+    # a tabela antiga vira "legado"; nomes de índice/PK são globais, então saem antes
+    conn.execute(text("DROP INDEX IF EXISTS ix_historico_pagamentos_id;"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_historico_pagamentos_fatura_id;"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_historico_pagamentos_search_tsv;"))
+    conn.execute(text("ALTER TABLE historico_pagamentos RENAME CONSTRAINT historico_pagamentos_pkey TO historico_pagamentos_legado_pkey;"))
+    conn.execute(text("ALTER TABLE historico_pagamentos RENAME TO historico_pagamentos_legado;"))
+    # a sequence do id continua a mesma (ids não mudam); só não pode cair junto com o legado
+    conn.execute(text("ALTER SEQUENCE historico_pagamentos_id_seq OWNED BY NONE;"))
+
+    # PK precisa conter a chave de partição
+    conn.execute(text(f"""
+        CREATE TABLE historico_pagamentos (
+            id INTEGER NOT NULL DEFAULT nextval('historico_pagamentos_id_seq'),
+            fatura_id INTEGER REFERENCES faturas(id) ON DELETE CASCADE,
+            pago_em TIMESTAMPTZ NOT NULL,
+            transportadora VARCHAR NOT NULL,
+            responsavel VARCHAR,
+            numero_fatura VARCHAR NOT NULL,
+            valor NUMERIC(10, 2) NOT NULL,
+            data_vencimento DATE NOT NULL,
+            search_tsv tsvector GENERATED ALWAYS AS ({HISTORICO_TSV_SQL}) STORED,
+            PRIMARY KEY (id, pago_em)
+        ) PARTITION BY RANGE (pago_em);
+    """))
+    conn.execute(text("CREATE TABLE historico_pagamentos_default PARTITION OF historico_pagamentos DEFAULT;"))
+
+    primeiro = conn.execute(text("SELECT MIN(pago_em) FROM historico_pagamentos_legado")).scalar()
+    garantir_particoes_historico(conn, desde=primeiro.astimezone(BR_TZ).date() if primeiro else None)
+
+    conn.execute(text(f"""
+        INSERT INTO historico_pagamentos ({HISTORICO_COLUNAS_SQL})
+        SELECT {HISTORICO_COLUNAS_SQL} FROM historico_pagamentos_legado;
+    """))
+    conn.execute(text("DROP TABLE historico_pagamentos_legado;"))
+    conn.execute(text("ALTER SEQUENCE historico_pagamentos_id_seq OWNED BY historico_pagamentos.id;"))
+
+    # índices no pai depois da cópia (cada partição ganha o seu)
+    conn.execute(text("CREATE INDEX ix_historico_pagamentos_pago_em ON historico_pagamentos (pago_em);"))
+    conn.execute(text("CREATE INDEX ix_historico_pagamentos_fatura_id ON historico_pagamentos (fatura_id);"))
+    conn.execute(text("CREATE INDEX ix_historico_pagamentos_search_tsv ON historico_pagamentos USING GIN (search_tsv);"))
+
+def _mig_004_arquivo_lotes(conn):
+    ArquivoLoteDB.__table__.create(conn, checkfirst=True)
+    # o arquivamento procura faturas pagas antigas
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_faturas_data_pagamento ON faturas (data_pagamento);"))
+
+def _mig_005_busca_prefixo_admin(conn):
+    # busca por prefixo da tela de admin: lower(x) LIKE 'abc%'
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username) text_pattern_ops);"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transportadoras_nome_lower ON transportadoras (lower(nome) text_pattern_ops);"))
+
+def _mig_006_idempotencia(conn):
+    IdempotenciaDB.__table__.create(conn, checkfirst=True)
+
+def _mig_007_fila_tarefas(conn):
+    TarefaDB.__table__.create(conn, checkfirst=True)
+    # o dequeue só olha as pendentes, em ordem de execução
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_pendentes ON jobs (executar_em, id) WHERE estado = 'pendente';"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_executando ON jobs (travada_em) WHERE estado = 'executando';"))
+
+def _mig_008_exportacoes(conn):
+    ExportacaoDB.__table__.create(conn, checkfirst=True)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_exportacoes_impressao ON exportacoes (impressao, criado_em DESC);"))
+
+def _mig_009_mudancas(conn):
+    conn.execute(text("ALTER TABLE faturas ADD COLUMN IF NOT EXISTS atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now();"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_faturas_atualizado_em ON faturas (atualizado_em);"))
+    RemocaoDB.__table__.create(conn, checkfirst=True)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_remocoes_tabela_removido_em ON remocoes (tabela, removido_em);"))
+
+    # trigger e não onupdate do ORM: pega também UPDATE em massa (virada de status)
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION mshop_tocar_atualizado_em() RETURNS trigger AS $$
+        BEGIN
+            NEW.atualizado_em := now();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+    """))
+    # nome da tabela vem por argumento: no histórico o trigger roda na partição
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION mshop_registrar_remocao() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO remocoes (tabela, registro_id) VALUES (TG_ARGV[0], OLD.id);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER trg_faturas_atualizado_em BEFORE UPDATE ON faturas
+        FOR EACH ROW EXECUTE FUNCTION mshop_tocar_atualizado_em();
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER trg_faturas_remocao AFTER DELETE ON faturas
+        FOR EACH ROW EXECUTE FUNCTION mshop_registrar_remocao('faturas');
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER trg_historico_remocao AFTER DELETE ON historico_pagamentos
+        FOR EACH ROW EXECUTE FUNCTION mshop_registrar_remocao('historico_pagamentos');
+    """))
+
+def _mig_010_indices_filtro_faturas(conn):
+    # ?status= de /faturas (em minúsculas) + faixa de vencimento; também
+    # atende a virada automática (pendente com vencimento <= corte)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_faturas_status_vencimento ON faturas (lower(status), data_vencimento);"))
+
+def _mig_011_limites_taxa(conn):
+    LimiteTaxaDB.__table__.create(conn, checkfirst=True)
+
+def _mig_012_auditoria_faturas(conn):
+    AuditoriaFaturaDB.__table__.create(conn, checkfirst=True)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_auditoria_faturas_fatura ON auditoria_faturas (fatura_id, criado_em DESC);"))
+
+def _mig_013_remocao_ignora_particao(conn):
+    # linha movida do default pra partição nova não foi removida: sem tombstone
+    conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION mshop_registrar_remocao() RETURNS trigger AS $$
+        BEGIN
+            IF current_setting('{GUC_MOVENDO_PARTICAO}', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO remocoes (tabela, registro_id) VALUES (TG_ARGV[0], OLD.id);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+    """))
+
+# (versão, descrição, função) — sempre acrescentar no FIM, nunca renumerar
+MIGRATIONS = [
+    (1, "baseline (antigo ensure_schema)", _mig_001_baseline),
+    (2, "busca textual (tsvector + GIN)", _mig_002_busca_textual),
+    (3, "historico_pagamentos particionado por mês", _mig_003_historico_particionado),
+    (4, "índice do arquivo frio (arquivo_lotes)", _mig_004_arquivo_lotes),
+    (5, "índices de busca por prefixo (admin)", _mig_005_busca_prefixo_admin),
+    (6, "chaves de idempotência", _mig_006_idempotencia),
+    (7, "fila de tarefas (jobs)", _mig_007_fila_tarefas),
+    (8, "exportações assíncronas", _mig_008_exportacoes),
+    (9, "feed de mudanças (atualizado_em + remocoes)", _mig_009_mudancas),
+    (10, "índice composto do filtro de status das faturas", _mig_010_indices_filtro_faturas),
+    (11, "baldes de limite de taxa compartilhados", _mig_011_limites_taxa),
+    (12, "auditoria de faturas", _mig_012_auditoria_faturas),
+    (13, "remoções ignoram troca de partição do histórico", _mig_013_remocao_ignora_particao),
+]
+
+def versao_schema_atual(conn) -> int:
+    return int(conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar() or 0)
+
+def run_migrations():
+    alvo = MIGRATIONS[-1][0]
+
+    # caminho rápido: uma única leitura da versão
+    try:
+        with get_engine().connect() as conn:
+            if versao_schema_atual(conn) >= alvo:
+                return
+    except Exception:
+        pass  # tabela schema_migrations ainda não existe
 
-        # --- password_resets
+    with get_engine().begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
         conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS password_resets (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                token_hash TEXT NOT NULL,
-                expires_at TIMESTAMPTZ NOT NULL,
-                used_at TIMESTAMPTZ
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                descricao TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             );
         """))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_password_resets_token_hash ON password_resets(token_hash);"))
 
-ensure_schema()
+        # outro worker pode ter aplicado enquanto esperávamos o lock
+        aplicadas = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+        for versao, descricao, fn in MIGRATIONS:
+            if versao in aplicadas:
+                continue
+            print(f"MIGRATION: aplicando {versao} - {descricao}")
+            fn(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, descricao) VALUES (:v, :d)"),
+                {"v": versao, "d": descricao},
+            )
 
 # =========================
 # RESPONSÁVEL (fallback antigo)
@@ -431,12 +1136,13 @@ def hash_password(password: str, salt: Optional[str] = None) -> Tuple[str, str]:
     else:
         salt_bytes = _b64url_decode(salt)
 
-    dk = hashlib.pbkdf2_hmac(
-        HASH_ALGO,
-        password.encode("utf-8"),
-        salt_bytes,
-        PBKDF2_ITERS,
-    )
+    with bulkhead("hash"), PBKDF2_LATENCIA.time():
+        dk = hashlib.pbkdf2_hmac(
+            HASH_ALGO,
+            password.encode("utf-8"),
+            salt_bytes,
+            PBKDF2_ITERS,
+        )
     return salt, _b64url(dk)
 
 def verify_password(password: str, salt: Optional[str], pwd_hash: Optional[str]) -> bool:
@@ -494,11 +1200,16 @@ def clear_auth_cookies(resp: Response):
     resp.delete_cookie(COOKIE_NAME, path="/")
     resp.delete_cookie(CSRF_COOKIE, path="/")
 
+def sessao_atual(request: Request) -> Optional[dict]:
+    # cookie verificado (HMAC + JSON) uma vez por requisição: o primeiro
+    # acesso decodifica e o resultado fica em request.state
+    if not hasattr(request.state, "sessao"):
+        token = request.cookies.get(COOKIE_NAME)
+        request.state.sessao = verify_signed(token, SESSION_SECRET) if token else None
+    return request.state.sessao
+
 def get_current_user(request: Request, db: Session) -> Optional[UserDB]:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        return None
-    payload = verify_signed(token, SESSION_SECRET)
+    payload = sessao_atual(request)
     if not payload:
         return None
     exp = payload.get("exp")
@@ -508,22 +1219,19 @@ def get_current_user(request: Request, db: Session) -> Optional[UserDB]:
     if int(exp) < int(agora_br().timestamp()):
         return None
 
-    user = db.query(UserDB).filter(UserDB.id == int(uid)).first()
+    # db.get usa o identity map: segunda chamada na mesma sessão não vai ao banco
+    user = db.get(UserDB, int(uid))
+    request.state.usuario = user
     return user
 
 def get_session_csrf(request: Request) -> Optional[str]:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        return None
-    payload = verify_signed(token, SESSION_SECRET)
+    payload = sessao_atual(request)
     if not payload:
         return None
     return payload.get("csrf")
 
 def validate_csrf(request: Request, csrf_form_value: Optional[str]) -> bool:
-    if not csrf_form_value:
-        csrf_form_value = request.cookies.get(CSRF_COOKIE)
-
+    # o token tem que vir no formulário/header: o cookie vai sozinho num POST de outro site
     if not csrf_form_value:
         return False
 
@@ -598,19 +1306,129 @@ class TransportadoraOut(BaseModel):
     class Config:
         from_attributes = True
 
+# =========================
+# ✅ CACHE LOCAL + INVALIDAÇÃO ENTRE WORKERS (LISTEN/NOTIFY)
+# =========================
+# Cada worker tem seus caches em memória (registrar_cache). Quem escreve
+# chama notificar_invalidacao(db, topico, chave) na mesma transação: o
+# Postgres entrega "topico:chave" no canal mshop_invalidate só no COMMIT e
+# a thread ouvinte de cada worker apaga as entradas. O TTL é a rede de
+# segurança; ao (re)conectar o ouvinte limpa tudo, porque pode ter perdido
+# avisos. CACHE_TTL_S=0 desliga os caches e o ouvinte.
+
+CACHE_TTL_S = float(os.getenv("CACHE_TTL_S", "60"))
+CANAL_INVALIDACAO = "mshop_invalidate"
+
+class CacheLocal:
+    def __init__(self, topico: str, ttl: float, max_itens: int = 512):
+        self.topico = topico
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._itens: dict = {}
+        self._geracao = 0
+        self._lock = threading.Lock()
+
+    def obter(self, chave: str, carregar):
+        if self.ttl <= 0:
+            return carregar()
+
+        agora = time.monotonic()
+        with self._lock:
+            item = self._itens.get(chave)
+            if item and item[0] > agora:
+                CACHE_CONSULTAS.labels(self.topico, "hit").inc()
+                return item[1]
+            geracao = self._geracao
+
+        CACHE_CONSULTAS.labels(self.topico, "miss").inc()
+        valor = carregar()
+        with self._lock:
+            # invalidado enquanto carregava: o valor pode já estar velho
+            if geracao == self._geracao:
+                if len(self._itens) >= self.max_itens:
+                    self._itens.clear()
+                self._itens[chave] = (agora + self.ttl, valor)
+        return valor
+
+    def invalidar(self, chave: str = "*"):
+        with self._lock:
+            self._geracao += 1
+            if chave == "*":
+                self._itens.clear()
+            else:
+                self._itens.pop(chave, None)
+
+_caches: dict = defaultdict(list)
+
+def registrar_cache(topico: str, ttl: Optional[float] = None) -> CacheLocal:
+    cache = CacheLocal(topico, CACHE_TTL_S if ttl is None else ttl)
+    _caches[topico].append(cache)
+    return cache
+
+def invalidar_local(topico: str, chave: str = "*"):
+    for cache in _caches.get(topico, ()):
+        cache.invalidar(chave)
+
+def notificar_invalidacao(db: Session, topico: str, chave: str = "*"):
+    # NOTIFY é transacional: os outros workers só recebem no commit
+    db.execute(
+        text("SELECT pg_notify(:canal, :payload)"),
+        {"canal": CANAL_INVALIDACAO, "payload": f"{topico}:{chave}"},
+    )
+    invalidar_local(topico, chave)
+
+_ouvinte_parar = threading.Event()
+
+def _ouvir_invalidacoes():
+    import select
+
+    while not _ouvinte_parar.is_set():
+        pg = None
+        try:
+            # conexão dedicada, fora do pool (fica presa no LISTEN)
+            raw = get_engine().raw_connection()
+            pg = raw.driver_connection
+            raw.detach()
+            pg.autocommit = True
+            pg.cursor().execute(f"LISTEN {CANAL_INVALIDACAO};")
+
+            for topico in list(_caches):
+                invalidar_local(topico)
+
+            while not _ouvinte_parar.is_set():
+                if select.select([pg], [], [], 1.0)[0]:
+                    pg.poll()
+                    while pg.notifies:
+                        topico, _, chave = pg.notifies.pop(0).payload.partition(":")
+                        invalidar_local(topico, chave or "*")
+        except Exception as e:
+            print("WARN ouvinte de invalidação (reconectando):", repr(e))
+            _ouvinte_parar.wait(2)
+        finally:
+            if pg is not None:
+                try:
+                    pg.close()
+                except Exception:
+                    pass
+
+def iniciar_ouvinte_invalidacao() -> Optional[threading.Thread]:
+    if CACHE_TTL_S <= 0:
+        return None
+    _ouvinte_parar.clear()
+    t = threading.Thread(target=_ouvir_invalidacoes, name="mshop-invalidacao", daemon=True)
+    t.start()
+    return t
+
+CACHE_RESPONSAVEIS = registrar_cache("responsaveis")
+# resumo do dashboard: TTL menor, pode ter sido lido de réplica atrasada
+CACHE_DASHBOARD = registrar_cache("faturas", ttl=min(CACHE_TTL_S, float(os.getenv("CACHE_DASHBOARD_TTL_S", "30"))))
+
 # =========================
 # HELPERS FATURAS
 # =========================
 
 def get_responsavel(db: Session, transportadora: str) -> Optional[str]:
-    if transportadora:
-        nome_base = transportadora.split("-")[0].strip()
-        tr = db.query(TransportadoraDB).filter(TransportadoraDB.nome.ilike(nome_base)).first()
-        if tr and tr.responsavel_user_id:
-            u = db.query(UserDB).filter(UserDB.id == tr.responsavel_user_id).first()
-            if u:
-                return u.username
-    return get_responsavel_fallback(transportadora)
+    return resolver_responsavel(mapa_responsaveis(db), transportadora)
 
 def fatura_to_out(db: Session, f: FaturaDB) -> FaturaOut:
     return FaturaOut(
@@ -625,13 +1443,139 @@ def fatura_to_out(db: Session, f: FaturaDB) -> FaturaOut:
         data_pagamento=f.data_pagamento,
     )
 
-def transportadora_to_out(db: Session, tr: TransportadoraDB) -> TransportadoraOut:
-    resp = None
-    if tr.responsavel_user_id:
-        u = db.query(UserDB).filter(UserDB.id == tr.responsavel_user_id).first()
-        if u:
-            resp = u.username
-    return TransportadoraOut(id=tr.id, nome=tr.nome, responsavel=resp)
+# =========================
+# ✅ SERIALIZAÇÃO RÁPIDA (listas)
+# =========================
+# Endpoints de lista montam dicts direto das linhas do banco e viram bytes
+# via orjson, sem instanciar/validar um Pydantic por linha. O formato é o
+# mesmo do response_model (valor float, datas ISO, UTC com "Z").
+
+ORJSON_OPTS = orjson.OPT_UTC_Z
+
+def json_response(data, status_code: int = 200) -> Response:
+    return Response(orjson.dumps(data, option=ORJSON_OPTS), status_code=status_code, media_type="application/json")
+
+def _carregar_mapa_responsaveis(db: Session) -> dict:
+    # uma query só (em vez de 2 por linha no get_responsavel)
+    rows = (
+        db.query(func.lower(TransportadoraDB.nome), UserDB.username)
+        .join(UserDB, UserDB.id == TransportadoraDB.responsavel_user_id)
+        .all()
+    )
+    return {nome: username for nome, username in rows}
+
+def mapa_responsaveis(db: Session) -> dict:
+    # cacheado por worker; invalidado pelo tópico "responsaveis" (não alterar o dict)
+    return CACHE_RESPONSAVEIS.obter("mapa", lambda: _carregar_mapa_responsaveis(db))
+
+def resolver_responsavel(mapa: dict, transportadora: str) -> Optional[str]:
+    if transportadora:
+        nome_base = transportadora.split("-")[0].strip()
+        resp = mapa.get(nome_base.lower())
+        if resp:
+            return resp
+    return get_responsavel_fallback(transportadora)
+
+FATURA_CAMPOS_OUT = (
+    "transportadora", "numero_fatura", "valor", "data_vencimento", "status",
+    "observacao", "id", "responsavel", "data_pagamento",
+)
+
+FATURA_COLUNAS = (
+    FaturaDB.id,
+    FaturaDB.transportadora,
+    FaturaDB.numero_fatura,
+    FaturaDB.valor,
+    FaturaDB.data_vencimento,
+    FaturaDB.status,
+    FaturaDB.observacao,
+    FaturaDB.data_pagamento,
+)
+
+def fatura_para_dict(f, mapa: dict) -> dict:
+    # mesma ordem de campos do FaturaOut
+    return {
+        "transportadora": f.transportadora,
+        "numero_fatura": f.numero_fatura,
+        "valor": float(f.valor or 0),
+        "data_vencimento": f.data_vencimento,
+        "status": f.status,
+        "observacao": f.observacao,
+        "id": f.id,
+        "responsavel": resolver_responsavel(mapa, f.transportadora),
+        "data_pagamento": f.data_pagamento,
+    }
+
+HISTORICO_CAMPOS_OUT = (
+    "id", "fatura_id", "pago_em", "transportadora", "responsavel",
+    "numero_fatura", "valor", "data_vencimento",
+)
+
+HISTORICO_COLUNAS = (
+    HistoricoPagamentoDB.id,
+    HistoricoPagamentoDB.fatura_id,
+    HistoricoPagamentoDB.pago_em,
+    HistoricoPagamentoDB.transportadora,
+    HistoricoPagamentoDB.responsavel,
+    HistoricoPagamentoDB.numero_fatura,
+    HistoricoPagamentoDB.valor,
+    HistoricoPagamentoDB.data_vencimento,
+)
+
+# =========================
+# ✅ FORMATO COLUNAR (?format=columns)
+# =========================
+# {"columns": [...], "dicts": {col: [valores]}, "rows": [[...], ...]}
+# transportadora/responsavel/status vêm como índice no dicts[col]
+# (null continua null). Também aceito via Accept: COLUNAR_MEDIA_TYPE.
+
+COLUNAR_MEDIA_TYPE = "application/vnd.mshop.columns+json"
+COLUNAS_DICIONARIO = ("transportadora", "responsavel", "status")
+
+def quer_colunar(request: Request, formato: Optional[str]) -> bool:
+    if formato:
+        return formato.strip().lower() == "columns"
+    return COLUNAR_MEDIA_TYPE in request.headers.get("accept", "")
+
+def colunar_response(itens: list, colunas: tuple) -> Response:
+    dicts = {c: [] for c in COLUNAS_DICIONARIO if c in colunas}
+    indices = {c: {} for c in dicts}
+    codificar = [(pos, c) for pos, c in enumerate(colunas) if c in indices]
+
+    rows = []
+    for item in itens:
+        row = list(item.values())
+        for pos, c in codificar:
+            v = row[pos]
+            if v is None:
+                continue
+            i = indices[c].get(v)
+            if i is None:
+                i = indices[c][v] = len(dicts[c])
+                dicts[c].append(v)
+            row[pos] = i
+        rows.append(row)
+
+    body = orjson.dumps({"columns": colunas, "dicts": dicts, "rows": rows}, option=ORJSON_OPTS)
+    return Response(body, media_type="application/json", headers={"Vary": "Accept"})
+
+def lista_response(request: Request, formato: Optional[str], itens: list, colunas: tuple) -> Response:
+    if quer_colunar(request, formato):
+        return colunar_response(itens, colunas)
+    return json_response(itens)
+
+def historico_para_dict(h) -> dict:
+    # mesma ordem de campos do HistoricoPagamentoOut
+    return {
+        "id": h.id,
+        "fatura_id": h.fatura_id,
+        "pago_em": h.pago_em,
+        "transportadora": h.transportadora,
+        "responsavel": h.responsavel,
+        "numero_fatura": h.numero_fatura,
+        "valor": float(h.valor or 0),
+        "data_vencimento": h.data_vencimento,
+    }
 
 # =========================
 # ✅ REGRA AUTOMÁTICA (atraso)
@@ -645,15 +1589,24 @@ def atualizar_status_automatico(db: Session):
     hoje = hoje_local_br()
     corte = quarta_da_semana_atual(hoje)
 
-    q = (
-        db.query(FaturaDB)
-        .filter(FaturaDB.status.ilike("pendente"))
-        .filter(FaturaDB.data_vencimento <= corte)
-    )
-
-    alteradas = q.update({FaturaDB.status: "atrasado"}, synchronize_session=False)
+    # a CTE devolve o status como estava gravado ("Pendente", "PENDENTE"...) pra auditoria
+    alteradas = db.execute(text("""
+        WITH alvo AS (
+            SELECT id, status FROM faturas
+             WHERE lower(status) = 'pendente' AND data_vencimento <= :corte
+               FOR UPDATE
+        )
+        UPDATE faturas f SET status = 'atrasado'
+          FROM alvo
+         WHERE f.id = alvo.id
+        RETURNING f.id, alvo.status
+    """), {"corte": corte}).all()
     if alteradas:
+        notificar_invalidacao(db, "faturas")
         db.commit()
+        for fid, antes in alteradas:
+            registrar_auditoria(fid, "atualizar", {"status": [antes, "atrasado"]})
+    return len(alteradas)
 
 # =========================
 # ✅ HISTÓRICO DE PAGAMENTO
@@ -682,17 +1635,477 @@ def remover_historico_pagamento(db: Session, fatura_id: int):
 # =========================
 
 def get_db():
-    db = SessionLocal()
+    db = new_session()
     try:
         yield db
     finally:
         db.close()
 
+# =========================
+# ✅ RÉPLICA DE LEITURA (opcional)
+# =========================
+# Com DATABASE_REPLICA_URL, endpoints só-leitura usam get_read_db e leem da
+# réplica. Voltam pro primário quando:
+#  - o usuário escreveu há menos de READ_YOUR_WRITES_S (cookie mshop_rw);
+#  - a réplica está mais de REPLICA_MAX_LAG_S atrasada ou não responde.
+# O atraso é medido no máximo a cada REPLICA_LAG_CHECK_S, por processo.
+
+READ_YOUR_WRITES_S = int(os.getenv("READ_YOUR_WRITES_S", "10"))
+REPLICA_MAX_LAG_S = float(os.getenv("REPLICA_MAX_LAG_S", "5"))
+REPLICA_LAG_CHECK_S = float(os.getenv("REPLICA_LAG_CHECK_S", "2"))
+RYW_COOKIE = "mshop_rw"
+
+# (medido_em monotonic, atraso em segundos | None = réplica indisponível)
+_replica_lag: Tuple[float, Optional[float]] = (float("-inf"), None)
+
+def atraso_replica() -> Optional[float]:
+    global _replica_lag
+    medido_em, lag = _replica_lag
+    if time.monotonic() - medido_em < REPLICA_LAG_CHECK_S:
+        return lag
+
+    try:
+        with get_engine_replica().connect() as conn:
+            # LSN recebido == aplicado -> em dia, mesmo com o primário ocioso
+            lag = float(conn.execute(text("""
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+            """)).scalar())
+    except Exception as e:
+        print("WARN réplica indisponível, lendo do primário:", repr(e))
+        lag = None
+
+    _replica_lag = (time.monotonic(), lag)
+    return lag
+
+def destino_leitura(request: Request) -> Tuple[str, str]:
+    try:
+        if float(request.cookies.get(RYW_COOKIE) or 0) > time.time():
+            return "primario", "escrita_recente"
+    except ValueError:
+        pass
+
+    lag = atraso_replica()
+    if lag is None:
+        return "primario", "replica_indisponivel"
+    if lag > REPLICA_MAX_LAG_S:
+        return "primario", "replica_atrasada"
+    return "replica", "ok"
+
+def get_read_db(request: Request, db: Session = Depends(get_db)):
+    # sem réplica configurada é a própria sessão do primário (mesmo objeto do get_db)
+    if not DATABASE_REPLICA_URL:
+        yield db
+        return
+
+    destino, motivo = destino_leitura(request)
+    DB_LEITURAS.labels(destino, motivo).inc()
+    if destino == "primario":
+        yield db
+        return
+
+    leitura = SessionLocal(bind=get_engine_replica())
+    try:
+        yield leitura
+    finally:
+        leitura.close()
+
 # =========================
 # APP / STATIC / TEMPLATES
 # =========================
 
-app = FastAPI(title="Sistema de Faturas", version="2.0.3")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # roda em cada worker (não no master do gunicorn): migração, admin inicial
+    verificar_config_r2()
+    run_migrations()
+    manter_particoes_historico()
+    iniciar_ouvinte_invalidacao()
+    iniciar_worker_tarefas()
+
+    db = new_session()
+    try:
+        bootstrap_admin(db)
+    finally:
+        db.close()
+
+    yield
+
+    _ouvinte_parar.set()
+    _tarefas_parar.set()
+    parar_gravador_auditoria()
+    for eng in (_engine, _engine_replica):
+        if eng is not None:
+            eng.dispose()
+
+app = FastAPI(title="Sistema de Faturas", version="2.0.3", lifespan=lifespan)
+
+def rota_template(request: Request) -> str:
+    # varre app.routes uma vez por requisição (no middleware mais externo);
+    # os de dentro leem o que ficou em request.state
+    rota = getattr(request.state, "rota", None)
+    if rota is None:
+        rota = "<sem_rota>"
+        for route in request.app.router.routes:
+            match, _ = route.matches(request.scope)
+            if match == Match.FULL:
+                rota = getattr(route, "path", request.url.path)
+                break
+        request.state.rota = rota
+    return rota
+
+# registrado depois do limite de taxa (mais abaixo): tem que ficar por fora
+# dele pra contar os 429 na latência/status
+async def metricas_http(request: Request, call_next):
+    rota = rota_template(request)
+    token = _rota_atual.set(rota)
+    stats = ConsultasRequisicao()
+    token_stats = _db_stats.set(stats)
+    em_voo = HTTP_EM_VOO.labels(request.method, rota)
+    em_voo.inc()
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+
+        if DEBUG:
+            response.headers["X-DB-Queries"] = str(stats.queries)
+            response.headers["X-DB-Time"] = f"{stats.segundos * 1000:.1f}"
+
+        orcamento = orcamento_queries(request.method, rota)
+        if orcamento and stats.queries > orcamento:
+            msg = f"{request.method} {rota} executou {stats.queries} queries (orçamento {orcamento})"
+            print("WARN query budget:", msg)
+            if DB_QUERY_BUDGET_ASSERT:
+                raise AssertionError(msg)
+
+        return response
+    finally:
+        HTTP_LATENCIA.labels(request.method, rota, str(status)).observe(time.perf_counter() - t0)
+        DB_QUERIES_POR_REQ.labels(rota).observe(stats.queries)
+        em_voo.dec()
+        _db_stats.reset(token_stats)
+        _rota_atual.reset(token)
+
+# depois de uma escrita, as leituras desse navegador ficam no primário por
+# READ_YOUR_WRITES_S (a réplica pode ainda não ter a mudança)
+@app.middleware("http")
+async def marcar_escrita_recente(request: Request, call_next):
+    response = await call_next(request)
+    if (
+        DATABASE_REPLICA_URL
+        and request.method not in ("GET", "HEAD", "OPTIONS")
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            RYW_COOKIE,
+            str(int(time.time()) + READ_YOUR_WRITES_S),
+            max_age=READ_YOUR_WRITES_S,
+            httponly=True,
+            secure=COOKIE_SECURE,
+            samesite="lax",
+            path="/",
+        )
+    return response
+
+# =========================
+# ✅ IDEMPOTÊNCIA (Idempotency-Key)
+# =========================
+# POST /faturas e POST /faturas/{id}/anexos aceitam o header
+# Idempotency-Key (por usuário). A primeira requisição reserva a chave e
+# grava a resposta 2xx; repetições com o mesmo pedido recebem a resposta
+# gravada (Idempotent-Replayed: true) sem executar de novo. Outro pedido
+# com a mesma chave -> 422; original ainda em andamento -> 409.
+# Erro (não-2xx) libera a chave pra nova tentativa. Reserva abandonada
+# (worker caiu) pode ser retomada depois de IDEMPOTENCIA_TRAVA_S.
+
+IDEMPOTENCIA_ROTAS = {("POST", "/faturas"), ("POST", "/faturas/{fatura_id}/anexos")}
+IDEMPOTENCIA_TTL_S = int(os.getenv("IDEMPOTENCIA_TTL_S", str(24 * 3600)))
+IDEMPOTENCIA_TRAVA_S = int(os.getenv("IDEMPOTENCIA_TRAVA_S", "120"))
+
+def _idem_reservar(uid: int, chave: str, rota: str, impressao: str):
+    """None = reserva nossa (executar); senão a linha existente."""
+    with get_engine().begin() as conn:
+        nossa = conn.execute(text("""
+            INSERT INTO idempotency_keys (usuario_id, chave, rota, impressao, estado, criado_em, expira_em)
+            VALUES (:u, :k, :r, :i, 'em_andamento', now(), now() + make_interval(secs => :ttl))
+            ON CONFLICT (usuario_id, chave) DO UPDATE
+               SET rota = EXCLUDED.rota, impressao = EXCLUDED.impressao, estado = 'em_andamento',
+                   status_code = NULL, content_type = NULL, corpo = NULL,
+                   criado_em = now(), expira_em = EXCLUDED.expira_em
+             WHERE idempotency_keys.expira_em < now()
+                OR (idempotency_keys.estado = 'em_andamento'
+                    AND idempotency_keys.criado_em < now() - make_interval(secs => :trava))
+            RETURNING 1
+        """), {"u": uid, "k": chave, "r": rota, "i": impressao, "ttl": IDEMPOTENCIA_TTL_S, "trava": IDEMPOTENCIA_TRAVA_S}).first()
+        if nossa:
+            return None
+        return conn.execute(
+            text("SELECT estado, impressao, status_code, content_type, corpo FROM idempotency_keys WHERE usuario_id = :u AND chave = :k"),
+            {"u": uid, "k": chave},
+        ).first()
+
+def _idem_concluir(uid: int, chave: str, status_code: int, content_type: Optional[str], corpo: bytes):
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            UPDATE idempotency_keys
+               SET estado = 'concluida', status_code = :s, content_type = :ct, corpo = :c
+             WHERE usuario_id = :u AND chave = :k
+        """), {"u": uid, "k": chave, "s": status_code, "ct": content_type, "c": corpo})
+
+def _idem_liberar(uid: int, chave: str):
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("DELETE FROM idempotency_keys WHERE usuario_id = :u AND chave = :k AND estado = 'em_andamento'"),
+            {"u": uid, "k": chave},
+        )
+
+def _idem_usuario(request: Request) -> Optional[int]:
+    # mesma checagem do usuario_api (exp, usuário existe, sem troca de senha
+    # pendente): sessão vencida não pode receber resposta gravada
+    db = new_session()
+    try:
+        u = get_current_user(request, db)
+        if not u or needs_password_change(u):
+            return None
+        return u.id
+    finally:
+        db.close()
+
+@app.middleware("http")
+async def idempotencia(request: Request, call_next):
+    chave = request.headers.get("Idempotency-Key")
+    if not chave or (request.method, rota_template(request)) not in IDEMPOTENCIA_ROTAS:
+        return await call_next(request)
+
+    uid = await run_in_threadpool(_idem_usuario, request)
+    if not uid:
+        return await call_next(request)  # sem sessão válida: a própria rota responde 401/403
+    if len(chave) > 200:
+        return json_response({"detail": "Idempotency-Key muito longa (máx. 200)"}, status_code=400)
+
+    # multipart muda o boundary a cada envio: aí a impressão é só método + caminho
+    impressao = hashlib.sha256(f"{request.method} {request.url.path}\n".encode("utf-8"))
+    if not (request.headers.get("content-type") or "").startswith("multipart/"):
+        impressao.update(await request.body())
+    impressao = impressao.hexdigest()
+
+    existente = await run_in_threadpool(_idem_reservar, uid, chave, request.url.path, impressao)
+    if existente is not None:
+        if existente.impressao != impressao:
+            return json_response({"detail": "Idempotency-Key já usada com outro pedido"}, status_code=422)
+        if existente.estado != "concluida":
+            resp = json_response({"detail": "Pedido com esta Idempotency-Key ainda em processamento"}, status_code=409)
+            resp.headers["Retry-After"] = "1"
+            return resp
+        return Response(
+            bytes(existente.corpo or b""),
+            status_code=existente.status_code,
+            media_type=existente.content_type,
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        await run_in_threadpool(_idem_liberar, uid, chave)
+        raise
+
+    if not 200 <= response.status_code < 300:
+        await run_in_threadpool(_idem_liberar, uid, chave)
+        return response
+
+    corpo = b"".join([parte async for parte in response.body_iterator])
+    await run_in_threadpool(_idem_concluir, uid, chave, response.status_code, response.headers.get("content-type"), corpo)
+
+    novo = Response(corpo, status_code=response.status_code, background=response.background)
+    novo.raw_headers = list(response.raw_headers)  # mantém todos os Set-Cookie
+    return novo
+
+# =========================
+# ✅ LIMITE DE TAXA E CONTROLE DE CARGA
+# =========================
+# Token bucket por usuário (sem sessão: por IP, se configurado). Cada identidade tem
+# LIMITE_RAJADA fichas, que voltam a LIMITE_TAXA por segundo; as rotas
+# caras gastam LIMITE_CUSTOS fichas por chamada (rota fora da tabela não
+# gasta). Faltou ficha -> 429 com Retry-After.
+# LIMITE_CUSTOS (env) sobrescreve a tabela: "GET /faturas/exportar=20,POST /login=10"
+# (custo 0 desliga a rota). LIMITE_BACKEND=postgres divide os baldes entre
+# os processos pela tabela rate_limits; se o banco falhar, vale o balde local.
+# Além da taxa, exportação síncrona e PBKDF2 têm teto de execuções
+# simultâneas por processo (bulkhead): sem vaga em BULKHEAD_ESPERA_S -> 429.
+
+LIMITE_ATIVO = os.getenv("LIMITE_ATIVO", "1") == "1"
+LIMITE_TAXA = max(float(os.getenv("LIMITE_TAXA", "1")), 0.001)  # fichas por segundo
+LIMITE_RAJADA = float(os.getenv("LIMITE_RAJADA", "30"))
+LIMITE_BACKEND = os.getenv("LIMITE_BACKEND", "memoria").strip().lower()  # memoria | postgres
+LIMITE_MAX_CHAVES = int(os.getenv("LIMITE_MAX_CHAVES", "10000"))
+# Sem sessão a chave é o IP, mas só se a origem dele for confiável: atrás de
+# proxy o client.host é o proxy (todo mundo cairia num balde só), então é
+# preciso LIMITE_IP_HEADER=X-Forwarded-For (ou o header do proxy) ou, sem
+# proxy, LIMITE_IP_DIRETO=1. Sem nenhum dos dois, anônimo não é limitado.
+LIMITE_IP_HEADER = os.getenv("LIMITE_IP_HEADER", "").strip()
+LIMITE_IP_DIRETO = os.getenv("LIMITE_IP_DIRETO", "0") == "1"
+
+BULKHEAD_ESPERA_S = float(os.getenv("BULKHEAD_ESPERA_S", "2"))
+BULKHEADS = {
+    "exportacao": threading.BoundedSemaphore(int(os.getenv("BULKHEAD_EXPORTACAO", "2"))),
+    "hash": threading.BoundedSemaphore(int(os.getenv("BULKHEAD_HASH", str(os.cpu_count() or 2)))),
+}
+
+LIMITE_CUSTOS_PADRAO = {
+    # PBKDF2 (e e-mail no /forgot): por IP, já que aqui quase nunca tem sessão
+    ("POST", "/login"): 5,
+    ("POST", "/forgot"): 5,
+    ("POST", "/reset"): 5,
+    ("POST", "/change-password"): 5,
+    ("GET", "/faturas/exportar"): 10,
+    ("GET", "/historico/exportar"): 10,
+    ("GET", "/historico_pagamentos/exportar"): 10,
+    ("POST", "/exportacoes"): 5,
+    ("GET", "/dashboard/resumo"): 2,
+    ("GET", "/dashboard/serie"): 2,
+    ("GET", "/dashboard/aging"): 2,
+    ("GET", "/busca"): 1,
+    ("GET", "/faturas"): 1,
+    ("GET", "/historico"): 1,
+    ("GET", "/historico_pagamentos"): 1,
+}
+
+def _carregar_custos() -> dict:
+    custos = dict(LIMITE_CUSTOS_PADRAO)
+    for item in os.getenv("LIMITE_CUSTOS", "").split(","):
+        if not item.strip():
+            continue
+        try:
+            rota, custo = item.rsplit("=", 1)
+            metodo, caminho = rota.split(None, 1)
+            custos[(metodo.upper(), caminho.strip())] = float(custo)
+        except ValueError:
+            print("WARN LIMITE_CUSTOS: item ignorado:", item)
+    return custos
+
+LIMITE_CUSTOS = _carregar_custos()
+
+class BaldesLocais:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._baldes = {}  # chave -> (fichas, instante monotônico)
+
+    def gastar(self, chave: str, custo: float) -> float:
+        """0 = liberado; senão segundos até juntar as fichas."""
+        agora = time.monotonic()
+        with self._lock:
+            fichas, t = self._baldes.get(chave, (LIMITE_RAJADA, agora))
+            fichas = min(LIMITE_RAJADA, fichas + (agora - t) * LIMITE_TAXA)
+            espera = 0.0
+            if fichas >= custo:
+                fichas -= custo
+            else:
+                espera = (custo - fichas) / LIMITE_TAXA
+            self._baldes[chave] = (fichas, agora)
+            if len(self._baldes) > LIMITE_MAX_CHAVES:
+                self._podar(agora)
+            return espera
+
+    def _podar(self, agora: float):
+        # balde que já encheu de novo é igual a balde novo: pode sair
+        cheios = [k for k, (f, t) in self._baldes.items() if f + (agora - t) * LIMITE_TAXA >= LIMITE_RAJADA]
+        for k in cheios:
+            del self._baldes[k]
+
+    def limpar(self):
+        with self._lock:
+            self._baldes.clear()
+
+_baldes_locais = BaldesLocais()
+_limite_aviso_em = 0.0
+
+def _gastar_postgres(chave: str, custo: float) -> float:
+    params = {"k": chave, "c": custo, "cap": LIMITE_RAJADA, "taxa": LIMITE_TAXA}
+    with get_engine().begin() as conn:
+        # o ON CONFLICT trava a linha: processos concorrentes não gastam a mesma ficha
+        liberado = conn.execute(text("""
+            INSERT INTO rate_limits AS r (chave, fichas, atualizado_em)
+            VALUES (:k, :cap - :c, now())
+            ON CONFLICT (chave) DO UPDATE
+               SET fichas = LEAST(:cap, r.fichas + EXTRACT(EPOCH FROM now() - r.atualizado_em) * :taxa) - :c,
+                   atualizado_em = now()
+             WHERE LEAST(:cap, r.fichas + EXTRACT(EPOCH FROM now() - r.atualizado_em) * :taxa) >= :c
+            RETURNING 1
+        """), params).first()
+        if liberado:
+            return 0.0
+        fichas = conn.execute(text("""
+            SELECT LEAST(:cap, fichas + EXTRACT(EPOCH FROM now() - atualizado_em) * :taxa)
+              FROM rate_limits WHERE chave = :k
+        """), params).scalar()
+    return max(0.0, (custo - float(fichas or 0)) / LIMITE_TAXA)
+
+def gastar_fichas(chave: str, custo: float) -> float:
+    global _limite_aviso_em
+    custo = min(custo, LIMITE_RAJADA)  # senão a rota nunca passaria
+    if LIMITE_BACKEND == "postgres":
+        try:
+            return _gastar_postgres(chave, custo)
+        except Exception as e:
+            if time.monotonic() - _limite_aviso_em > 60:
+                _limite_aviso_em = time.monotonic()
+                print("WARN limite de taxa no Postgres (usando balde local):", repr(e))
+    return _baldes_locais.gastar(chave, custo)
+
+def ip_cliente(request: Request) -> Optional[str]:
+    """None = não dá pra saber o IP real do cliente (ver LIMITE_IP_*)."""
+    if LIMITE_IP_HEADER:
+        valor = request.headers.get(LIMITE_IP_HEADER)
+        if valor:
+            # X-Forwarded-For: o último endereço é o que o nosso proxy acrescentou
+            return valor.split(",")[-1].strip() or None
+        return None
+    if LIMITE_IP_DIRETO and request.client:
+        return request.client.host
+    return None
+
+def resposta_429(detalhe: str, espera_s: float) -> Response:
+    resp = json_response({"detail": detalhe}, status_code=429)
+    resp.headers["Retry-After"] = str(max(1, math.ceil(espera_s)))
+    return resp
+
+@app.middleware("http")
+async def limitar_taxa(request: Request, call_next):
+    if not LIMITE_ATIVO:
+        return await call_next(request)
+    rota = rota_template(request)
+    custo = LIMITE_CUSTOS.get((request.method, rota))
+    if not custo:
+        return await call_next(request)
+
+    uid = (sessao_atual(request) or {}).get("uid")
+    if uid:
+        chave = f"u:{int(uid)}"
+    else:
+        ip = ip_cliente(request)
+        if not ip:
+            return await call_next(request)
+        chave = f"ip:{ip}"
+    if LIMITE_BACKEND == "postgres":
+        espera = await run_in_threadpool(gastar_fichas, chave, custo)
+    else:
+        espera = gastar_fichas(chave, custo)
+
+    if espera > 0:
+        LIMITE_REJEICOES.labels("taxa", rota).inc()
+        return resposta_429("Muitas requisições. Tente novamente em alguns segundos.", espera)
+    return await call_next(request)
+
+# ordem: o último registrado fica por fora. Métricas e CORS por cima do
+# limite de taxa e da idempotência: o 429 entra nas métricas e sai com os
+# headers de CORS (senão o navegador vê erro de rede, sem Retry-After)
+app.middleware("http")(metricas_http)
 
 # ✅ NOVO (opcional): CORS por ENV
 # Ex: CORS_ORIGINS=https://seu-front.com,https://outro.com
@@ -706,8 +2119,219 @@ if cors_origins:
         allow_headers=["*"],
     )
 
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+@contextmanager
+def bulkhead(nome: str):
+    sem = BULKHEADS[nome]
+    if not sem.acquire(timeout=BULKHEAD_ESPERA_S):
+        LIMITE_REJEICOES.labels("bulkhead", nome).inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Servidor ocupado. Tente novamente em alguns segundos.",
+            headers={"Retry-After": "5"},
+        )
+    try:
+        yield
+    finally:
+        sem.release()
+
+# dependência de rota: a vaga fica presa até a resposta sair
+def vaga_exportacao():
+    with bulkhead("exportacao"):
+        yield
+
+# =========================
+# ✅ COMPRESSÃO (gzip / brotli)
+# =========================
+# Comprime JSON/HTML/CSV com Content-Length conhecido acima do limite.
+# Respostas em streaming (download de anexo) e acima de COMPRESS_MAX_BYTES
+# passam direto. Corpo acima de COMPRESS_THREAD_BYTES é comprimido numa
+# thread, pra não travar o event loop (e as outras requisições) do worker.
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_MAX_BYTES = int(os.getenv("COMPRESS_MAX_BYTES", str(1024 * 1024)))
+COMPRESS_THREAD_BYTES = int(os.getenv("COMPRESS_THREAD_BYTES", str(64 * 1024)))
+COMPRESS_TIPOS = (
+    "application/json",
+    "text/html",
+    "text/csv",
+    "text/plain",
+    "text/css",
+    "application/javascript",
+    "text/javascript",
+)
+
+def escolher_encoding(accept_encoding: str) -> Optional[str]:
+    aceitos = set()
+    for parte in (accept_encoding or "").lower().split(","):
+        nome, _, params = parte.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        aceitos.add(nome.strip())
+    if brotli is not None and "br" in aceitos:
+        return "br"
+    if "gzip" in aceitos:
+        return "gzip"
+    return None
+
+def comprimir(body: bytes, encoding: str, nivel_alto: bool = False) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if nivel_alto else 4)
+    return gzip.compress(body, compresslevel=9 if nivel_alto else 6)
+
+def tipo_comprimivel(content_type: str) -> bool:
+    return (content_type or "").split(";")[0].strip().lower() in COMPRESS_TIPOS
+
+class CompressaoMiddleware:
+    def __init__(self, app, minimo: int = COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimo = minimo
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = escolher_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        inicio = None
+        partes = []
+
+        async def send_wrapper(message):
+            nonlocal inicio
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                try:
+                    tamanho = int(headers.get("content-length", ""))
+                except ValueError:
+                    tamanho = -1
+                if (
+                    message["status"] not in (204, 304)
+                    and "content-encoding" not in headers
+                    and tipo_comprimivel(headers.get("content-type", ""))
+                    and self.minimo <= tamanho <= COMPRESS_MAX_BYTES
+                ):
+                    inicio = message  # segura o cabeçalho até juntar o corpo
+                    return
+                await send(message)
+                return
+
+            if message["type"] == "http.response.body" and inicio is not None:
+                partes.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+                corpo = b"".join(partes)
+                if len(corpo) > COMPRESS_THREAD_BYTES:
+                    corpo = await run_in_threadpool(comprimir, corpo, encoding)
+                else:
+                    corpo = comprimir(corpo, encoding)
+                headers = MutableHeaders(scope=inicio)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(corpo))
+                headers.add_vary_header("Accept-Encoding")
+                await send(inicio)
+                await send({"type": "http.response.body", "body": corpo, "more_body": False})
+                return
+
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+app.add_middleware(CompressaoMiddleware)
+
+# =========================
+# ✅ ASSETS COM HASH (cache imutável)
+# =========================
+# Sem build: no primeiro uso o manifesto lê STATIC_DIR, calcula o hash de
+# cada arquivo e guarda versões gzip/br prontas. Templates usam
+# {{ asset_url('app.js') }} -> /static/app.<hash>.js, servido com
+# Cache-Control immutable. Nomes sem hash continuam funcionando (no-cache).
+
+CACHE_IMUTAVEL = "public, max-age=31536000, immutable"
+
+_assets_lock = threading.Lock()
+_assets = None
+_assets_assinatura = None
+
+def _nome_com_hash(relativo: str, digest: str) -> str:
+    p = Path(relativo)
+    return str(p.with_name(f"{p.stem}.{digest}{p.suffix}").as_posix())
+
+def _assinatura_static() -> tuple:
+    return tuple(sorted(
+        (str(p), p.stat().st_mtime_ns) for p in Path(STATIC_DIR).rglob("*") if p.is_file()
+    ))
+
+def _montar_manifesto() -> dict:
+    por_nome, por_hash = {}, {}
+    base = Path(STATIC_DIR)
+    for p in sorted(base.rglob("*")):
+        if not p.is_file() or p.suffix in (".gz", ".br"):
+            continue
+        relativo = p.relative_to(base).as_posix()
+        conteudo = p.read_bytes()
+        digest = hashlib.sha256(conteudo).hexdigest()[:12]
+        content_type = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+
+        asset = {
+            "hashed": _nome_com_hash(relativo, digest),
+            "content_type": content_type,
+            "etag": f'"{digest}"',
+            "identity": conteudo,
+        }
+        if tipo_comprimivel(content_type) and len(conteudo) >= COMPRESS_MIN_BYTES:
+            asset["gzip"] = comprimir(conteudo, "gzip", nivel_alto=True)
+            if brotli is not None:
+                asset["br"] = comprimir(conteudo, "br", nivel_alto=True)
+
+        por_nome[relativo] = asset
+        por_hash[asset["hashed"]] = asset
+    return {"por_nome": por_nome, "por_hash": por_hash}
+
+def manifesto_assets() -> dict:
+    global _assets, _assets_assinatura
+    # em DEBUG, editar um arquivo em static/ já gera hash novo
+    assinatura = _assinatura_static() if DEBUG else None
+    if _assets is None or assinatura != _assets_assinatura:
+        with _assets_lock:
+            if _assets is None or assinatura != _assets_assinatura:
+                _assets = _montar_manifesto()
+                _assets_assinatura = assinatura
+    return _assets
+
+def asset_url(nome: str) -> str:
+    asset = manifesto_assets()["por_nome"].get(nome.lstrip("/"))
+    if not asset:
+        return f"/static/{nome.lstrip('/')}"
+    return f"/static/{asset['hashed']}"
+
+class AssetsStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope):
+        # montar o manifesto comprime todos os arquivos: fora do event loop
+        manifesto = await run_in_threadpool(manifesto_assets)
+        asset = manifesto["por_hash"].get(path.replace(os.sep, "/"))
+        if asset is not None:
+            headers = {"Cache-Control": CACHE_IMUTAVEL, "ETag": asset["etag"], "Vary": "Accept-Encoding"}
+            if Headers(scope=scope).get("if-none-match") == asset["etag"]:
+                return Response(status_code=304, headers=headers)
+            encoding = escolher_encoding(Headers(scope=scope).get("accept-encoding", ""))
+            corpo = asset["identity"]
+            if encoding and encoding in asset:
+                corpo = asset[encoding]
+                headers["Content-Encoding"] = encoding
+            return Response(corpo, headers=headers, media_type=asset["content_type"])
+
+        resp = await super().get_response(path, scope)
+        resp.headers.setdefault("Cache-Control", "no-cache")
+        return resp
+
+app.mount("/static", AssetsStaticFiles(directory=STATIC_DIR), name="static")
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
+templates.env.globals["asset_url"] = asset_url
 
 # =========================
 # BOOTSTRAP ADMIN (ENV)
@@ -748,14 +2372,6 @@ def bootstrap_admin(db: Session):
         db.commit()
         print(f"BOOTSTRAP: admin EXISTENTE corrigido/atualizado: {BOOTSTRAP_ADMIN_USER}")
 
-@app.on_event("startup")
-def on_startup():
-    db = SessionLocal()
-    try:
-        bootstrap_admin(db)
-    finally:
-        db.close()
-
 # =========================
 # AUTH ROUTES / PAGES
 # =========================
@@ -827,6 +2443,8 @@ def login_action(
 def logout():
     resp = RedirectResponse(url="/login", status_code=302)
     clear_auth_cookies(resp)
+    # apaga o cache offline (IndexedDB) de faturas do navegador
+    resp.headers["Clear-Site-Data"] = '"storage"'
     return resp
 
 @app.get("/change-password", response_class=HTMLResponse)
@@ -1019,60 +2637,66 @@ def reset_action(
 def redirect_to_login(next_path: str) -> RedirectResponse:
     return RedirectResponse(url=f"/login?next={next_path}", status_code=302)
 
-@app.get("/", response_class=HTMLResponse)
-def home(request: Request, db: Session = Depends(get_db)):
-    user = get_current_user(request, db)
-    if not user:
-        return redirect_to_login("/")
-
-    if needs_password_change(user):
-        return RedirectResponse(url="/change-password", status_code=302)
+# dependências das páginas: sem permissão viram redirect (não 401/403)
+class Redirecionar(Exception):
+    def __init__(self, url: str):
+        self.url = url
 
-    return templates.TemplateResponse(TPL_INDEX, {"request": request})
+@app.exception_handler(Redirecionar)
+async def tratar_redirecionar(request: Request, exc: Redirecionar):
+    return RedirectResponse(url=exc.url, status_code=302)
 
-@app.get("/admin", response_class=HTMLResponse)
-def admin_page(request: Request, db: Session = Depends(get_db)):
+def usuario_pagina(request: Request, db: Session = Depends(get_db)) -> UserDB:
     user = get_current_user(request, db)
     if not user:
-        return redirect_to_login("/admin")
+        # POST de formulário volta pra página da seção (ex: /admin/user/create -> /admin)
+        volta = request.url.path if request.method == "GET" else "/" + request.url.path.strip("/").split("/")[0]
+        raise Redirecionar(f"/login?next={volta}")
     if needs_password_change(user):
-        return RedirectResponse(url="/change-password", status_code=302)
+        raise Redirecionar("/change-password")
+    return user
+
+def admin_pagina(user: UserDB = Depends(usuario_pagina)) -> UserDB:
     if (user.role or "").lower() != "admin":
-        return RedirectResponse(url="/", status_code=302)
+        raise Redirecionar("/")
+    return user
+
+def admin_form(request: Request, csrf: Optional[str] = Form(None), admin: UserDB = Depends(admin_pagina)) -> UserDB:
+    if not validate_csrf(request, csrf):
+        raise Redirecionar("/admin")
+    return admin
+
+@app.get("/", response_class=HTMLResponse, dependencies=[Depends(usuario_pagina)])
+def home(request: Request):
+    return templates.TemplateResponse(TPL_INDEX, {"request": request})
 
+def pagina_admin(request: Request, user: UserDB, error: Optional[str] = None, status_code: int = 200):
     csrf_cookie = request.cookies.get(CSRF_COOKIE)
     csrf = csrf_cookie or make_csrf_token()
 
-    users = db.query(UserDB).order_by(UserDB.username.asc()).all()
-    trs = db.query(TransportadoraDB).order_by(TransportadoraDB.nome.asc()).all()
-    user_map = {u.id: u.username for u in users}
-
+    # usuários e transportadoras vêm paginados por /admin/usuarios e /admin/transportadoras (admin.js)
     resp = templates.TemplateResponse(
         TPL_ADMIN,
-        {"request": request, "csrf": csrf, "admin": user, "users": users, "trs": trs, "user_map": user_map},
+        {"request": request, "csrf": csrf, "admin": user, "error": error},
+        status_code=status_code,
     )
     if not csrf_cookie:
         resp.set_cookie(CSRF_COOKIE, csrf, max_age=CSRF_MAX_AGE_SECONDS, httponly=False, secure=COOKIE_SECURE, samesite="lax", path="/")
     return resp
 
-@app.post("/admin/user/create", response_class=HTMLResponse)
+@app.get("/admin", response_class=HTMLResponse)
+def admin_page(request: Request, user: UserDB = Depends(admin_pagina)):
+    return pagina_admin(request, user)
+
+@app.post("/admin/user/create", response_class=HTMLResponse, dependencies=[Depends(admin_form)])
 def admin_create_user(
     request: Request,
     username: str = Form(...),
     email: str = Form(""),
     role: str = Form("user"),
     temp_password: str = Form(...),
-    csrf: Optional[str] = Form(None),
     db: Session = Depends(get_db),
 ):
-    admin = get_current_user(request, db)
-    if not admin:
-        return redirect_to_login("/admin")
-    if (admin.role or "").lower() != "admin":
-        return RedirectResponse(url="/", status_code=302)
-    if not validate_csrf(request, csrf):
-        return RedirectResponse(url="/admin", status_code=302)
-
     username = username.strip()
     if not username:
         return RedirectResponse(url="/admin", status_code=302)
@@ -1097,21 +2721,12 @@ def admin_create_user(
     db.commit()
     return RedirectResponse(url="/admin", status_code=302)
 
-@app.post("/admin/transportadora/create", response_class=HTMLResponse)
+@app.post("/admin/transportadora/create", response_class=HTMLResponse, dependencies=[Depends(admin_form)])
 def admin_create_transportadora(
     request: Request,
     nome: str = Form(...),
-    csrf: Optional[str] = Form(None),
     db: Session = Depends(get_db),
 ):
-    admin = get_current_user(request, db)
-    if not admin:
-        return redirect_to_login("/admin")
-    if (admin.role or "").lower() != "admin":
-        return RedirectResponse(url="/", status_code=302)
-    if not validate_csrf(request, csrf):
-        return RedirectResponse(url="/admin", status_code=302)
-
     nome = nome.strip()
     if not nome:
         return RedirectResponse(url="/admin", status_code=302)
@@ -1119,6 +2734,7 @@ def admin_create_transportadora(
     exists = db.query(TransportadoraDB).filter(TransportadoraDB.nome.ilike(nome)).first()
     if not exists:
         db.add(TransportadoraDB(nome=nome))
+        notificar_invalidacao(db, "responsaveis")
         db.commit()
 
     return RedirectResponse(url="/admin", status_code=302)
@@ -1128,32 +2744,39 @@ def admin_assign_transportadora(
     request: Request,
     transportadora_id: int = Form(...),
     responsavel_user_id: str = Form(""),
-    csrf: Optional[str] = Form(None),
+    responsavel_username: Optional[str] = Form(None),  # admin.js manda o username (sem lista de ids)
+    admin: UserDB = Depends(admin_form),
     db: Session = Depends(get_db),
 ):
-    admin = get_current_user(request, db)
-    if not admin:
-        return redirect_to_login("/admin")
-    if (admin.role or "").lower() != "admin":
-        return RedirectResponse(url="/", status_code=302)
-    if not validate_csrf(request, csrf):
-        return RedirectResponse(url="/admin", status_code=302)
-
     tr = db.query(TransportadoraDB).filter(TransportadoraDB.id == transportadora_id).first()
     if not tr:
         return RedirectResponse(url="/admin", status_code=302)
 
-    if responsavel_user_id.strip() == "":
-        tr.responsavel_user_id = None
-    else:
+    # o datalist é só sugestão: nome digitado errado volta como erro, sem
+    # mexer nas faturas nem avisar os workers
+    u = None
+    if responsavel_username is not None:
+        nome = responsavel_username.strip()
+        if nome:
+            u = db.query(UserDB).filter(UserDB.username == nome).first()
+            if not u:
+                return pagina_admin(request, admin, f"Usuário '{nome}' não encontrado.", status_code=400)
+    elif responsavel_user_id.strip():
         try:
-            uid = int(responsavel_user_id)
-            u = db.query(UserDB).filter(UserDB.id == uid).first()
-            if u:
-                tr.responsavel_user_id = u.id
-        except Exception:
-            pass
-
+            u = db.query(UserDB).filter(UserDB.id == int(responsavel_user_id)).first()
+        except ValueError:
+            u = None
+        if not u:
+            return pagina_admin(request, admin, "Usuário não encontrado.", status_code=400)
+    tr.responsavel_user_id = u.id if u else None
+
+    # o responsável sai no JSON de cada fatura: marca como alteradas pro
+    # cache do app.js buscar de novo (mesma regra de resolver_responsavel)
+    db.execute(
+        text("UPDATE faturas SET atualizado_em = now() WHERE lower(btrim(split_part(transportadora, '-', 1))) = lower(:nome)"),
+        {"nome": tr.nome.strip()},
+    )
+    notificar_invalidacao(db, "responsaveis")
     db.commit()
     return RedirectResponse(url="/admin", status_code=302)
 
@@ -1163,40 +2786,287 @@ def admin_assign_transportadora(
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "static_dir": STATIC_DIR, "templates_dir": TEMPLATES_DIR, "debug": DEBUG}
+    return {
+        "status": "ok",
+        "static_dir": STATIC_DIR,
+        "templates_dir": TEMPLATES_DIR,
+        "debug": DEBUG,
+        "import_ms": round(IMPORT_MS, 1),
+    }
 
 # =========================
-# API AUTH
+# MÉTRICAS
 # =========================
 
-def api_require_auth(request: Request, db: Session) -> UserDB:
-    u = get_current_user(request, db)
+@app.get("/metrics")
+def metrics(request: Request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("authorization", "")
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            raise HTTPException(status_code=401, detail="Não autorizado")
+
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        data = generate_latest(registry)
+    else:
+        data = generate_latest()
+    return Response(data, media_type=CONTENT_TYPE_LATEST)
+
+# =========================
+# API AUTH
+# =========================
+
+def api_require_auth(request: Request, db: Session) -> UserDB:
+    u = get_current_user(request, db)
     if not u:
         raise HTTPException(status_code=401, detail="Não autenticado")
     if needs_password_change(u):
         raise HTTPException(status_code=403, detail="Troca de senha necessária")
     return u
 
+# dependências declarativas: dependencies=[Depends(usuario_api)] na rota.
+# Autentica sempre no primário: usuário rebaixado/removido ou com troca de
+# senha pendente não pode passar por causa de atraso da réplica.
+def usuario_api(request: Request, db: Session = Depends(get_db)) -> UserDB:
+    return api_require_auth(request, db)
+
+def admin_api(user: UserDB = Depends(usuario_api)) -> UserDB:
+    if (user.role or "").lower() != "admin":
+        raise HTTPException(status_code=403, detail="Apenas administradores")
+    return user
+
+def exigir_csrf(request: Request):
+    # app.js manda X-CSRF-Token em toda escrita; sem o header, recusa
+    if not validate_csrf(request, request.headers.get("X-CSRF-Token")):
+        raise HTTPException(status_code=403, detail="CSRF inválido")
+
 @app.get("/me")
-def me(request: Request, db: Session = Depends(get_db)):
-    u = api_require_auth(request, db)
+def me(u: UserDB = Depends(usuario_api)):
     return {"id": u.id, "username": u.username, "email": u.email, "role": u.role}
 
 # ✅ NOVO: lista transportadoras (pra sidebar / filtros)
-@app.get("/transportadoras", response_model=List[TransportadoraOut])
-def listar_transportadoras_api(request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-    trs = db.query(TransportadoraDB).order_by(TransportadoraDB.nome.asc()).all()
-    return [transportadora_to_out(db, tr) for tr in trs]
+@app.get("/transportadoras", response_model=List[TransportadoraOut], dependencies=[Depends(usuario_api)])
+def listar_transportadoras_api(request: Request, db: Session = Depends(get_read_db)):
+    rows = (
+        db.query(TransportadoraDB.id, TransportadoraDB.nome, UserDB.username)
+        .outerjoin(UserDB, UserDB.id == TransportadoraDB.responsavel_user_id)
+        .order_by(TransportadoraDB.nome.asc())
+        .all()
+    )
+    return json_response([{"id": r.id, "nome": r.nome, "responsavel": r.username} for r in rows])
+
+# =========================
+# ADMIN (API JSON paginada)
+# =========================
+# Busca por prefixo (sem diferenciar maiúsculas) + paginação keyset:
+# ?depois=<último username/nome da página anterior>.
+# Resposta: {"itens": [...], "proximo": <cursor ou null>}
+
+def _like_prefixo(q: str) -> str:
+    q = q.strip().lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return q + "%"
+
+@app.get("/admin/usuarios", dependencies=[Depends(admin_api)])
+def admin_listar_usuarios(
+    db: Session = Depends(get_read_db),
+    q: Optional[str] = Query(None, max_length=100),
+    depois: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+):
+    query = db.query(UserDB.id, UserDB.username, UserDB.email, UserDB.role, UserDB.last_login_at)
+    if q and q.strip():
+        padrao = _like_prefixo(q)
+        query = query.filter(or_(
+            func.lower(UserDB.username).like(padrao, escape="\\"),
+            func.lower(UserDB.email).like(padrao, escape="\\"),
+        ))
+    if depois:
+        query = query.filter(UserDB.username > depois)
+
+    rows = query.order_by(UserDB.username.asc()).limit(limit + 1).all()
+    itens = [
+        {"id": r.id, "username": r.username, "email": r.email, "role": r.role, "last_login_at": r.last_login_at}
+        for r in rows[:limit]
+    ]
+    proximo = rows[limit - 1].username if len(rows) > limit else None
+    return json_response({"itens": itens, "proximo": proximo})
+
+@app.get("/admin/transportadoras", dependencies=[Depends(admin_api)])
+def admin_listar_transportadoras(
+    db: Session = Depends(get_read_db),
+    q: Optional[str] = Query(None, max_length=100),
+    depois: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+):
+    query = (
+        db.query(TransportadoraDB.id, TransportadoraDB.nome, TransportadoraDB.responsavel_user_id, UserDB.username)
+        .outerjoin(UserDB, UserDB.id == TransportadoraDB.responsavel_user_id)
+    )
+    if q and q.strip():
+        query = query.filter(func.lower(TransportadoraDB.nome).like(_like_prefixo(q), escape="\\"))
+    if depois:
+        query = query.filter(TransportadoraDB.nome > depois)
+
+    rows = query.order_by(TransportadoraDB.nome.asc()).limit(limit + 1).all()
+    itens = [
+        {"id": r.id, "nome": r.nome, "responsavel_user_id": r.responsavel_user_id, "responsavel": r.username}
+        for r in rows[:limit]
+    ]
+    proximo = rows[limit - 1].nome if len(rows) > limit else None
+    return json_response({"itens": itens, "proximo": proximo})
+
+# =========================
+# ✅ AUDITORIA DE FATURAS (write-behind)
+# =========================
+# Criar/editar/apagar fatura registra quem mudou o quê: {campo: [antes,
+# depois]}, só os campos que mudaram. O registro entra numa fila em memória
+# depois do commit e uma thread grava em lote (um INSERT multi-linha) a cada
+# AUDITORIA_FLUSH_S ou quando junta AUDITORIA_LOTE, então o save não paga
+# INSERT extra. Falha de gravação devolve o lote pra fila; acima de
+# AUDITORIA_MAX_PENDENTES os mais antigos são descartados (com WARN). No
+# shutdown (lifespan / worker CLI) a fila é esvaziada.
+
+AUDITORIA_FLUSH_S = float(os.getenv("AUDITORIA_FLUSH_S", "2"))
+AUDITORIA_LOTE = int(os.getenv("AUDITORIA_LOTE", "500"))
+AUDITORIA_MAX_PENDENTES = int(os.getenv("AUDITORIA_MAX_PENDENTES", "50000"))
+AUDITORIA_CAMPOS = ("transportadora", "numero_fatura", "valor", "data_vencimento", "status", "observacao", "data_pagamento")
+
+_auditoria_lock = threading.Lock()
+_auditoria_pendentes: list = []
+_auditoria_acordar = threading.Event()
+_auditoria_parar = threading.Event()
+_auditoria_thread: Optional[threading.Thread] = None
+_auditoria_pid: Optional[int] = None
+_auditoria_aviso_em = 0.0
+_auditoria_falha_em = 0.0
+_auditoria_descartadas = 0
+
+def _valor_auditoria(v):
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, (date, datetime)):
+        return v.isoformat()
+    return v
+
+def foto_fatura(f: FaturaDB) -> dict:
+    return {c: _valor_auditoria(getattr(f, c)) for c in AUDITORIA_CAMPOS}
+
+def diff_fatura(antes: dict, depois: dict) -> dict:
+    return {c: [antes.get(c), depois.get(c)] for c in AUDITORIA_CAMPOS if antes.get(c) != depois.get(c)}
+
+def autor_auditoria(usuario: Optional[UserDB]) -> Tuple[Optional[int], Optional[str]]:
+    # lido antes do commit: depois dele o objeto expira e cada atributo vira SELECT
+    if usuario is None:
+        return (None, None)
+    return (usuario.id, usuario.username)
+
+def registrar_auditoria(fatura_id: int, acao: str, mudancas: dict, autor: Tuple[Optional[int], Optional[str]] = (None, None)):
+    if not mudancas:
+        return
+    item = {
+        "fatura_id": fatura_id,
+        "acao": acao,
+        "usuario_id": autor[0],
+        "usuario": autor[1],
+        "mudancas": mudancas,
+        "criado_em": agora_br(),
+    }
+    global _auditoria_aviso_em, _auditoria_descartadas
+    with _auditoria_lock:
+        if len(_auditoria_pendentes) >= AUDITORIA_MAX_PENDENTES:
+            del _auditoria_pendentes[0]
+            _auditoria_descartadas += 1
+            # banco fora por muito tempo: um aviso por minuto, não um por save
+            if time.monotonic() - _auditoria_aviso_em > 60:
+                _auditoria_aviso_em = time.monotonic()
+                print(f"WARN auditoria: fila cheia, {_auditoria_descartadas} registro(s) antigo(s) descartado(s)")
+                _auditoria_descartadas = 0
+        _auditoria_pendentes.append(item)
+        cheio = len(_auditoria_pendentes) >= AUDITORIA_LOTE
+    _garantir_gravador_auditoria()
+    if cheio:
+        _auditoria_acordar.set()
+
+def gravar_auditoria() -> int:
+    global _auditoria_pendentes, _auditoria_falha_em
+    with _auditoria_lock:
+        lote, _auditoria_pendentes = _auditoria_pendentes, []
+    if not lote:
+        return 0
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(AuditoriaFaturaDB.__table__.insert(), lote)
+    except Exception as e:
+        if time.monotonic() - _auditoria_falha_em > 60:
+            _auditoria_falha_em = time.monotonic()
+            print(f"WARN auditoria: lote de {len(lote)} não gravado (fica pra próxima):", repr(e))
+        with _auditoria_lock:
+            _auditoria_pendentes = (lote + _auditoria_pendentes)[-AUDITORIA_MAX_PENDENTES:]
+        return 0
+    return len(lote)
+
+def _loop_auditoria():
+    while not _auditoria_parar.is_set():
+        _auditoria_acordar.wait(AUDITORIA_FLUSH_S)
+        _auditoria_acordar.clear()
+        gravar_auditoria()
+
+def _garantir_gravador_auditoria():
+    # thread por processo, criada no primeiro uso (depois de um fork a do pai não existe)
+    global _auditoria_thread, _auditoria_pid
+    if _auditoria_thread is not None and _auditoria_pid == os.getpid() and _auditoria_thread.is_alive():
+        return
+    with _auditoria_lock:
+        if _auditoria_thread is not None and _auditoria_pid == os.getpid() and _auditoria_thread.is_alive():
+            return
+        _auditoria_parar.clear()
+        _auditoria_pid = os.getpid()
+        _auditoria_thread = threading.Thread(target=_loop_auditoria, name="mshop-auditoria", daemon=True)
+        _auditoria_thread.start()
+
+def parar_gravador_auditoria():
+    _auditoria_parar.set()
+    _auditoria_acordar.set()
+    if _auditoria_thread is not None and _auditoria_pid == os.getpid():
+        _auditoria_thread.join(timeout=5)
+    gravar_auditoria()
+
+@app.get("/faturas/{fatura_id}/auditoria", dependencies=[Depends(usuario_api)])
+def auditoria_fatura(
+    fatura_id: int,
+    db: Session = Depends(get_db),
+    limit: int = Query(200, ge=1, le=1000),
+):
+    # o que este processo ainda tem na fila vai antes: quem acabou de salvar já vê
+    gravar_auditoria()
+    rows = (
+        db.query(AuditoriaFaturaDB)
+        .filter(AuditoriaFaturaDB.fatura_id == fatura_id)
+        .order_by(AuditoriaFaturaDB.criado_em.desc(), AuditoriaFaturaDB.id.desc())
+        .limit(limit)
+        .all()
+    )
+    return json_response([
+        {
+            "id": r.id,
+            "fatura_id": r.fatura_id,
+            "acao": r.acao,
+            "usuario": r.usuario,
+            "criado_em": r.criado_em,
+            "mudancas": r.mudancas,
+        }
+        for r in rows
+    ])
 
 # =========================
 # FATURAS (API)
 # =========================
 
-@app.post("/faturas", response_model=FaturaOut)
+@app.post("/faturas", response_model=FaturaOut, dependencies=[Depends(usuario_api), Depends(exigir_csrf)])
 def criar_fatura(fatura: FaturaCreate, request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-
     db_fatura = FaturaDB(
         transportadora=fatura.transportadora,
         numero_fatura=fatura.numero_fatura,
@@ -1213,56 +3083,151 @@ def criar_fatura(fatura: FaturaCreate, request: Request, db: Session = Depends(g
         resp_nome = get_responsavel(db, db_fatura.transportadora)
         registrar_pagamento(db, db_fatura, resp_nome)
 
+    notificar_invalidacao(db, "faturas")
+    autor = autor_auditoria(request.state.usuario)
     db.commit()
     db.refresh(db_fatura)
+    registrar_auditoria(db_fatura.id, "criar", diff_fatura({}, foto_fatura(db_fatura)), autor)
     return fatura_to_out(db, db_fatura)
 
-@app.get("/faturas", response_model=List[FaturaOut])
+# =========================
+# ✅ FILTROS E ORDENAÇÃO DE /faturas
+# =========================
+# status aceita lista separada por vírgula (status=pendente,atrasado) e
+# compara em minúsculas, como o ilike de antes, mas sem wildcard: assim
+# casa com o índice (lower(status), data_vencimento). Datas inválidas
+# continuam sendo ignoradas. de_pagamento/ate_pagamento são dias no fuso BR.
+# O app.js filtra o próprio cache (IndexedDB) e não usa estes parâmetros:
+# eles são pra outros clientes da API e pra quem quer paginar no servidor.
+
+FATURA_ORDENACOES = {
+    "id": (FaturaDB.id,),
+    "vencimento": (FaturaDB.data_vencimento, FaturaDB.id),
+    "valor": (FaturaDB.valor, FaturaDB.id),
+    "transportadora": (func.lower(FaturaDB.transportadora), FaturaDB.data_vencimento, FaturaDB.id),
+    "pagamento": (FaturaDB.data_pagamento, FaturaDB.id),
+    "numero": (FaturaDB.numero_fatura, FaturaDB.id),
+}
+
+def _data_filtro(valor: Optional[str]) -> Optional[date]:
+    if not valor:
+        return None
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def status_filtro(valor: Optional[str]) -> list:
+    if not valor:
+        return []
+    return sorted({s.strip().lower() for s in valor.split(",") if s.strip()})
+
+def filtrar_faturas(
+    query,
+    transportadora: Optional[str] = None,
+    numero_fatura: Optional[str] = None,
+    status: Optional[str] = None,
+    de_vencimento: Optional[str] = None,
+    ate_vencimento: Optional[str] = None,
+    de_pagamento: Optional[str] = None,
+    ate_pagamento: Optional[str] = None,
+):
+    if transportadora:
+        query = query.filter(FaturaDB.transportadora.ilike(f"%{transportadora}%"))
+    if numero_fatura:
+        query = query.filter(FaturaDB.numero_fatura.ilike(f"%{numero_fatura}%"))
+
+    lista_status = status_filtro(status)
+    if len(lista_status) == 1:
+        query = query.filter(func.lower(FaturaDB.status) == lista_status[0])
+    elif lista_status:
+        query = query.filter(func.lower(FaturaDB.status).in_(lista_status))
+
+    d = _data_filtro(de_vencimento)
+    if d:
+        query = query.filter(FaturaDB.data_vencimento >= d)
+    d = _data_filtro(ate_vencimento)
+    if d:
+        query = query.filter(FaturaDB.data_vencimento <= d)
+
+    d = _data_filtro(de_pagamento)
+    if d:
+        query = query.filter(FaturaDB.data_pagamento >= inicio_dia_br(d))
+    d = _data_filtro(ate_pagamento)
+    if d:
+        query = query.filter(FaturaDB.data_pagamento < inicio_dia_br(d + timedelta(days=1)))
+
+    return query
+
+def ordenar_faturas(query, ordenar: Optional[str]):
+    """ordenar=campo (crescente) ou -campo (decrescente); padrão -id."""
+    chave = (ordenar or "-id").strip()
+    desc = chave.startswith("-")
+    colunas = FATURA_ORDENACOES.get(chave.lstrip("-+"))
+    if colunas is None:
+        raise HTTPException(
+            status_code=422,
+            detail="ordenar deve ser um de: " + ", ".join(sorted(FATURA_ORDENACOES)) + " (prefixo - para decrescente)",
+        )
+    if desc:
+        return query.order_by(*[c.desc().nulls_last() for c in colunas])
+    return query.order_by(*[c.asc().nulls_last() for c in colunas])
+
+@app.get("/faturas", response_model=List[FaturaOut], dependencies=[Depends(usuario_api)])
 def listar_faturas(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
+    primario: Session = Depends(get_db),
     transportadora: Optional[str] = Query(None),
     ate_vencimento: Optional[str] = Query(None),
     de_vencimento: Optional[str] = Query(None),
     numero_fatura: Optional[str] = Query(None),
+    status: Optional[str] = Query(None),
+    de_pagamento: Optional[str] = Query(None),
+    ate_pagamento: Optional[str] = Query(None),
+    ordenar: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    offset: int = Query(0, ge=0),
+    format: Optional[str] = Query(None),
 ):
-    api_require_auth(request, db)
-    atualizar_status_automatico(db)
-
-    query = db.query(FaturaDB)
-
-    if transportadora:
-        query = query.filter(FaturaDB.transportadora.ilike(f"%{transportadora}%"))
+    if atualizar_status_automatico(primario):
+        db = primario  # a réplica ainda não viu a virada de status
 
-    if de_vencimento:
-        try:
-            data_de = datetime.strptime(de_vencimento, "%Y-%m-%d").date()
-            query = query.filter(FaturaDB.data_vencimento >= data_de)
-        except ValueError:
-            pass
+    query = filtrar_faturas(
+        db.query(FaturaDB),
+        transportadora=transportadora,
+        numero_fatura=numero_fatura,
+        status=status,
+        de_vencimento=de_vencimento,
+        ate_vencimento=ate_vencimento,
+        de_pagamento=de_pagamento,
+        ate_pagamento=ate_pagamento,
+    )
 
-    if ate_vencimento:
-        try:
-            data_ate = datetime.strptime(ate_vencimento, "%Y-%m-%d").date()
-            query = query.filter(FaturaDB.data_vencimento <= data_ate)
-        except ValueError:
-            pass
+    total = None
+    if limit is not None:
+        # só paginando vale o COUNT extra; sem limit a lista já é o total
+        total = query.with_entities(func.count(FaturaDB.id)).scalar() or 0
 
-    if numero_fatura:
-        query = query.filter(FaturaDB.numero_fatura.ilike(f"%{numero_fatura}%"))
+    q = ordenar_faturas(query.with_entities(*FATURA_COLUNAS), ordenar)
+    if limit is not None:
+        q = q.limit(limit).offset(offset)
 
-    faturas_db = query.order_by(FaturaDB.id.desc()).all()
-    return [fatura_to_out(db, f) for f in faturas_db]
+    mapa = mapa_responsaveis(db)
+    itens = [fatura_para_dict(f, mapa) for f in q.all()]
+    resp = lista_response(request, format, itens, FATURA_CAMPOS_OUT)
+    if total is not None:
+        resp.headers["X-Total-Count"] = str(total)
+    return resp
 
-@app.put("/faturas/{fatura_id}", response_model=FaturaOut)
+@app.put("/faturas/{fatura_id}", response_model=FaturaOut, dependencies=[Depends(usuario_api), Depends(exigir_csrf)])
 def atualizar_fatura(fatura_id: int, dados: FaturaUpdate, request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-
     fatura = db.query(FaturaDB).filter(FaturaDB.id == fatura_id).first()
     if not fatura:
         raise HTTPException(status_code=404, detail="Fatura não encontrada")
 
     status_antigo = (fatura.status or "").lower()
+    antes = foto_fatura(fatura)
 
     data = dados.dict(exclude_unset=True)
     for campo, valor in data.items():
@@ -1278,43 +3243,45 @@ def atualizar_fatura(fatura_id: int, dados: FaturaUpdate, request: Request, db:
         remover_historico_pagamento(db, fatura.id)
         fatura.data_pagamento = None
 
+    notificar_invalidacao(db, "faturas")
+    autor = autor_auditoria(request.state.usuario)
     db.commit()
     db.refresh(fatura)
+    registrar_auditoria(fatura.id, "atualizar", diff_fatura(antes, foto_fatura(fatura)), autor)
     return fatura_to_out(db, fatura)
 
-@app.delete("/faturas/{fatura_id}")
+@app.delete("/faturas/{fatura_id}", dependencies=[Depends(usuario_api), Depends(exigir_csrf)])
 def deletar_fatura(fatura_id: int, request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-
     fatura = db.query(FaturaDB).filter(FaturaDB.id == fatura_id).first()
     if not fatura:
         raise HTTPException(status_code=404, detail="Fatura não encontrada")
 
-    for anexo in list(fatura.anexos or []):
-        try:
-            s3.delete_object(Bucket=R2_BUCKET_NAME, Key=anexo.filename)
-        except ClientError as e:
-            print("ERRO AO APAGAR NO R2:", repr(e))
+    # objetos do R2 saem em background, só se o delete commitar
+    chaves = [a.filename for a in (fatura.anexos or []) if a.filename]
+    if chaves:
+        enfileirar(db, "r2_apagar", {"chaves": chaves})
 
     remover_historico_pagamento(db, fatura.id)
+    antes = foto_fatura(fatura)
 
     db.delete(fatura)
+    notificar_invalidacao(db, "faturas")
+    autor = autor_auditoria(request.state.usuario)
     db.commit()
+    registrar_auditoria(fatura_id, "remover", diff_fatura(antes, {}), autor)
     return {"ok": True}
 
 # =========================
 # ANEXOS
 # =========================
 
-@app.post("/faturas/{fatura_id}/anexos", response_model=List[AnexoOut])
+@app.post("/faturas/{fatura_id}/anexos", response_model=List[AnexoOut], dependencies=[Depends(usuario_api), Depends(exigir_csrf)])
 async def upload_anexos(
     fatura_id: int,
     request: Request,
     files: List[UploadFile] = File(...),
     db: Session = Depends(get_db),
 ):
-    api_require_auth(request, db)
-
     fatura = db.query(FaturaDB).filter(FaturaDB.id == fatura_id).first()
     if not fatura:
         raise HTTPException(status_code=404, detail="Fatura não encontrada")
@@ -1326,7 +3293,7 @@ async def upload_anexos(
 
         try:
             content = await file.read()
-            s3.put_object(
+            r2_call("put_object",
                 Bucket=R2_BUCKET_NAME,
                 Key=key,
                 Body=content,
@@ -1359,25 +3326,21 @@ async def upload_anexos(
     db.commit()
     return anexos_criados
 
-@app.get("/faturas/{fatura_id}/anexos", response_model=List[AnexoOut])
-def listar_anexos(fatura_id: int, request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-
+@app.get("/faturas/{fatura_id}/anexos", response_model=List[AnexoOut], dependencies=[Depends(usuario_api)])
+def listar_anexos(fatura_id: int, request: Request, db: Session = Depends(get_read_db)):
     fatura = db.query(FaturaDB).filter(FaturaDB.id == fatura_id).first()
     if not fatura:
         raise HTTPException(status_code=404, detail="Fatura não encontrada")
     return fatura.anexos
 
-@app.get("/anexos/{anexo_id}")
+@app.get("/anexos/{anexo_id}", dependencies=[Depends(usuario_api)])
 def baixar_anexo(anexo_id: int, request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-
     anexo = db.query(AnexoDB).filter(AnexoDB.id == anexo_id).first()
     if not anexo:
         raise HTTPException(status_code=404, detail="Anexo não encontrado")
 
     try:
-        obj = s3.get_object(Bucket=R2_BUCKET_NAME, Key=anexo.filename)
+        obj = r2_call("get_object", Bucket=R2_BUCKET_NAME, Key=anexo.filename)
         body = obj["Body"]
         content_type = obj.get("ContentType") or anexo.content_type or "application/octet-stream"
     except ClientError as e:
@@ -1387,18 +3350,14 @@ def baixar_anexo(anexo_id: int, request: Request, db: Session = Depends(get_db))
     headers = {"Content-Disposition": f'attachment; filename="{anexo.original_name}"'}
     return StreamingResponse(body, media_type=content_type, headers=headers)
 
-@app.delete("/anexos/{anexo_id}")
+@app.delete("/anexos/{anexo_id}", dependencies=[Depends(usuario_api), Depends(exigir_csrf)])
 def deletar_anexo(anexo_id: int, request: Request, db: Session = Depends(get_db)):
-    api_require_auth(request, db)
-
     anexo = db.query(AnexoDB).filter(AnexoDB.id == anexo_id).first()
     if not anexo:
         raise HTTPException(status_code=404, detail="Anexo não encontrado")
 
-    try:
-        s3.delete_object(Bucket=R2_BUCKET_NAME, Key=anexo.filename)
-    except ClientError as e:
-        print("ERRO AO APAGAR NO R2:", repr(e))
+    if anexo.filename:
+        enfileirar(db, "r2_apagar", {"chaves": [anexo.filename]})
 
     db.delete(anexo)
     db.commit()
@@ -1408,20 +3367,32 @@ def deletar_anexo(anexo_id: int, request: Request, db: Session = Depends(get_db)
 # DASHBOARD
 # =========================
 
-@app.get("/dashboard/resumo")
+@app.get("/dashboard/resumo", dependencies=[Depends(usuario_api)])
 def resumo_dashboard(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
+    primario: Session = Depends(get_db),
     transportadora: Optional[str] = Query(None),
     ate_vencimento: Optional[str] = Query(None),
     de_vencimento: Optional[str] = Query(None),
 ):
-    api_require_auth(request, db)
-    atualizar_status_automatico(db)
-
-    hoje = hoje_local_br()
-    corte = quarta_da_semana_atual(hoje)
+    if atualizar_status_automatico(primario):
+        db = primario  # a réplica ainda não viu a virada de status
+
+    corte = quarta_da_semana_atual(hoje_local_br())
+    chave = "|".join([transportadora or "", de_vencimento or "", ate_vencimento or "", corte.isoformat()])
+    return CACHE_DASHBOARD.obter(
+        chave,
+        lambda: _calcular_resumo(db, corte, transportadora, de_vencimento, ate_vencimento),
+    )
 
+def _calcular_resumo(
+    db: Session,
+    corte: date,
+    transportadora: Optional[str],
+    de_vencimento: Optional[str],
+    ate_vencimento: Optional[str],
+) -> dict:
     query_base = db.query(FaturaDB)
 
     if transportadora:
@@ -1495,21 +3466,334 @@ def resumo_dashboard(
         "qtd_pago": int(qtd_pago),
     }
 
+# =========================
+# HISTÓRICO: FILTRO DE PERÍODO
+# =========================
+# de/ate são dias no fuso BR; vira faixa meio-aberta em pago_em
+# ([de 00:00, ate+1 00:00)) pra o Postgres podar as partições.
+
+def inicio_dia_br(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day, tzinfo=BR_TZ)
+
+def filtrar_periodo_pagamento(q, de: Optional[str], ate: Optional[str]):
+    if de:
+        try:
+            d1 = datetime.strptime(de, "%Y-%m-%d").date()
+            q = q.filter(HistoricoPagamentoDB.pago_em >= inicio_dia_br(d1))
+        except ValueError:
+            pass
+
+    if ate:
+        try:
+            d2 = datetime.strptime(ate, "%Y-%m-%d").date()
+            q = q.filter(HistoricoPagamentoDB.pago_em < inicio_dia_br(d2 + timedelta(days=1)))
+        except ValueError:
+            pass
+
+    return q
+
+# =========================
+# ✅ DASHBOARD: SÉRIE TEMPORAL
+# =========================
+# /dashboard/serie?bucket=day|week|month: pago por período (histórico,
+# pago_em no fuso BR) e a vencer por período (faturas não pagas, por
+# data_vencimento), numa consulta só. Os arrays vêm alinhados com
+# "buckets" (períodos sem movimento aparecem com 0). agrupar=transportadora
+# ou agrupar=responsavel devolve uma série por grupo; no histórico vale o
+# responsável gravado no pagamento, nas faturas o responsável atual.
+
+SERIE_BUCKETS = {"day": 1, "week": 7, "month": 31}
+SERIE_JANELA_PADRAO_DIAS = {"day": 30, "week": 26 * 7, "month": 365}
+SERIE_MAX_BUCKETS = int(os.getenv("SERIE_MAX_BUCKETS", "400"))
+
+def _inicio_bucket(d: date, bucket: str) -> date:
+    if bucket == "week":
+        return d - timedelta(days=d.weekday())  # segunda, igual ao date_trunc('week')
+    if bucket == "month":
+        return date(d.year, d.month, 1)
+    return d
+
+def _proximo_bucket(d: date, bucket: str) -> date:
+    if bucket == "month":
+        return _somar_meses(d, 1)
+    return d + timedelta(days=SERIE_BUCKETS[bucket])
+
+def _data_param(valor: Optional[str], padrao: date) -> date:
+    if not valor:
+        return padrao
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"data inválida: {valor} (use AAAA-MM-DD)")
+
+@app.get("/dashboard/serie", dependencies=[Depends(usuario_api)])
+def serie_dashboard(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    bucket: str = Query("month"),
+    de: Optional[str] = Query(None),
+    ate: Optional[str] = Query(None),
+    transportadora: Optional[str] = Query(None),
+    agrupar: Optional[str] = Query(None),
+):
+    if bucket not in SERIE_BUCKETS:
+        raise HTTPException(status_code=422, detail="bucket deve ser day, week ou month")
+    if agrupar not in (None, "", "transportadora", "responsavel"):
+        raise HTTPException(status_code=422, detail="agrupar deve ser transportadora ou responsavel")
+    agrupar = agrupar or None
+
+    hoje = hoje_local_br()
+    janela = timedelta(days=SERIE_JANELA_PADRAO_DIAS[bucket])
+    d_de = _data_param(de, hoje - janela)
+    d_ate = _data_param(ate, hoje + janela)
+    if d_ate < d_de:
+        raise HTTPException(status_code=422, detail="ate deve ser maior ou igual a de")
+
+    buckets = []
+    b = _inicio_bucket(d_de, bucket)
+    while b <= d_ate:
+        buckets.append(b)
+        if len(buckets) > SERIE_MAX_BUCKETS:
+            raise HTTPException(status_code=422, detail=f"período longo demais para bucket={bucket} (máx. {SERIE_MAX_BUCKETS} pontos)")
+        b = _proximo_bucket(b, bucket)
+
+    chave = "serie|" + "|".join([bucket, d_de.isoformat(), d_ate.isoformat(), transportadora or "", agrupar or ""])
+    return CACHE_DASHBOARD.obter(
+        chave,
+        lambda: _calcular_serie(db, bucket, buckets, d_de, d_ate, transportadora, agrupar),
+    )
+
+def _calcular_serie(
+    db: Session,
+    bucket: str,
+    buckets: List[date],
+    d_de: date,
+    d_ate: date,
+    transportadora: Optional[str],
+    agrupar: Optional[str],
+) -> dict:
+    grupo_hist = {"transportadora": "transportadora", "responsavel": "responsavel"}.get(agrupar, "NULL")
+    grupo_fat = "transportadora" if agrupar else "NULL"
+    filtro_hist = "AND transportadora ILIKE :transp" if transportadora else ""
+    filtro_fat = "AND transportadora ILIKE :transp" if transportadora else ""
+
+    # bucket vem de SERIE_BUCKETS (validado), não do usuário direto
+    linhas = db.execute(
+        text(f"""
+            SELECT 'pago' AS serie,
+                   date_trunc('{bucket}', timezone(:tz, pago_em))::date AS b,
+                   {grupo_hist} AS grupo,
+                   SUM(valor) AS total, COUNT(*) AS qtd
+              FROM historico_pagamentos
+             WHERE pago_em >= :ini AND pago_em < :fim {filtro_hist}
+             GROUP BY 1, 2, 3
+            UNION ALL
+            SELECT 'a_vencer',
+                   date_trunc('{bucket}', data_vencimento::timestamp)::date,
+                   {grupo_fat},
+                   SUM(valor), COUNT(*)
+              FROM faturas
+             WHERE lower(status) IN ('pendente', 'atrasado')
+               AND data_vencimento >= :de AND data_vencimento <= :ate {filtro_fat}
+             GROUP BY 1, 2, 3
+        """),
+        {
+            "tz": BR_TZ.key,
+            "ini": inicio_dia_br(d_de),
+            "fim": inicio_dia_br(d_ate + timedelta(days=1)),
+            "de": d_de,
+            "ate": d_ate,
+            "transp": f"%{transportadora}%",
+        },
+    ).all()
+
+    mapa = mapa_responsaveis(db) if agrupar == "responsavel" else None
+    pos = {b: i for i, b in enumerate(buckets)}
+    n = len(buckets)
+    series: dict = {}
+
+    for serie, b, grupo, total, qtd in linhas:
+        if serie == "a_vencer" and mapa is not None:
+            grupo = resolver_responsavel(mapa, grupo)
+        i = pos.get(b)
+        if i is None:
+            continue
+        s = series.get(grupo)
+        if s is None:
+            s = series[grupo] = {"grupo": grupo, "pago": [0.0] * n, "qtd_pago": [0] * n, "a_vencer": [0.0] * n, "qtd_a_vencer": [0] * n}
+        s[serie][i] = round(s[serie][i] + float(total or 0), 2)
+        s["qtd_" + serie][i] += int(qtd or 0)
+
+    if not series:
+        series[None] = {"grupo": None, "pago": [0.0] * n, "qtd_pago": [0] * n, "a_vencer": [0.0] * n, "qtd_a_vencer": [0] * n}
+
+    return {
+        "bucket": bucket,
+        "de": d_de.isoformat(),
+        "ate": d_ate.isoformat(),
+        "agrupar": agrupar,
+        "buckets": [b.isoformat() for b in buckets],
+        "series": sorted(series.values(), key=lambda s: (s["grupo"] is None, (s["grupo"] or "").lower())),
+    }
+
+# =========================
+# ✅ DASHBOARD: AGING (atraso por faixa)
+# =========================
+# Vencido = mesma regra da virada automática: status atrasado, ou pendente
+# com vencimento até a quarta da semana (quarta_da_semana_atual). Os dias
+# de atraso contam a partir de hoje; o que vence entre hoje e a quarta já
+# é cobrado como atrasado e cai na faixa "0".
+
+AGING_FAIXAS = ("0", "1-7", "8-30", "31-60", "60+")
+
+@app.get("/dashboard/aging", dependencies=[Depends(usuario_api)])
+def aging_dashboard(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    transportadora: Optional[str] = Query(None),
+):
+    hoje = hoje_local_br()
+    corte = quarta_da_semana_atual(hoje)
+    chave = "aging|" + "|".join([transportadora or "", hoje.isoformat()])
+    return CACHE_DASHBOARD.obter(chave, lambda: _calcular_aging(db, hoje, corte, transportadora))
+
+def _calcular_aging(db: Session, hoje: date, corte: date, transportadora: Optional[str]) -> dict:
+    filtro = "AND transportadora ILIKE :transp" if transportadora else ""
+    linhas = db.execute(
+        text(f"""
+            SELECT transportadora,
+                   CASE
+                       WHEN :hoje - data_vencimento <= 0 THEN 0
+                       WHEN :hoje - data_vencimento <= 7 THEN 1
+                       WHEN :hoje - data_vencimento <= 30 THEN 2
+                       WHEN :hoje - data_vencimento <= 60 THEN 3
+                       ELSE 4
+                   END AS faixa,
+                   SUM(valor) AS total, COUNT(*) AS qtd
+              FROM faturas
+             WHERE (status ILIKE 'atrasado' OR (status ILIKE 'pendente' AND data_vencimento <= :corte))
+               AND data_vencimento IS NOT NULL {filtro}
+             GROUP BY 1, 2
+        """),
+        {"hoje": hoje, "corte": corte, "transp": f"%{transportadora}%"},
+    ).all()
+
+    mapa = mapa_responsaveis(db)
+    n = len(AGING_FAIXAS)
+
+    def vazio(**chaves) -> dict:
+        return {**chaves, "faixas": [0.0] * n, "qtd": [0] * n, "total": 0.0, "qtd_total": 0}
+
+    def somar(alvo: dict, i: int, total: float, qtd: int):
+        alvo["faixas"][i] = round(alvo["faixas"][i] + total, 2)
+        alvo["qtd"][i] += qtd
+        alvo["total"] = round(alvo["total"] + total, 2)
+        alvo["qtd_total"] += qtd
+
+    geral = vazio()
+    por_transp: dict = {}
+    por_resp: dict = {}
+    for transp, faixa, total, qtd in linhas:
+        total, qtd = float(total or 0), int(qtd or 0)
+        resp = resolver_responsavel(mapa, transp)
+        somar(geral, faixa, total, qtd)
+        somar(por_transp.setdefault(transp, vazio(transportadora=transp, responsavel=resp)), faixa, total, qtd)
+        somar(por_resp.setdefault(resp, vazio(responsavel=resp)), faixa, total, qtd)
+
+    return {
+        "hoje": hoje.isoformat(),
+        "corte": corte.isoformat(),
+        "faixas_dias": list(AGING_FAIXAS),
+        "geral": geral,
+        "por_transportadora": sorted(por_transp.values(), key=lambda x: -x["total"]),
+        "por_responsavel": sorted(por_resp.values(), key=lambda x: -x["total"]),
+    }
+
+# =========================
+# ✅ BUSCA TEXTUAL
+# =========================
+# Cada termo vira prefixo ("1234" acha "123456", "cobr" acha "cobrança");
+# todos os termos precisam aparecer. Resultado ordenado por relevância.
+
+def termos_busca(q: str) -> List[str]:
+    return re.findall(r"\w+", q or "")[:10]
+
+def tsquery_sql(termos: List[str]) -> Tuple[str, dict]:
+    partes, params = [], {}
+    for i, termo in enumerate(termos):
+        params[f"t{i}"] = f"{termo}:*"
+        partes.append(f"(to_tsquery('mshop_pt', :t{i}) || to_tsquery('mshop_simples', :t{i}))")
+    return " && ".join(partes), params
+
+@app.get("/busca", dependencies=[Depends(usuario_api)])
+def buscar(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+):
+    termos = termos_busca(q)
+    if not termos:
+        return json_response({"q": q, "itens": [], "limit": limit, "offset": offset, "tem_mais": False})
+
+    tsq, params = tsquery_sql(termos)
+    params.update({"lim": limit + 1, "off": offset})
+
+    rows = db.execute(text(f"""
+        WITH consulta AS (SELECT {tsq} AS tsq)
+        SELECT * FROM (
+            SELECT 'fatura' AS tipo, f.id, f.id AS fatura_id, f.transportadora, NULL AS responsavel,
+                   f.numero_fatura, f.valor, f.data_vencimento, f.status, f.observacao,
+                   f.data_pagamento AS pago_em, ts_rank(f.search_tsv, c.tsq) AS rank
+            FROM faturas f, consulta c
+            WHERE f.search_tsv @@ c.tsq
+            UNION ALL
+            SELECT 'historico', h.id, h.fatura_id, h.transportadora, h.responsavel,
+                   h.numero_fatura, h.valor, h.data_vencimento, 'pago', NULL,
+                   h.pago_em, ts_rank(h.search_tsv, c.tsq)
+            FROM historico_pagamentos h, consulta c
+            WHERE h.search_tsv @@ c.tsq
+        ) r
+        ORDER BY rank DESC, fatura_id DESC, tipo
+        LIMIT :lim OFFSET :off
+    """), params).all()
+
+    tem_mais = len(rows) > limit
+    mapa = mapa_responsaveis(db)
+    itens = [
+        {
+            "tipo": r.tipo,
+            "id": r.id,
+            "fatura_id": r.fatura_id,
+            "transportadora": r.transportadora,
+            "responsavel": r.responsavel or resolver_responsavel(mapa, r.transportadora),
+            "numero_fatura": r.numero_fatura,
+            "valor": float(r.valor or 0),
+            "data_vencimento": r.data_vencimento,
+            "status": r.status,
+            "observacao": r.observacao,
+            "pago_em": r.pago_em,
+            "rank": round(float(r.rank), 4),
+        }
+        for r in rows[:limit]
+    ]
+    return json_response({"q": q, "itens": itens, "limit": limit, "offset": offset, "tem_mais": tem_mais})
+
 # =========================
 # HISTÓRICO (API)
 # =========================
 
-@app.get("/historico", response_model=List[HistoricoPagamentoOut])
+@app.get("/historico", response_model=List[HistoricoPagamentoOut], dependencies=[Depends(usuario_api)])
 def listar_historico(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     transportadora: Optional[str] = Query(None),
     de: Optional[str] = Query(None),   # yyyy-mm-dd
     ate: Optional[str] = Query(None),  # yyyy-mm-dd
     numero_fatura: Optional[str] = Query(None),
+    format: Optional[str] = Query(None),
 ):
-    api_require_auth(request, db)
-
     q = db.query(HistoricoPagamentoDB)
 
     if transportadora:
@@ -1518,32 +3802,22 @@ def listar_historico(
     if numero_fatura:
         q = q.filter(HistoricoPagamentoDB.numero_fatura.ilike(f"%{numero_fatura}%"))
 
-    if de:
-        try:
-            d1 = datetime.strptime(de, "%Y-%m-%d").date()
-            q = q.filter(func.date(HistoricoPagamentoDB.pago_em) >= d1)
-        except ValueError:
-            pass
-
-    if ate:
-        try:
-            d2 = datetime.strptime(ate, "%Y-%m-%d").date()
-            q = q.filter(func.date(HistoricoPagamentoDB.pago_em) <= d2)
-        except ValueError:
-            pass
+    q = filtrar_periodo_pagamento(q, de, ate)
 
-    itens = q.order_by(HistoricoPagamentoDB.pago_em.desc()).all()
-    return itens
+    rows = q.with_entities(*HISTORICO_COLUNAS).order_by(HistoricoPagamentoDB.pago_em.desc()).all()
+    itens = [historico_para_dict(h) for h in rows]
+    return lista_response(request, format, itens, HISTORICO_CAMPOS_OUT)
 
 # ✅ ALIAS para seu app.js (ele chama /historico_pagamentos)
-@app.get("/historico_pagamentos", response_model=List[HistoricoPagamentoOut])
+@app.get("/historico_pagamentos", response_model=List[HistoricoPagamentoOut], dependencies=[Depends(usuario_api)])
 def listar_historico_alias(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     transportadora: Optional[str] = Query(None),
     de: Optional[str] = Query(None),
     ate: Optional[str] = Query(None),
     numero_fatura: Optional[str] = Query(None),
+    format: Optional[str] = Query(None),
 ):
     return listar_historico(
         request=request,
@@ -1552,161 +3826,233 @@ def listar_historico_alias(
         de=de,
         ate=ate,
         numero_fatura=numero_fatura,
+        format=format,
     )
 
+# =========================
+# ✅ MUDANÇAS INCREMENTAIS (cache offline do app.js)
+# =========================
+# /faturas/mudancas e /historico/mudancas?desde=<cursor> devolvem só o que
+# mudou desde a última sincronização: linhas novas/alteradas em "itens" e
+# ids apagados em "removidos", mais o cursor pra próxima chamada.
+# faturas.atualizado_em é mantido por trigger e o histórico (só INSERT)
+# usa pago_em; DELETE nas duas tabelas (cascata e arquivamento inclusive)
+# fica registrado em remocoes. Sem desde, com desde inválido ou mais velho
+# que MUDANCAS_RETENCAO_DIAS vem tudo com resetar=true. A busca volta
+# MUDANCAS_MARGEM_S antes do cursor pra pegar transações que commitaram
+# depois; linha repetida não faz mal (o cliente faz upsert por id).
+
+MUDANCAS_MARGEM_S = int(os.getenv("MUDANCAS_MARGEM_S", "60"))
+MUDANCAS_RETENCAO_DIAS = int(os.getenv("MUDANCAS_RETENCAO_DIAS", "30"))
+
+def _desde_mudancas(desde: Optional[str], agora: datetime) -> Optional[datetime]:
+    """None = cliente precisa recarregar tudo."""
+    if not desde:
+        return None
+    try:
+        dt = datetime.fromisoformat(desde)
+    except ValueError:
+        return None
+    if dt.tzinfo is None or dt < agora - timedelta(days=MUDANCAS_RETENCAO_DIAS):
+        return None
+    return dt - timedelta(seconds=MUDANCAS_MARGEM_S)
+
+def _removidos_desde(db: Session, tabela: str, desde: datetime) -> List[int]:
+    return [
+        rid
+        for (rid,) in db.query(RemocaoDB.registro_id)
+        .filter(RemocaoDB.tabela == tabela, RemocaoDB.removido_em > desde)
+        .distinct()
+    ]
+
+@app.get("/faturas/mudancas", dependencies=[Depends(usuario_api)])
+def mudancas_faturas(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    primario: Session = Depends(get_db),
+    desde: Optional[str] = Query(None),
+):
+    if atualizar_status_automatico(primario):
+        db = primario  # a réplica ainda não viu a virada de status
+
+    # cursor lido ANTES das consultas: o que commitar depois entra na próxima
+    agora = db.execute(text("SELECT now()")).scalar()
+    inicio = _desde_mudancas(desde, agora)
+
+    query = db.query(FaturaDB)
+    if inicio is not None:
+        query = query.filter(FaturaDB.atualizado_em > inicio)
+
+    mapa = mapa_responsaveis(db)
+    rows = query.with_entities(*FATURA_COLUNAS).order_by(FaturaDB.id.desc()).all()
+    return json_response({
+        "cursor": agora,
+        "resetar": inicio is None,
+        "itens": [fatura_para_dict(f, mapa) for f in rows],
+        "removidos": _removidos_desde(db, "faturas", inicio) if inicio is not None else [],
+    })
+
+@app.get("/historico/mudancas", dependencies=[Depends(usuario_api)])
+def mudancas_historico(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    desde: Optional[str] = Query(None),
+):
+    agora = db.execute(text("SELECT now()")).scalar()
+    inicio = _desde_mudancas(desde, agora)
+
+    q = db.query(HistoricoPagamentoDB)
+    if inicio is not None:
+        q = q.filter(HistoricoPagamentoDB.pago_em > inicio)  # poda partições
+
+    rows = q.with_entities(*HISTORICO_COLUNAS).order_by(HistoricoPagamentoDB.pago_em.desc()).all()
+    return json_response({
+        "cursor": agora,
+        "resetar": inicio is None,
+        "itens": [historico_para_dict(h) for h in rows],
+        "removidos": _removidos_desde(db, "historico_pagamentos", inicio) if inicio is not None else [],
+    })
+
 # =========================
 # EXPORT CSV
 # =========================
 
-@app.get("/faturas/exportar")
+CSV_CABECALHO_FATURAS = [
+    "ID",
+    "Transportadora",
+    "Responsável",
+    "Número Fatura",
+    "Valor",
+    "Data Vencimento",
+    "Status",
+    "Data Pagamento (BR)",
+    "Observação",
+]
+CSV_CABECALHO_HISTORICO = ["ID Hist", "ID Fatura", "Transportadora", "Responsável", "Número Fatura", "Valor", "Vencimento", "Pago em (BR)"]
+
+def _data_br(d: Optional[date]) -> str:
+    return d.strftime("%d/%m/%Y") if d else ""
+
+def _data_hora_br(dt) -> str:
+    if not dt:
+        return ""
+    try:
+        return dt.astimezone(BR_TZ).strftime("%d/%m/%Y %H:%M:%S")
+    except Exception:
+        return str(dt)
+
+def query_export_faturas(db: Session, filtros: dict):
+    query = filtrar_faturas(
+        db.query(FaturaDB),
+        transportadora=filtros.get("transportadora"),
+        numero_fatura=filtros.get("numero_fatura"),
+        status=filtros.get("status"),
+        de_vencimento=filtros.get("de_vencimento"),
+        ate_vencimento=filtros.get("ate_vencimento"),
+    )
+    return query.with_entities(*FATURA_COLUNAS).order_by(FaturaDB.id.desc())
+
+def linha_csv_fatura(f, mapa: dict) -> list:
+    return [
+        f.id,
+        f.transportadora,
+        resolver_responsavel(mapa, f.transportadora) or "",
+        str(f.numero_fatura),
+        float(f.valor or 0),
+        _data_br(f.data_vencimento),
+        f.status,
+        _data_hora_br(f.data_pagamento),
+        f.observacao or "",
+    ]
+
+def query_export_historico(db: Session, filtros: dict):
+    q = db.query(HistoricoPagamentoDB)
+    if filtros.get("transportadora"):
+        q = q.filter(HistoricoPagamentoDB.transportadora.ilike(f"%{filtros['transportadora']}%"))
+    if filtros.get("numero_fatura"):
+        q = q.filter(HistoricoPagamentoDB.numero_fatura.ilike(f"%{filtros['numero_fatura']}%"))
+    q = filtrar_periodo_pagamento(q, filtros.get("de"), filtros.get("ate"))
+    return q.with_entities(*HISTORICO_COLUNAS).order_by(HistoricoPagamentoDB.pago_em.desc())
+
+def linha_csv_historico(it) -> list:
+    return [
+        it.id,
+        it.fatura_id,
+        it.transportadora,
+        it.responsavel or "",
+        it.numero_fatura,
+        float(it.valor or 0),
+        _data_br(it.data_vencimento),
+        _data_hora_br(it.pago_em),
+    ]
+
+@app.get("/faturas/exportar", dependencies=[Depends(usuario_api), Depends(vaga_exportacao)])
 def exportar_faturas(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
+    primario: Session = Depends(get_db),
     transportadora: Optional[str] = Query(None),
     numero_fatura: Optional[str] = Query(None),
     de_vencimento: Optional[str] = Query(None),
     ate_vencimento: Optional[str] = Query(None),
     status: Optional[str] = Query(None),
 ):
-    api_require_auth(request, db)
-    atualizar_status_automatico(db)
+    if atualizar_status_automatico(primario):
+        db = primario  # a réplica ainda não viu a virada de status
 
     import csv
     import io
 
-    query = db.query(FaturaDB)
-    if transportadora:
-        query = query.filter(FaturaDB.transportadora.ilike(f"%{transportadora}%"))
-    if numero_fatura:
-        query = query.filter(FaturaDB.numero_fatura.ilike(f"%{numero_fatura}%"))
-    if status:
-        query = query.filter(FaturaDB.status.ilike(status.strip()))
-    if de_vencimento:
-        try:
-            d1 = datetime.strptime(de_vencimento, "%Y-%m-%d").date()
-            query = query.filter(FaturaDB.data_vencimento >= d1)
-        except ValueError:
-            pass
-    if ate_vencimento:
-        try:
-            d2 = datetime.strptime(ate_vencimento, "%Y-%m-%d").date()
-            query = query.filter(FaturaDB.data_vencimento <= d2)
-        except ValueError:
-            pass
-
-    faturas = query.order_by(FaturaDB.id.desc()).all()
+    filtros = {
+        "transportadora": transportadora,
+        "numero_fatura": numero_fatura,
+        "de_vencimento": de_vencimento,
+        "ate_vencimento": ate_vencimento,
+        "status": status,
+    }
+    mapa = mapa_responsaveis(db)
+    faturas = query_export_faturas(db, filtros).all()
 
     output = io.StringIO()
     writer = csv.writer(output, delimiter=";")
-
-    writer.writerow(
-        [
-            "ID",
-            "Transportadora",
-            "Responsável",
-            "Número Fatura",
-            "Valor",
-            "Data Vencimento",
-            "Status",
-            "Data Pagamento (BR)",
-            "Observação",
-        ]
-    )
-
+    writer.writerow(CSV_CABECALHO_FATURAS)
     for f in faturas:
-        pago_em = ""
-        if f.data_pagamento:
-            try:
-                pago_em = f.data_pagamento.astimezone(BR_TZ).strftime("%d/%m/%Y %H:%M:%S")
-            except Exception:
-                pago_em = str(f.data_pagamento)
-
-        writer.writerow(
-            [
-                f.id,
-                f.transportadora,
-                get_responsavel(db, f.transportadora) or "",
-                str(f.numero_fatura),
-                float(f.valor or 0),
-                f.data_vencimento.strftime("%d/%m/%Y") if f.data_vencimento else "",
-                f.status,
-                pago_em,
-                f.observacao or "",
-            ]
-        )
+        writer.writerow(linha_csv_fatura(f, mapa))
 
     csv_bytes = output.getvalue().encode("utf-8-sig")
     headers = {"Content-Disposition": 'attachment; filename="faturas.csv"'}
     return Response(csv_bytes, media_type="text/csv", headers=headers)
 
-@app.get("/historico/exportar")
+@app.get("/historico/exportar", dependencies=[Depends(usuario_api), Depends(vaga_exportacao)])
 def exportar_historico(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     transportadora: Optional[str] = Query(None),
     de: Optional[str] = Query(None),
     ate: Optional[str] = Query(None),
     numero_fatura: Optional[str] = Query(None),
 ):
-    api_require_auth(request, db)
-
     import csv
     import io
 
-    q = db.query(HistoricoPagamentoDB)
-    if transportadora:
-        q = q.filter(HistoricoPagamentoDB.transportadora.ilike(f"%{transportadora}%"))
-    if numero_fatura:
-        q = q.filter(HistoricoPagamentoDB.numero_fatura.ilike(f"%{numero_fatura}%"))
-
-    if de:
-        try:
-            d1 = datetime.strptime(de, "%Y-%m-%d").date()
-            q = q.filter(func.date(HistoricoPagamentoDB.pago_em) >= d1)
-        except ValueError:
-            pass
-
-    if ate:
-        try:
-            d2 = datetime.strptime(ate, "%Y-%m-%d").date()
-            q = q.filter(func.date(HistoricoPagamentoDB.pago_em) <= d2)
-        except ValueError:
-            pass
-
-    itens = q.order_by(HistoricoPagamentoDB.pago_em.desc()).all()
+    filtros = {"transportadora": transportadora, "numero_fatura": numero_fatura, "de": de, "ate": ate}
+    itens = query_export_historico(db, filtros).all()
 
     output = io.StringIO()
     writer = csv.writer(output, delimiter=";")
-
-    writer.writerow(["ID Hist", "ID Fatura", "Transportadora", "Responsável", "Número Fatura", "Valor", "Vencimento", "Pago em (BR)"])
-
+    writer.writerow(CSV_CABECALHO_HISTORICO)
     for it in itens:
-        pago_em = ""
-        try:
-            pago_em = it.pago_em.astimezone(BR_TZ).strftime("%d/%m/%Y %H:%M:%S")
-        except Exception:
-            pago_em = str(it.pago_em)
-
-        writer.writerow([
-            it.id,
-            it.fatura_id,
-            it.transportadora,
-            it.responsavel or "",
-            it.numero_fatura,
-            float(it.valor or 0),
-            it.data_vencimento.strftime("%d/%m/%Y") if it.data_vencimento else "",
-            pago_em
-        ])
+        writer.writerow(linha_csv_historico(it))
 
     csv_bytes = output.getvalue().encode("utf-8-sig")
     headers = {"Content-Disposition": 'attachment; filename="historico_pagamentos.csv"'}
     return Response(csv_bytes, media_type="text/csv", headers=headers)
 
 # ✅ alias do export, se seu JS chamar isso
-@app.get("/historico_pagamentos/exportar")
+@app.get("/historico_pagamentos/exportar", dependencies=[Depends(usuario_api), Depends(vaga_exportacao)])
 def exportar_historico_alias(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     transportadora: Optional[str] = Query(None),
     de: Optional[str] = Query(None),
     ate: Optional[str] = Query(None),
@@ -1720,3 +4066,723 @@ def exportar_historico_alias(
         ate=ate,
         numero_fatura=numero_fatura,
     )
+
+# =========================
+# ✅ ARQUIVO FRIO (R2)
+# =========================
+# Faturas pagas há mais de ARQUIVO_MESES saem do banco e vão pro R2 como
+# JSONL gzip (uma linha por fatura, com histórico e anexos), em lotes de
+# até ARQUIVO_LOTE faturas de um mesmo mês de pagamento. arquivo_lotes
+# guarda o índice; /arquivo lista e /arquivo/{id} devolve o conteúdo.
+# Rodar: python main.py arquivar [--meses N]
+# Os objetos dos anexos continuam no R2 (a linha guarda a KEY).
+
+ARQUIVO_MESES = int(os.getenv("ARQUIVO_MESES", "24"))
+ARQUIVO_LOTE = int(os.getenv("ARQUIVO_LOTE", "5000"))
+ARQUIVO_LOCK_KEY = 7_305_002
+
+def _fatura_arquivo(f: FaturaDB, historico: list, anexos: list) -> dict:
+    return {
+        "id": f.id,
+        "transportadora": f.transportadora,
+        "numero_fatura": f.numero_fatura,
+        "valor": float(f.valor or 0),
+        "data_vencimento": f.data_vencimento,
+        "status": f.status,
+        "observacao": f.observacao,
+        "data_pagamento": f.data_pagamento,
+        "historico": [historico_para_dict(h) for h in historico],
+        "anexos": [
+            {
+                "id": a.id,
+                "filename": a.filename,
+                "original_name": a.original_name,
+                "content_type": a.content_type,
+                "criado_em": a.criado_em,
+            }
+            for a in anexos
+        ],
+    }
+
+def _arquivar_um_lote(corte: datetime, lote_max: int) -> Optional[dict]:
+    db = new_session()
+    chave = None
+    try:
+        if not db.execute(text("SELECT pg_try_advisory_xact_lock(:k)"), {"k": ARQUIVO_LOCK_KEY}).scalar():
+            print("ARQUIVO: outro processo já está arquivando")
+            return None
+
+        pagas = db.query(FaturaDB).filter(FaturaDB.status.ilike("pago"), FaturaDB.data_pagamento < corte)
+
+        # um lote nunca mistura meses: começa pelo mês mais antigo
+        primeira = pagas.with_entities(func.min(FaturaDB.data_pagamento)).scalar()
+        if primeira is None:
+            return None
+        mes = primeira.astimezone(BR_TZ).date().replace(day=1)
+        fim_mes = min(corte, inicio_dia_br(_somar_meses(mes, 1)))
+
+        faturas = (
+            pagas.filter(FaturaDB.data_pagamento < fim_mes)
+            .order_by(FaturaDB.data_pagamento, FaturaDB.id)
+            .limit(lote_max)
+            .with_for_update()
+            .all()
+        )
+        ids = [f.id for f in faturas]
+
+        historico_por_fatura = defaultdict(list)
+        for h in (
+            db.query(HistoricoPagamentoDB)
+            .filter(HistoricoPagamentoDB.fatura_id.in_(ids))
+            .order_by(HistoricoPagamentoDB.pago_em)
+        ):
+            historico_por_fatura[h.fatura_id].append(h)
+
+        anexos_por_fatura = defaultdict(list)
+        for a in db.query(AnexoDB).filter(AnexoDB.fatura_id.in_(ids)).order_by(AnexoDB.id):
+            anexos_por_fatura[a.fatura_id].append(a)
+
+        corpo = gzip.compress(
+            b"".join(
+                orjson.dumps(
+                    _fatura_arquivo(f, historico_por_fatura[f.id], anexos_por_fatura[f.id]),
+                    option=ORJSON_OPTS,
+                ) + b"\n"
+                for f in faturas
+            )
+        )
+
+        chave = f"arquivo/faturas/{mes:%Y-%m}/{uuid.uuid4().hex}.jsonl.gz"
+        r2_call("put_object", Bucket=R2_BUCKET_NAME, Key=chave, Body=corpo, ContentType="application/gzip")
+
+        lote = ArquivoLoteDB(
+            chave=chave,
+            periodo=f"{mes:%Y-%m}",
+            qtd_faturas=len(faturas),
+            qtd_historico=sum(len(v) for v in historico_por_fatura.values()),
+            bytes=len(corpo),
+            pago_de=faturas[0].data_pagamento,
+            pago_ate=faturas[-1].data_pagamento,
+        )
+        db.add(lote)
+        fotos = {f.id: foto_fatura(f) for f in faturas}
+        # histórico e anexos vão junto (ON DELETE CASCADE)
+        db.query(FaturaDB).filter(FaturaDB.id.in_(ids)).delete(synchronize_session=False)
+        notificar_invalidacao(db, "faturas")
+        db.commit()
+        for fid, foto in fotos.items():
+            registrar_auditoria(fid, "remover", {**diff_fatura(foto, {}), "arquivo": [None, chave]})
+
+        print(f"ARQUIVO: {lote.periodo} -> {chave} ({lote.qtd_faturas} faturas, {lote.bytes} bytes)")
+        return {
+            "id": lote.id,
+            "chave": chave,
+            "periodo": lote.periodo,
+            "qtd_faturas": lote.qtd_faturas,
+            "qtd_historico": lote.qtd_historico,
+            "bytes": lote.bytes,
+        }
+    except Exception:
+        db.rollback()
+        if chave:
+            # upload feito mas o banco não: objeto órfão sai do R2
+            try:
+                r2_call("delete_object", Bucket=R2_BUCKET_NAME, Key=chave)
+            except Exception as e:
+                # qualquer falha aqui (rede, timeout, disjuntor) só vira aviso:
+                # quem sobe é o erro original do banco
+                print("WARN ARQUIVO: falha ao remover objeto órfão:", chave, repr(e))
+        raise
+    finally:
+        db.close()
+
+def arquivar_faturas_pagas(meses: Optional[int] = None, lote_max: Optional[int] = None) -> List[dict]:
+    meses = ARQUIVO_MESES if meses is None else meses
+    lote_max = ARQUIVO_LOTE if lote_max is None else lote_max
+
+    hoje = hoje_local_br()
+    corte = inicio_dia_br(_somar_meses(date(hoje.year, hoje.month, 1), -meses))
+
+    lotes = []
+    while True:
+        lote = _arquivar_um_lote(corte, lote_max)
+        if not lote:
+            return lotes
+        lotes.append(lote)
+
+def _linhas_arquivo(body, numero_fatura: Optional[str], transportadora: Optional[str]):
+    # descompacta em streaming; filtra linha a linha sem carregar o lote inteiro
+    import zlib
+
+    numero = (numero_fatura or "").lower()
+    transp = (transportadora or "").lower()
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    resto = b""
+
+    def passa(linha: bytes) -> bool:
+        if not (numero or transp):
+            return True
+        item = orjson.loads(linha)
+        return numero in (item.get("numero_fatura") or "").lower() and transp in (item.get("transportadora") or "").lower()
+
+    for chunk in body.iter_chunks(64 * 1024):
+        resto += d.decompress(chunk)
+        *linhas, resto = resto.split(b"\n")
+        for linha in linhas:
+            if linha and passa(linha):
+                yield linha + b"\n"
+    resto += d.flush()
+    for linha in resto.split(b"\n"):
+        if linha and passa(linha):
+            yield linha + b"\n"
+
+@app.get("/arquivo", dependencies=[Depends(usuario_api)])
+def listar_arquivo(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    periodo: Optional[str] = Query(None),  # AAAA-MM
+):
+    q = db.query(ArquivoLoteDB)
+    if periodo:
+        q = q.filter(ArquivoLoteDB.periodo == periodo)
+
+    lotes = q.order_by(ArquivoLoteDB.periodo.desc(), ArquivoLoteDB.id.desc()).all()
+    return json_response([
+        {
+            "id": l.id,
+            "periodo": l.periodo,
+            "qtd_faturas": l.qtd_faturas,
+            "qtd_historico": l.qtd_historico,
+            "bytes": l.bytes,
+            "pago_de": l.pago_de,
+            "pago_ate": l.pago_ate,
+            "criado_em": l.criado_em,
+        }
+        for l in lotes
+    ])
+
+@app.get("/arquivo/{lote_id}", dependencies=[Depends(usuario_api)])
+def baixar_arquivo(
+    lote_id: int,
+    request: Request,
+    db: Session = Depends(get_read_db),
+    numero_fatura: Optional[str] = Query(None),
+    transportadora: Optional[str] = Query(None),
+    bruto: bool = Query(False),  # true = o .jsonl.gz como está no R2
+):
+    lote = db.query(ArquivoLoteDB).filter(ArquivoLoteDB.id == lote_id).first()
+    if not lote:
+        raise HTTPException(status_code=404, detail="Lote de arquivo não encontrado")
+
+    try:
+        obj = r2_call("get_object", Bucket=R2_BUCKET_NAME, Key=lote.chave)
+    except ClientError as e:
+        print("ERRO ARQUIVO R2:", repr(e))
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado no R2")
+
+    nome = f"faturas_{lote.periodo}_{lote.id}.jsonl"
+    if bruto:
+        headers = {"Content-Disposition": f'attachment; filename="{nome}.gz"'}
+        return StreamingResponse(obj["Body"], media_type="application/gzip", headers=headers)
+
+    headers = {"Content-Disposition": f'inline; filename="{nome}"'}
+    return StreamingResponse(
+        _linhas_arquivo(obj["Body"], numero_fatura, transportadora),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+# =========================
+# ✅ FILA DE TAREFAS (Postgres, FOR UPDATE SKIP LOCKED)
+# =========================
+# enfileirar(db, tipo, payload) grava na tabela jobs na MESMA transação de
+# quem chamou: a tarefa só existe se o commit acontecer. Os workers pegam
+# uma pendente por vez com SKIP LOCKED (vários processos sem brigar),
+# erro reagenda com backoff exponencial até max_tentativas, e tarefa
+# "executando" de worker que morreu volta pra fila depois de TAREFAS_TRAVA_S.
+#
+# Worker: thread em cada processo web (TAREFAS_INPROCESS=1, padrão) ou
+# processo separado com `python main.py worker` (aí use TAREFAS_INPROCESS=0
+# nos web). As periódicas entram com chave_unica por janela de tempo, então
+# saem uma vez por intervalo mesmo com vários workers agendando.
+
+TAREFAS_INPROCESS = os.getenv("TAREFAS_INPROCESS", "1").strip() == "1"
+TAREFAS_POLL_S = float(os.getenv("TAREFAS_POLL_S", "2"))
+TAREFAS_MAX_TENTATIVAS = int(os.getenv("TAREFAS_MAX_TENTATIVAS", "5"))
+TAREFAS_BACKOFF_S = int(os.getenv("TAREFAS_BACKOFF_S", "10"))
+TAREFAS_BACKOFF_MAX_S = int(os.getenv("TAREFAS_BACKOFF_MAX_S", "3600"))
+TAREFAS_TRAVA_S = int(os.getenv("TAREFAS_TRAVA_S", "900"))
+TAREFAS_RETENCAO_DIAS = int(os.getenv("TAREFAS_RETENCAO_DIAS", "7"))
+
+TAREFAS = {}
+
+def tarefa(tipo: str):
+    def registrar(fn):
+        TAREFAS[tipo] = fn
+        return fn
+    return registrar
+
+def enfileirar(db: Session, tipo: str, payload: Optional[dict] = None, atraso_s: int = 0,
+               max_tentativas: Optional[int] = None, chave_unica: Optional[str] = None):
+    if tipo not in TAREFAS:
+        raise ValueError(f"tarefa desconhecida: {tipo}")
+    db.execute(
+        text("""
+            INSERT INTO jobs (tipo, payload, max_tentativas, executar_em, chave_unica)
+            VALUES (:t, CAST(:p AS jsonb), :m, now() + make_interval(secs => :a), :c)
+            ON CONFLICT (chave_unica) DO NOTHING
+        """),
+        {
+            "t": tipo,
+            "p": json.dumps(payload or {}),
+            "m": max_tentativas or TAREFAS_MAX_TENTATIVAS,
+            "a": atraso_s,
+            "c": chave_unica,
+        },
+    )
+
+# ---- tarefas
+
+@tarefa("r2_apagar")
+def _tarefa_r2_apagar(payload: dict):
+    for chave in payload.get("chaves") or []:
+        r2_call("delete_object", Bucket=R2_BUCKET_NAME, Key=chave)
+
+@tarefa("status_automatico")
+def _tarefa_status_automatico(payload: dict):
+    db = new_session()
+    try:
+        atualizar_status_automatico(db)
+    finally:
+        db.close()
+
+@tarefa("particoes_historico")
+def _tarefa_particoes_historico(payload: dict):
+    manter_particoes_historico()
+
+@tarefa("arquivar")
+def _tarefa_arquivar(payload: dict):
+    arquivar_faturas_pagas(payload.get("meses"), payload.get("lote"))
+
+@tarefa("limpar_password_resets")
+def _tarefa_limpar_password_resets(payload: dict):
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            DELETE FROM password_resets
+             WHERE expires_at < now() - interval '1 day'
+                OR used_at < now() - interval '1 day'
+        """))
+
+@tarefa("limpar_idempotencia")
+def _tarefa_limpar_idempotencia(payload: dict):
+    with get_engine().begin() as conn:
+        conn.execute(text("DELETE FROM idempotency_keys WHERE expira_em < now()"))
+
+@tarefa("limpar_limites")
+def _tarefa_limpar_limites(payload: dict):
+    # balde parado por rajada/taxa segundos já está cheio: igual a não existir
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("DELETE FROM rate_limits WHERE atualizado_em < now() - make_interval(secs => :s)"),
+            {"s": LIMITE_RAJADA / LIMITE_TAXA},
+        )
+
+@tarefa("limpar_remocoes")
+def _tarefa_limpar_remocoes(payload: dict):
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("DELETE FROM remocoes WHERE removido_em < now() - make_interval(days => :d)"),
+            {"d": MUDANCAS_RETENCAO_DIAS},
+        )
+
+@tarefa("limpar_tarefas")
+def _tarefa_limpar_tarefas(payload: dict):
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("""
+                DELETE FROM jobs
+                 WHERE estado IN ('concluida', 'falhou')
+                   AND COALESCE(concluida_em, criado_em) < now() - make_interval(days => :d)
+            """),
+            {"d": TAREFAS_RETENCAO_DIAS},
+        )
+
+# (tipo, intervalo em segundos); intervalo 0 desliga
+TAREFAS_PERIODICAS = [
+    ("status_automatico", int(os.getenv("TAREFAS_STATUS_S", "300"))),
+    ("particoes_historico", int(os.getenv("TAREFAS_PARTICOES_S", str(6 * 3600)))),
+    ("limpar_password_resets", int(os.getenv("TAREFAS_LIMPEZA_S", "3600"))),
+    ("limpar_idempotencia", int(os.getenv("TAREFAS_LIMPEZA_S", "3600"))),
+    ("limpar_tarefas", int(os.getenv("TAREFAS_LIMPEZA_S", "3600"))),
+    ("limpar_remocoes", int(os.getenv("TAREFAS_LIMPEZA_S", "3600"))),
+    ("limpar_limites", int(os.getenv("TAREFAS_LIMPEZA_S", "3600"))),
+    # arquivamento mexe em dados: só agenda se pedirem
+    ("arquivar", int(os.getenv("TAREFAS_ARQUIVO_S", "0"))),
+]
+
+# ---- worker
+
+def agendar_periodicas():
+    agora = time.time()
+    db = new_session()
+    try:
+        for tipo, intervalo in TAREFAS_PERIODICAS:
+            if intervalo > 0:
+                enfileirar(db, tipo, chave_unica=f"{tipo}@{int(agora // intervalo)}", max_tentativas=1)
+        db.commit()
+    finally:
+        db.close()
+
+def recuperar_tarefas_travadas() -> int:
+    # worker morreu no meio: volta pra fila (ou falha, se já gastou as tentativas)
+    with get_engine().begin() as conn:
+        return conn.execute(
+            text("""
+                UPDATE jobs
+                   SET estado = CASE WHEN tentativas >= max_tentativas THEN 'falhou' ELSE 'pendente' END,
+                       executar_em = now(), travada_por = NULL, travada_em = NULL,
+                       ultimo_erro = 'travada: worker não terminou em ' || :trava || 's'
+                 WHERE estado = 'executando'
+                   AND travada_em < now() - make_interval(secs => :trava)
+            """),
+            {"trava": TAREFAS_TRAVA_S},
+        ).rowcount
+
+def executar_uma_tarefa(worker_id: str) -> bool:
+    """Pega e executa UMA tarefa pendente. False se a fila estava vazia."""
+    with get_engine().begin() as conn:
+        job = conn.execute(
+            text("""
+                UPDATE jobs
+                   SET estado = 'executando', travada_por = :w, travada_em = now(), tentativas = tentativas + 1
+                 WHERE id = (
+                        SELECT id FROM jobs
+                         WHERE estado = 'pendente' AND executar_em <= now()
+                         ORDER BY executar_em, id
+                         FOR UPDATE SKIP LOCKED
+                         LIMIT 1
+                 )
+             RETURNING id, tipo, payload, tentativas, max_tentativas
+            """),
+            {"w": worker_id},
+        ).first()
+    if job is None:
+        return False
+
+    t0 = time.perf_counter()
+    try:
+        fn = TAREFAS.get(job.tipo)
+        if fn is None:
+            raise RuntimeError(f"tarefa desconhecida: {job.tipo}")
+        fn(job.payload or {})
+    except Exception as e:
+        desistir = job.tentativas >= job.max_tentativas
+        espera = min(TAREFAS_BACKOFF_S * 2 ** (job.tentativas - 1), TAREFAS_BACKOFF_MAX_S)
+        print(f"WARN TAREFA {job.tipo}#{job.id} tentativa {job.tentativas}/{job.max_tentativas}:", repr(e))
+        with get_engine().begin() as conn:
+            conn.execute(
+                text("""
+                    UPDATE jobs
+                       SET estado = :estado, ultimo_erro = :erro, travada_por = NULL, travada_em = NULL,
+                           executar_em = now() + make_interval(secs => :espera),
+                           concluida_em = CASE WHEN :estado = 'falhou' THEN now() END
+                     WHERE id = :id
+                """),
+                {"id": job.id, "estado": "falhou" if desistir else "pendente", "erro": repr(e)[:2000], "espera": espera},
+            )
+        TAREFAS_LATENCIA.labels(job.tipo, "falhou" if desistir else "retry").observe(time.perf_counter() - t0)
+        return True
+
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE jobs
+                   SET estado = 'concluida', concluida_em = now(), travada_por = NULL, travada_em = NULL, ultimo_erro = NULL
+                 WHERE id = :id
+            """),
+            {"id": job.id},
+        )
+    TAREFAS_LATENCIA.labels(job.tipo, "ok").observe(time.perf_counter() - t0)
+    return True
+
+_tarefas_parar = threading.Event()
+
+def loop_tarefas(parar: threading.Event, worker_id: Optional[str] = None):
+    worker_id = worker_id or f"{os.uname().nodename}:{os.getpid()}"
+    proxima_agenda = 0.0
+    while not parar.is_set():
+        try:
+            if time.monotonic() >= proxima_agenda:
+                agendar_periodicas()
+                recuperar_tarefas_travadas()
+                proxima_agenda = time.monotonic() + 30
+            # esvazia o que estiver pronto antes de dormir
+            while not parar.is_set() and executar_uma_tarefa(worker_id):
+                pass
+        except Exception as e:
+            print("WARN worker de tarefas:", repr(e))
+        parar.wait(TAREFAS_POLL_S)
+
+def iniciar_worker_tarefas() -> Optional[threading.Thread]:
+    if not TAREFAS_INPROCESS:
+        return None
+    _tarefas_parar.clear()
+    t = threading.Thread(target=loop_tarefas, args=(_tarefas_parar,), name="mshop-tarefas", daemon=True)
+    t.start()
+    return t
+
+# =========================
+# ✅ EXPORTAÇÕES ASSÍNCRONAS (R2)
+# =========================
+# POST /exportacoes grava o pedido e enfileira a tarefa "exportacao"; o
+# worker gera o CSV em arquivo temporário (linhas em streaming, progresso
+# a cada EXPORTACAO_PASSO linhas), sobe pro R2 e GET /exportacoes/{id}
+# devolve uma URL pré-assinada. Pedido igual (mesmo tipo e filtros) feito
+# há menos de EXPORTACAO_REUSO_S reaproveita o anterior, inclusive se
+# ainda estiver rodando. Os GET /.../exportar síncronos continuam valendo.
+
+EXPORTACAO_REUSO_S = int(os.getenv("EXPORTACAO_REUSO_S", "300"))
+EXPORTACAO_URL_S = int(os.getenv("EXPORTACAO_URL_S", "900"))
+EXPORTACAO_RETENCAO_H = int(os.getenv("EXPORTACAO_RETENCAO_H", "24"))
+EXPORTACAO_PASSO = 5000
+
+EXPORTACAO_FILTROS = {
+    "faturas": ("transportadora", "numero_fatura", "de_vencimento", "ate_vencimento", "status"),
+    "historico": ("transportadora", "numero_fatura", "de", "ate"),
+}
+EXPORTACAO_ARQUIVO = {"faturas": "faturas.csv", "historico": "historico_pagamentos.csv"}
+
+class ExportacaoCreate(BaseModel):
+    tipo: str
+    filtros: dict = {}
+
+def normalizar_filtros_exportacao(tipo: str, filtros: dict) -> dict:
+    # só o que a exportação entende, sem vazios: a impressão não muda por ruído
+    out = {}
+    for k in EXPORTACAO_FILTROS[tipo]:
+        v = filtros.get(k)
+        if isinstance(v, str) and v.strip():
+            out[k] = v.strip()
+    return out
+
+def exportacao_para_dict(e: ExportacaoDB) -> dict:
+    travada = (
+        e.estado == "executando"
+        and e.atualizado_em is not None
+        and e.atualizado_em < agora_br() - timedelta(seconds=TAREFAS_TRAVA_S)
+    )
+    estado = "falhou" if travada else e.estado
+    progresso = None
+    if estado == "concluida":
+        progresso = 1.0
+    elif e.linhas_total:
+        progresso = round(min(e.linhas_feitas / e.linhas_total, 1.0), 3)
+
+    url = None
+    if estado == "concluida" and e.chave_r2:
+        url = r2_call(
+            "generate_presigned_url",
+            ClientMethod="get_object",
+            Params={
+                "Bucket": R2_BUCKET_NAME,
+                "Key": e.chave_r2,
+                "ResponseContentDisposition": f'attachment; filename="{EXPORTACAO_ARQUIVO[e.tipo]}"',
+            },
+            ExpiresIn=EXPORTACAO_URL_S,
+        )
+
+    return {
+        "id": e.id,
+        "tipo": e.tipo,
+        "filtros": e.filtros,
+        "estado": estado,
+        "progresso": progresso,
+        "linhas_total": e.linhas_total,
+        "linhas_feitas": e.linhas_feitas,
+        "bytes": e.bytes,
+        "url": url,
+        "erro": e.erro or ("worker parou no meio da exportação" if travada else None),
+        "criado_em": e.criado_em,
+        "concluida_em": e.concluida_em,
+    }
+
+def _exportacao_progresso(exp_id: int, **campos):
+    sets = ", ".join(f"{k} = :{k}" for k in campos)
+    with get_engine().begin() as conn:
+        conn.execute(
+            text(f"UPDATE exportacoes SET {sets}, atualizado_em = now() WHERE id = :id"),
+            {"id": exp_id, **campos},
+        )
+
+@tarefa("exportacao")
+def _tarefa_exportacao(payload: dict):
+    import csv
+    import io
+    import tempfile
+
+    exp_id = payload["id"]
+    db = new_session()
+    try:
+        exp = db.get(ExportacaoDB, exp_id)
+        if exp is None or exp.estado == "concluida":
+            return
+        tipo, filtros = exp.tipo, dict(exp.filtros or {})
+        _exportacao_progresso(exp_id, estado="executando", linhas_feitas=0, erro=None)
+
+        if tipo == "faturas":
+            atualizar_status_automatico(db)
+            query = query_export_faturas(db, filtros)
+            mapa = mapa_responsaveis(db)
+            cabecalho, linha = CSV_CABECALHO_FATURAS, (lambda r: linha_csv_fatura(r, mapa))
+        else:
+            query = query_export_historico(db, filtros)
+            cabecalho, linha = CSV_CABECALHO_HISTORICO, linha_csv_historico
+
+        total = query.order_by(None).count()
+        _exportacao_progresso(exp_id, linhas_total=total)
+
+        chave = f"exportacoes/{exp_id}/{uuid.uuid4().hex}_{EXPORTACAO_ARQUIVO[tipo]}"
+        with tempfile.TemporaryFile() as tmp:
+            texto = io.TextIOWrapper(tmp, encoding="utf-8-sig", newline="")
+            writer = csv.writer(texto, delimiter=";")
+            writer.writerow(cabecalho)
+            feitas = 0
+            for r in query.yield_per(2000):
+                writer.writerow(linha(r))
+                feitas += 1
+                if feitas % EXPORTACAO_PASSO == 0:
+                    _exportacao_progresso(exp_id, linhas_feitas=feitas)
+            texto.flush()
+            texto.detach()  # o wrapper não pode fechar o tmp quando for coletado
+            tamanho = tmp.tell()
+            tmp.seek(0)
+
+            r2_call(
+                "upload_fileobj",
+                Fileobj=tmp,
+                Bucket=R2_BUCKET_NAME,
+                Key=chave,
+                ExtraArgs={"ContentType": "text/csv; charset=utf-8"},
+            )
+
+        _exportacao_progresso(
+            exp_id,
+            estado="concluida",
+            linhas_feitas=feitas,
+            chave_r2=chave,
+            bytes=tamanho,
+            concluida_em=agora_br(),
+        )
+    except Exception as e:
+        # uma tentativa só: quem pediu vê o erro e pede de novo
+        _exportacao_progresso(exp_id, estado="falhou", erro=repr(e)[:2000])
+        raise
+    finally:
+        db.close()
+
+@tarefa("limpar_exportacoes")
+def _tarefa_limpar_exportacoes(payload: dict):
+    db = new_session()
+    try:
+        velhas = (
+            db.query(ExportacaoDB)
+            .filter(ExportacaoDB.criado_em < agora_br() - timedelta(hours=EXPORTACAO_RETENCAO_H))
+            .filter(ExportacaoDB.estado.in_(("concluida", "falhou")))
+            .limit(500)
+            .all()
+        )
+        chaves = [e.chave_r2 for e in velhas if e.chave_r2]
+        for e in velhas:
+            db.delete(e)
+        if chaves:
+            enfileirar(db, "r2_apagar", {"chaves": chaves})
+        db.commit()
+    finally:
+        db.close()
+
+TAREFAS_PERIODICAS.append(("limpar_exportacoes", int(os.getenv("TAREFAS_LIMPEZA_S", "3600"))))
+
+@app.post("/exportacoes", status_code=202, dependencies=[Depends(exigir_csrf)])
+def criar_exportacao(dados: ExportacaoCreate, request: Request, db: Session = Depends(get_db), u: UserDB = Depends(usuario_api)):
+    if dados.tipo not in EXPORTACAO_FILTROS:
+        raise HTTPException(status_code=422, detail="tipo deve ser 'faturas' ou 'historico'")
+
+    filtros = normalizar_filtros_exportacao(dados.tipo, dados.filtros or {})
+    impressao = hashlib.sha256(
+        (dados.tipo + json.dumps(filtros, sort_keys=True, separators=(",", ":"))).encode("utf-8")
+    ).hexdigest()
+
+    recente = (
+        db.query(ExportacaoDB)
+        .filter(ExportacaoDB.impressao == impressao)
+        .filter(ExportacaoDB.estado.in_(("pendente", "executando", "concluida")))
+        .filter(ExportacaoDB.criado_em >= agora_br() - timedelta(seconds=EXPORTACAO_REUSO_S))
+        .order_by(ExportacaoDB.criado_em.desc())
+        .first()
+    )
+    if recente and exportacao_para_dict(recente)["estado"] != "falhou":
+        return {**exportacao_para_dict(recente), "reaproveitada": True}
+
+    exp = ExportacaoDB(usuario_id=u.id, tipo=dados.tipo, filtros=filtros, impressao=impressao)
+    db.add(exp)
+    db.flush()
+    enfileirar(db, "exportacao", {"id": exp.id}, max_tentativas=1)
+    db.commit()
+    db.refresh(exp)
+    return {**exportacao_para_dict(exp), "reaproveitada": False}
+
+@app.get("/exportacoes/{exportacao_id}", dependencies=[Depends(usuario_api)])
+def status_exportacao(exportacao_id: int, db: Session = Depends(get_db)):
+    exp = db.get(ExportacaoDB, exportacao_id)
+    if not exp:
+        raise HTTPException(status_code=404, detail="Exportação não encontrada")
+    return exportacao_para_dict(exp)
+
+# =========================
+# ✅ ORÇAMENTO DE TEMPO DE IMPORT
+# =========================
+# Import não abre rede; se passar do orçamento alguém voltou a fazer
+# trabalho pesado no topo do módulo.
+
+IMPORT_MS = (time.perf_counter() - _IMPORT_T0) * 1000
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "1500"))
+if IMPORT_MS > IMPORT_BUDGET_MS:
+    print(f"WARN: import de main.py levou {IMPORT_MS:.0f} ms (orçamento {IMPORT_BUDGET_MS:.0f} ms)")
+
+# =========================
+# ✅ TAREFAS DE LINHA DE COMANDO
+# =========================
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tarefas de manutenção do Sistema de Faturas")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_arq = sub.add_parser("arquivar", help="move faturas pagas antigas pro arquivo no R2")
+    p_arq.add_argument("--meses", type=int, default=ARQUIVO_MESES)
+    p_arq.add_argument("--lote", type=int, default=ARQUIVO_LOTE)
+
+    p_wrk = sub.add_parser("worker", help="processa a fila de tarefas (jobs) até receber SIGTERM/Ctrl+C")
+    p_wrk.add_argument("--id", default=None, help="identificação do worker (padrão host:pid)")
+
+    args = parser.parse_args()
+
+    if args.comando == "arquivar":
+        verificar_config_r2()
+        run_migrations()
+        lotes = arquivar_faturas_pagas(args.meses, args.lote)
+        print(f"ARQUIVO: {len(lotes)} lote(s), {sum(l['qtd_faturas'] for l in lotes)} faturas arquivadas")
+
+    elif args.comando == "worker":
+        import signal
+
+        verificar_config_r2()
+        run_migrations()
+        signal.signal(signal.SIGTERM, lambda *_: _tarefas_parar.set())
+        print(f"TAREFAS: worker iniciado ({len(TAREFAS)} tipos registrados)")
+        try:
+            loop_tarefas(_tarefas_parar, args.id)
+        except KeyboardInterrupt:
+            pass
+        parar_gravador_auditoria()
@@ -0,0 +1,133 @@
+// ============ ADMIN ============
+// Usuários e transportadoras vêm paginados de /admin/usuarios e
+// /admin/transportadoras (?q= busca por prefixo, ?depois= próxima página).
+
+const PAGINA_ADMIN = 50;
+
+function el(tag, attrs = {}, ...filhos) {
+  const e = document.createElement(tag);
+  for (const [k, v] of Object.entries(attrs)) {
+    if (k === "text") e.textContent = v;
+    else e.setAttribute(k, v);
+  }
+  for (const f of filhos) e.appendChild(f);
+  return e;
+}
+
+function debounce(fn, ms) {
+  let t = null;
+  return (...args) => {
+    clearTimeout(t);
+    t = setTimeout(() => fn(...args), ms);
+  };
+}
+
+// lista paginada: busca nova limpa a tabela; "Carregar mais" segue o cursor
+function listaPaginada({ url, tbody, botao, busca, linha }) {
+  let proximo = null;
+  let geracao = 0;
+
+  async function carregar(limpar) {
+    const minha = limpar ? ++geracao : geracao;
+    const params = new URLSearchParams({ limit: String(PAGINA_ADMIN) });
+    const q = busca.value.trim();
+    if (q) params.set("q", q);
+    if (!limpar && proximo) params.set("depois", proximo);
+
+    const resp = await fetch(`${url}?${params.toString()}`, { credentials: "include" });
+    if (resp.status === 401) {
+      window.location.href = "/login?next=/admin";
+      return;
+    }
+    if (!resp.ok || minha !== geracao) return; // resposta de uma busca antiga
+
+    const data = await resp.json();
+    if (limpar) tbody.innerHTML = "";
+    const frag = document.createDocumentFragment();
+    data.itens.forEach((it) => frag.appendChild(linha(it)));
+    tbody.appendChild(frag);
+
+    proximo = data.proximo;
+    botao.hidden = !proximo;
+  }
+
+  busca.addEventListener("input", debounce(() => carregar(true), 250));
+  botao.addEventListener("click", () => carregar(false));
+  carregar(true);
+}
+
+function linhaTransportadora(csrf) {
+  return (tr) => {
+    const form = el(
+      "form",
+      { method: "post", action: "/admin/transportadora/assign", class: "row" },
+      el("input", { type: "hidden", name: "csrf", value: csrf }),
+      el("input", { type: "hidden", name: "transportadora_id", value: String(tr.id) }),
+      el("input", {
+        name: "responsavel_username",
+        list: "listaUsuarios",
+        placeholder: "(Sem responsável)",
+        value: tr.responsavel || "",
+        autocomplete: "off",
+      }),
+      el("button", { class: "btn", type: "submit", text: "Salvar" })
+    );
+    return el(
+      "tr",
+      {},
+      el("td", { text: tr.nome }),
+      el("td", { text: tr.responsavel || "-" }),
+      el("td", {}, form)
+    );
+  };
+}
+
+function linhaUsuario(u) {
+  return el(
+    "tr",
+    {},
+    el("td", { text: u.username }),
+    el("td", { text: u.email || "-" }),
+    el("td", { text: u.role || "user" }),
+    el("td", { text: u.last_login_at ? new Date(u.last_login_at).toLocaleString("pt-BR") : "-" })
+  );
+}
+
+// sugestões do campo de responsável: só os usuários que casam com o que foi digitado
+const sugerirUsuarios = debounce(async (q) => {
+  const params = new URLSearchParams({ limit: "20" });
+  if (q) params.set("q", q);
+  const resp = await fetch(`/admin/usuarios?${params.toString()}`, { credentials: "include" });
+  if (!resp.ok) return;
+  const data = await resp.json();
+  const lista = document.getElementById("listaUsuarios");
+  lista.innerHTML = "";
+  data.itens.forEach((u) => lista.appendChild(el("option", { value: u.username, label: `${u.username} (${u.role})` })));
+}, 200);
+
+document.addEventListener("DOMContentLoaded", () => {
+  const card = document.getElementById("cardTransportadoras");
+
+  listaPaginada({
+    url: "/admin/transportadoras",
+    tbody: document.getElementById("tbodyTransportadoras"),
+    botao: document.getElementById("maisTransportadoras"),
+    busca: document.getElementById("buscaTransportadora"),
+    linha: linhaTransportadora(card.dataset.csrf),
+  });
+
+  listaPaginada({
+    url: "/admin/usuarios",
+    tbody: document.getElementById("tbodyUsuarios"),
+    botao: document.getElementById("maisUsuarios"),
+    busca: document.getElementById("buscaUsuario"),
+    linha: linhaUsuario,
+  });
+
+  card.addEventListener("input", (ev) => {
+    if (ev.target.name === "responsavel_username") sugerirUsuarios(ev.target.value.trim());
+  });
+  card.addEventListener("focusin", (ev) => {
+    if (ev.target.name === "responsavel_username") sugerirUsuarios(ev.target.value.trim());
+  });
+});
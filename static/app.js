@@ -59,12 +59,21 @@ function formatDateTime(isoDateTime) {
   return d.toLocaleString("pt-BR");
 }
 
-// fetch padrão com cookie (sessão)
+function lerCookie(nome) {
+  const par = document.cookie.split("; ").find((c) => c.startsWith(`${nome}=`));
+  return par ? decodeURIComponent(par.slice(nome.length + 1)) : "";
+}
+
+// fetch padrão com cookie (sessão); escritas levam o token CSRF no header
 async function apiFetch(url, options = {}) {
   const opts = {
     credentials: "include",
     ...options,
   };
+  const metodo = (opts.method || "GET").toUpperCase();
+  if (metodo !== "GET" && metodo !== "HEAD") {
+    opts.headers = { "X-CSRF-Token": lerCookie("mshop_csrf"), ...(opts.headers || {}) };
+  }
   const resp = await fetch(url, opts);
 
   if (resp.status === 401) {
@@ -75,6 +84,223 @@ async function apiFetch(url, options = {}) {
   return resp;
 }
 
+// ============ IDEMPOTÊNCIA ============
+// POST de fatura/anexos leva Idempotency-Key: repetir (clique duplo, rede
+// caiu, retry automático) devolve a mesma resposta em vez de duplicar.
+
+function novaChaveIdempotencia() {
+  if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+const esperar = (ms) => new Promise((r) => setTimeout(r, ms));
+
+// repete em falha de rede, 409 (original ainda processando) e 5xx
+async function fetchIdempotente(url, options, chave, tentativas = 3) {
+  const opts = { ...options, headers: { ...(options.headers || {}), "Idempotency-Key": chave } };
+  for (let i = 1; ; i++) {
+    try {
+      const resp = await apiFetch(url, opts);
+      if ((resp.status === 409 || resp.status >= 500) && i < tentativas) {
+        await esperar(500 * 2 ** (i - 1));
+        continue;
+      }
+      return resp;
+    } catch (err) {
+      // TypeError = falha de rede no fetch; 401 e afins não repetem
+      if (!(err instanceof TypeError) || i >= tentativas) throw err;
+      await esperar(500 * 2 ** (i - 1));
+    }
+  }
+}
+
+// ============ FORMATO COLUNAR ============
+// /faturas e /historico aceitam ?format=columns:
+// { columns: [...], dicts: { transportadora: [...], ... }, rows: [[...]] }
+// (colunas em "dicts" vêm como índice). Aqui volta pra lista de objetos.
+
+function decodificarColunar(payload) {
+  const cols = payload.columns || [];
+  const dicts = payload.dicts || {};
+  const tabelas = cols.map((c) => dicts[c] || null);
+  const n = cols.length;
+
+  return (payload.rows || []).map((row) => {
+    const obj = {};
+    for (let i = 0; i < n; i++) {
+      const v = row[i];
+      const tab = tabelas[i];
+      obj[cols[i]] = tab && v !== null ? tab[v] : v;
+    }
+    return obj;
+  });
+}
+
+async function lerLista(resp) {
+  const json = await resp.json();
+  return Array.isArray(json) ? json : decodificarColunar(json);
+}
+
+// ============ CACHE LOCAL (IndexedDB) ============
+// Faturas e histórico ficam no IndexedDB (chave = id). Ao abrir a página a
+// tela sai direto do cache; depois /faturas/mudancas e /historico/mudancas
+// trazem só o que mudou desde o último cursor. Os filtros de transportadora,
+// número e vencimento rodam aqui sobre o cache (mesma regra do servidor).
+// Sem IndexedDB (modo privado, navegador antigo) funciona só em memória.
+
+const CACHE_DB = "mshop-cache";
+const CACHE_VERSAO = 1; // subir quando o formato dos itens mudar (recomeça do zero)
+
+const colecoes = {
+  faturas: { url: "/faturas/mudancas", itens: new Map(), cursor: null, lida: false, sincronizando: null },
+  historico: { url: "/historico/mudancas", itens: new Map(), cursor: null, lida: false, sincronizando: null },
+};
+
+let cacheDbPromise = null;
+
+function abrirCacheDb() {
+  if (cacheDbPromise) return cacheDbPromise;
+  cacheDbPromise = new Promise((resolve) => {
+    if (!window.indexedDB) return resolve(null);
+    let req;
+    try {
+      req = indexedDB.open(CACHE_DB, CACHE_VERSAO);
+    } catch (err) {
+      return resolve(null);
+    }
+    req.onupgradeneeded = () => {
+      const db = req.result;
+      Array.from(db.objectStoreNames).forEach((nome) => db.deleteObjectStore(nome));
+      db.createObjectStore("faturas", { keyPath: "id" });
+      db.createObjectStore("historico", { keyPath: "id" });
+      db.createObjectStore("meta");
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => resolve(null);
+    req.onblocked = () => resolve(null);
+  });
+  return cacheDbPromise;
+}
+
+function idbPedido(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+function idbFim(tx) {
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  });
+}
+
+// carrega do IndexedDB pra memória (uma vez por página)
+async function lerColecaoDoCache(nome) {
+  const col = colecoes[nome];
+  if (col.lida) return;
+  col.lida = true;
+
+  const db = await abrirCacheDb();
+  if (!db) return;
+  try {
+    const tx = db.transaction([nome, "meta"], "readonly");
+    const [itens, cursor] = await Promise.all([
+      idbPedido(tx.objectStore(nome).getAll()),
+      idbPedido(tx.objectStore("meta").get(nome)),
+    ]);
+    col.itens = new Map(itens.map((it) => [it.id, it]));
+    col.cursor = cursor || null;
+  } catch (err) {
+    console.warn("cache local indisponível:", err);
+  }
+}
+
+async function gravarNoCache(nome, { itens, removidos, cursor, resetar }) {
+  const db = await abrirCacheDb();
+  if (!db) return;
+  try {
+    const tx = db.transaction([nome, "meta"], "readwrite");
+    const store = tx.objectStore(nome);
+    if (resetar) store.clear();
+    itens.forEach((it) => store.put(it));
+    removidos.forEach((id) => store.delete(id));
+    tx.objectStore("meta").put(cursor, nome);
+    await idbFim(tx);
+  } catch (err) {
+    console.warn("falha ao gravar cache local:", err);
+  }
+}
+
+// busca só o que mudou; devolve true se algo mudou
+function sincronizarColecao(nome) {
+  const col = colecoes[nome];
+  if (col.sincronizando) return col.sincronizando;
+
+  col.sincronizando = (async () => {
+    const params = new URLSearchParams();
+    if (col.cursor) params.append("desde", col.cursor);
+    const resp = await apiFetch(`${API_BASE}${col.url}?${params.toString()}`);
+    if (!resp.ok) throw new Error(`Erro ao sincronizar ${nome}`);
+    const data = await resp.json();
+
+    if (data.resetar) col.itens = new Map();
+    data.itens.forEach((it) => col.itens.set(it.id, it));
+    data.removidos.forEach((id) => col.itens.delete(id));
+    col.cursor = data.cursor;
+
+    await gravarNoCache(nome, data);
+    return data.resetar || data.itens.length > 0 || data.removidos.length > 0;
+  })().finally(() => {
+    col.sincronizando = null;
+  });
+  return col.sincronizando;
+}
+
+async function limparCacheLocal() {
+  Object.values(colecoes).forEach((col) => {
+    col.itens = new Map();
+    col.cursor = null;
+  });
+  const db = await abrirCacheDb();
+  if (!db) return;
+  try {
+    const tx = db.transaction(["faturas", "historico", "meta"], "readwrite");
+    ["faturas", "historico", "meta"].forEach((n) => tx.objectStore(n).clear());
+    await idbFim(tx);
+  } catch (err) {
+    console.warn("falha ao limpar cache local:", err);
+  }
+}
+
+function contemTexto(valor, termo) {
+  return String(valor ?? "").toLowerCase().includes(termo.toLowerCase());
+}
+
+// mesmos filtros do GET /faturas (ILIKE %x% e faixa de vencimento), id desc
+function faturasDoCache() {
+  return Array.from(colecoes.faturas.itens.values())
+    .filter(
+      (f) =>
+        (!filtroTransportadora || contemTexto(f.transportadora, filtroTransportadora)) &&
+        (!filtroNumeroFatura || contemTexto(f.numero_fatura, filtroNumeroFatura)) &&
+        (!filtroVencimentoDe || (f.data_vencimento && f.data_vencimento >= filtroVencimentoDe)) &&
+        (!filtroVencimentoAte || (f.data_vencimento && f.data_vencimento <= filtroVencimentoAte))
+    )
+    .sort((a, b) => b.id - a.id);
+}
+
+// mesmo filtro do GET /historico_pagamentos, pago_em desc
+function historicoDoCache() {
+  return Array.from(colecoes.historico.itens.values())
+    .filter((h) => !filtroTransportadora || contemTexto(h.transportadora, filtroTransportadora))
+    .map((h) => [Date.parse(h.pago_em) || 0, h])
+    .sort((a, b) => b[0] - a[0])
+    .map(([, h]) => h);
+}
+
 // ============ PERFIL / AUTH ============
 
 async function carregarMe() {
@@ -105,7 +331,9 @@ async function carregarMe() {
   }
 }
 
-function logout() {
+async function logout() {
+  // não deixa faturas no navegador depois de sair
+  await limparCacheLocal();
   // seu backend tem GET /logout (não existe /auth/logout POST)
   window.location.href = "/logout";
 }
@@ -172,14 +400,12 @@ async function carregarDashboard() {
 
     let lista = Array.isArray(ultimaListaFaturas) ? [...ultimaListaFaturas] : [];
     if (lista.length === 0) {
-      const urlF =
-        params.toString().length > 0
-          ? `${API_BASE}/faturas?${params.toString()}`
-          : `${API_BASE}/faturas`;
+      const paramsF = new URLSearchParams(params);
+      paramsF.append("format", "columns");
 
-      const respFat = await apiFetch(urlF);
+      const respFat = await apiFetch(`${API_BASE}/faturas?${paramsF.toString()}`);
       if (!respFat.ok) throw new Error("Erro ao buscar faturas");
-      lista = await respFat.json();
+      lista = await lerLista(respFat);
       ultimaListaFaturas = lista;
     }
 
@@ -517,99 +743,238 @@ function renderResumoDashboardPago(lista) {
   tbody.appendChild(trTotal);
 }
 
-// ============ FATURAS (LISTA + RESUMO) ============
+// ============ TABELA VIRTUAL ============
+// Só as linhas na tela (mais uma folga) existem no DOM. Duas linhas
+// espaçadoras no topo e no fim ocupam a altura do resto, e as <tr> são
+// reaproveitadas no scroll: só o texto das células muda. A altura da
+// linha é fixa (medida na primeira; o CSS corta texto longo numa linha).
 
-async function carregarFaturas() {
-  try {
-    const params = new URLSearchParams();
-    if (filtroTransportadora) params.append("transportadora", filtroTransportadora);
-    if (filtroVencimentoDe) params.append("de_vencimento", filtroVencimentoDe);
-    if (filtroVencimentoAte) params.append("ate_vencimento", filtroVencimentoAte);
-    if (filtroNumeroFatura) params.append("numero_fatura", filtroNumeroFatura);
+const VIRTUAL_FOLGA = 15;
+const VIRTUAL_LINHAS_OCULTA = 50; // aba escondida: desenha só o começo
 
-    const url =
-      params.toString().length > 0
-        ? `${API_BASE}/faturas?${params.toString()}`
-        : `${API_BASE}/faturas`;
+function criarTabelaVirtual(tbody, { colunas, criarLinha, preencherLinha, vazio }) {
+  tbody.classList.add("tabela-virtual");
 
-    const resp = await apiFetch(url);
-    if (!resp.ok) throw new Error("Erro ao listar faturas");
+  const espacador = () => {
+    const tr = document.createElement("tr");
+    tr.className = "virtual-espaco";
+    const td = document.createElement("td");
+    td.colSpan = colunas;
+    tr.appendChild(td);
+    return tr;
+  };
+  const topo = espacador();
+  const fundo = espacador();
+
+  const linhaVazia = document.createElement("tr");
+  const tdVazia = document.createElement("td");
+  tdVazia.colSpan = colunas;
+  tdVazia.textContent = vazio;
+  tdVazia.style.textAlign = "center";
+  tdVazia.style.padding = "12px";
+  linhaVazia.appendChild(tdVazia);
+
+  let itens = [];
+  let alturaLinha = 0;
+  let passoMedido = false;
+  let inicio = -1;
+  let fim = -1;
+  const pool = [];
+  let agendado = false;
 
-    const faturas = await resp.json();
-    ultimaListaFaturas = faturas;
+  tbody.innerHTML = "";
+  tbody.append(topo, fundo);
 
-    renderizarFaturas();
-    await carregarDashboard();
-  } catch (err) {
-    console.error(err);
-    alert("Erro ao carregar faturas");
+  function faixaVisivel() {
+    const n = itens.length;
+    if (!alturaLinha || tbody.offsetParent === null) {
+      return [0, Math.min(n, VIRTUAL_LINHAS_OCULTA)];
+    }
+    const rect = tbody.getBoundingClientRect();
+    const primeira = Math.floor(Math.max(0, -rect.top) / alturaLinha);
+    const cabem = Math.ceil(window.innerHeight / alturaLinha);
+    const ini = Math.max(0, primeira - VIRTUAL_FOLGA);
+    return [ini, Math.min(n, primeira + cabem + VIRTUAL_FOLGA)];
   }
-}
 
-function renderizarFaturas() {
-  const tbody = document.getElementById("tbodyFaturas");
-  if (!tbody) return;
+  function desenhar(forcar = false) {
+    agendado = false;
+    const n = itens.length;
 
-  tbody.innerHTML = "";
+    if (n === 0) {
+      pool.forEach((tr) => tr.remove());
+      pool.length = 0;
+      topo.style.height = fundo.style.height = "0px";
+      if (!linhaVazia.isConnected) tbody.insertBefore(linhaVazia, fundo);
+      inicio = fim = -1;
+      return;
+    }
+    linhaVazia.remove();
 
-  let lista = Array.isArray(ultimaListaFaturas) ? [...ultimaListaFaturas] : [];
+    // mede a altura com uma linha de verdade
+    if (!alturaLinha && tbody.offsetParent !== null) {
+      if (!pool.length) {
+        pool.push(criarLinha());
+        tbody.insertBefore(pool[0], fundo);
+      }
+      preencherLinha(pool[0], itens[0]);
+      alturaLinha = pool[0].getBoundingClientRect().height || 0;
+    }
 
-  if (filtroDataInicioFaturas || filtroDataFimFaturas) {
-    lista = lista.filter((f) => {
-      if (!f.data_vencimento) return false;
-      const d = parseISODateLocal(f.data_vencimento);
-      if (!d) return false;
-      const time = d.setHours(0, 0, 0, 0);
+    const [ini, fimNovo] = faixaVisivel();
+    if (!forcar && ini === inicio && fimNovo === fim) return;
+    if (ini !== inicio || fimNovo !== fim) fecharTodosMenus();
+    inicio = ini;
+    fim = fimNovo;
+
+    const qtd = fim - inicio;
+    while (pool.length < qtd) {
+      const tr = criarLinha();
+      tbody.insertBefore(tr, fundo);
+      pool.push(tr);
+    }
+    while (pool.length > qtd) pool.pop().remove();
 
-      if (filtroDataInicioFaturas) {
-        const dIni = parseISODateLocal(filtroDataInicioFaturas);
-        if (!dIni) return false;
-        const ini = dIni.setHours(0, 0, 0, 0);
-        if (time < ini) return false;
-      }
+    for (let i = 0; i < qtd; i++) preencherLinha(pool[i], itens[inicio + i]);
 
-      if (filtroDataFimFaturas) {
-        const dFim = parseISODateLocal(filtroDataFimFaturas);
-        if (!dFim) return false;
-        const fim = dFim.setHours(0, 0, 0, 0);
-        if (time > fim) return false;
-      }
+    // a altura de verdade é o passo entre linhas: com border-collapse a
+    // primeira linha sozinha mede meia borda a menos que as outras
+    if (!passoMedido && qtd > 1 && tbody.offsetParent !== null) {
+      const passo = (pool[qtd - 1].getBoundingClientRect().top - pool[0].getBoundingClientRect().top) / (qtd - 1);
+      if (passo > 0) alturaLinha = passo;
+      passoMedido = true;
+    }
+
+    const h = alturaLinha || 0;
+    topo.style.height = `${inicio * h}px`;
+    fundo.style.height = `${(n - fim) * h}px`;
+  }
+
+  function agendar() {
+    if (agendado || !itens.length) return;
+    agendado = true;
+    requestAnimationFrame(() => desenhar());
+  }
 
-      return true;
+  window.addEventListener("scroll", agendar, { passive: true });
+  window.addEventListener("resize", () => {
+    alturaLinha = 0; // quebra de layout pode mudar a altura
+    passoMedido = false;
+    agendar();
+  });
+
+  return {
+    definirItens(novos) {
+      itens = novos;
+      desenhar(true);
+    },
+    redesenhar() {
+      desenhar(true);
+    },
+  };
+}
+
+let tabelaFaturas = null;
+let tabelaHistorico = null;
+
+function iniciarTabelasVirtuais() {
+  const tbodyF = document.getElementById("tbodyFaturas");
+  if (tbodyF) {
+    tabelaFaturas = criarTabelaVirtual(tbodyF, {
+      colunas: 10,
+      criarLinha: criarLinhaFatura,
+      preencherLinha: preencherLinhaFatura,
+      vazio: "Nenhuma fatura encontrada.",
+    });
+  }
+  const tbodyH = document.getElementById("tbodyHistorico");
+  if (tbodyH) {
+    tabelaHistorico = criarTabelaVirtual(tbodyH, {
+      colunas: 8,
+      criarLinha: criarLinhaHistorico,
+      preencherLinha: preencherLinhaHistorico,
+      vazio: "Nenhum pagamento registrado.",
     });
   }
+}
+
+// ============ FATURAS (LISTA + RESUMO) ============
+
+async function carregarFaturas() {
+  const col = colecoes.faturas;
+  let mostrouCache = false;
 
-  if (filtroStatus) {
-    const alvo = filtroStatus.toLowerCase();
-    lista = lista.filter((f) => (f.status || "").toLowerCase() === alvo);
+  try {
+    // desenha na hora com o que já temos (IndexedDB na primeira vez,
+    // memória quando só o filtro mudou); a rede vem depois
+    if (!col.lida) await lerColecaoDoCache("faturas");
+    if (col.itens.size > 0 || col.cursor) {
+      ultimaListaFaturas = faturasDoCache();
+      renderizarFaturas();
+      mostrouCache = true;
+    }
+
+    const mudou = await sincronizarColecao("faturas");
+    if (mudou || !mostrouCache) {
+      ultimaListaFaturas = faturasDoCache();
+      renderizarFaturas();
+    }
+    await carregarDashboard();
+  } catch (err) {
+    console.error(err);
+    // offline com cache: segue com o que já está na tela
+    if (!mostrouCache) alert("Erro ao carregar faturas");
   }
+}
+
+function hojeISOLocal() {
+  const d = new Date();
+  const mm = String(d.getMonth() + 1).padStart(2, "0");
+  const dd = String(d.getDate()).padStart(2, "0");
+  return `${d.getFullYear()}-${mm}-${dd}`;
+}
+
+// filtros da tela comparam as datas como texto AAAA-MM-DD (mesma ordem
+// cronológica), sem criar Date por item
+function renderizarFaturas() {
+  if (!tabelaFaturas) return;
+
+  const ini = filtroDataInicioFaturas;
+  const fim = filtroDataFimFaturas;
+  const alvo = filtroStatus ? filtroStatus.toLowerCase() : "";
+  const base = Array.isArray(ultimaListaFaturas) ? ultimaListaFaturas : [];
+
+  const lista =
+    ini || fim || alvo
+      ? base.filter((f) => {
+          if (ini || fim) {
+            const v = f.data_vencimento;
+            if (!v || (ini && v < ini) || (fim && v > fim)) return false;
+          }
+          return !alvo || (f.status || "").toLowerCase() === alvo;
+        })
+      : base;
 
   let total = 0;
   let pendentes = 0;
   let atrasadas = 0;
   let pagas = 0;
+  const hoje = hojeISOLocal();
 
-  const hoje = new Date();
-  hoje.setHours(0, 0, 0, 0);
-  const hojeTime = hoje.getTime();
-
-  lista.forEach((f) => {
+  for (const f of lista) {
     const valor = Number(f.valor || 0);
     total += valor;
 
     const status = (f.status || "").toLowerCase();
-    const d = parseISODateLocal(f.data_vencimento);
-    const vencTime = d ? d.setHours(0, 0, 0, 0) : null;
-
     if (status === "pago") {
       pagas += valor;
     } else if (status === "pendente") {
-      if (vencTime !== null && vencTime < hojeTime) atrasadas += valor;
+      if (f.data_vencimento && f.data_vencimento < hoje) atrasadas += valor;
       else pendentes += valor;
     } else if (status === "atrasado") {
       atrasadas += valor;
     }
-  });
+  }
 
   const elTotal = document.getElementById("fatTotal");
   const elPend = document.getElementById("fatPendentes");
@@ -620,117 +985,95 @@ function renderizarFaturas() {
   if (elAtr) elAtr.textContent = formatCurrency(atrasadas);
   if (elPag) elPag.textContent = formatCurrency(pagas);
 
-  if (lista.length === 0) {
-    const tr = document.createElement("tr");
-    const td = document.createElement("td");
-    td.colSpan = 10;
-    td.textContent = "Nenhuma fatura encontrada.";
-    td.style.textAlign = "center";
-    td.style.padding = "12px";
-    tr.appendChild(td);
-    tbody.appendChild(tr);
-    return;
-  }
+  fecharTodosMenus();
+  tabelaFaturas.definirItens(lista);
+}
 
-  lista.forEach((f) => {
-    const tr = document.createElement("tr");
-    tr.dataset.faturaId = f.id;
-
-    tr.innerHTML = `
-      <td>${f.id}</td>
-      <td>${f.transportadora}</td>
-      <td>${f.responsavel ?? ""}</td>
-      <td>${f.numero_fatura}</td>
-      <td>${formatCurrency(f.valor)}</td>
-      <td>${formatDate(f.data_vencimento)}</td>
-      <td>${f.status}</td>
-      <td>${f.observacao ?? ""}</td>
-      <td>${f.data_pagamento ? formatDate(f.data_pagamento) : "-"}</td>
-      <td class="acoes">
-        <button type="button" class="menu-btn" aria-label="Ações">⋮</button>
-        <div class="menu-dropdown">
-          <button type="button" data-acao="editar">Editar</button>
-          <button type="button" data-acao="excluir">Excluir</button>
-          <button type="button" data-acao="anexos">Anexos</button>
-        </div>
-      </td>
-    `;
+function criarLinhaFatura() {
+  const tr = document.createElement("tr");
+  for (let i = 0; i < 9; i++) tr.appendChild(document.createElement("td"));
+  const acoes = document.createElement("td");
+  acoes.className = "acoes";
+  acoes.innerHTML = `
+    <button type="button" class="menu-btn" aria-label="Ações">⋮</button>
+    <div class="menu-dropdown">
+      <button type="button" data-acao="editar">Editar</button>
+      <button type="button" data-acao="excluir">Excluir</button>
+      <button type="button" data-acao="anexos">Anexos</button>
+    </div>
+  `;
+  tr.appendChild(acoes);
+  return tr;
+}
 
-    tbody.appendChild(tr);
-  });
+function preencherLinhaFatura(tr, f) {
+  tr.dataset.faturaId = f.id;
+  const c = tr.cells;
+  c[0].textContent = f.id;
+  c[1].textContent = f.transportadora;
+  c[2].textContent = f.responsavel ?? "";
+  c[3].textContent = f.numero_fatura;
+  c[4].textContent = formatCurrency(f.valor);
+  c[5].textContent = formatDate(f.data_vencimento);
+  c[6].textContent = f.status;
+  c[7].textContent = f.observacao ?? "";
+  c[7].title = f.observacao ?? "";
+  c[8].textContent = f.data_pagamento ? formatDate(f.data_pagamento) : "-";
 }
 
 // ============ HISTÓRICO ============
 
 async function carregarHistorico() {
-  try {
-    const params = new URLSearchParams();
-    if (filtroTransportadora) params.append("transportadora", filtroTransportadora);
-
-    const url =
-      params.toString().length > 0
-        ? `${API_BASE}/historico_pagamentos?${params.toString()}`
-        : `${API_BASE}/historico_pagamentos`;
-
-    const resp = await apiFetch(url);
-    if (!resp.ok) throw new Error("Erro ao listar histórico");
+  const col = colecoes.historico;
+  let mostrouCache = false;
 
-    const hist = await resp.json();
-    ultimaListaHistorico = hist;
+  try {
+    if (!col.lida) await lerColecaoDoCache("historico");
+    if (col.itens.size > 0 || col.cursor) {
+      ultimaListaHistorico = historicoDoCache();
+      renderizarHistorico();
+      mostrouCache = true;
+    }
 
-    renderizarHistorico();
+    const mudou = await sincronizarColecao("historico");
+    if (mudou || !mostrouCache) {
+      ultimaListaHistorico = historicoDoCache();
+      renderizarHistorico();
+    }
   } catch (err) {
     console.error(err);
-    alert("Erro ao carregar histórico");
+    if (!mostrouCache) alert("Erro ao carregar histórico");
   }
 }
 
 function renderizarHistorico() {
-  const tbody = document.getElementById("tbodyHistorico");
-  if (!tbody) return;
-
-  tbody.innerHTML = "";
-
-  const lista = Array.isArray(ultimaListaHistorico) ? [...ultimaListaHistorico] : [];
+  if (!tabelaHistorico) return;
+  tabelaHistorico.definirItens(Array.isArray(ultimaListaHistorico) ? ultimaListaHistorico : []);
+}
 
-  if (lista.length === 0) {
-    const tr = document.createElement("tr");
-    const td = document.createElement("td");
-    td.colSpan = 8;
-    td.textContent = "Nenhum pagamento registrado.";
-    td.style.textAlign = "center";
-    td.style.padding = "12px";
-    tr.appendChild(td);
-    tbody.appendChild(tr);
-    return;
-  }
+function criarLinhaHistorico() {
+  const tr = document.createElement("tr");
+  for (let i = 0; i < 8; i++) tr.appendChild(document.createElement("td"));
+  return tr;
+}
 
-  lista.forEach((h) => {
-    const tr = document.createElement("tr");
-    tr.innerHTML = `
-      <td>${h.id}</td>
-      <td>${h.fatura_id}</td>
-      <td>${h.transportadora}</td>
-      <td>${h.responsavel ?? ""}</td>
-      <td>${h.numero_fatura}</td>
-      <td>${formatCurrency(h.valor)}</td>
-      <td>${formatDate(h.data_vencimento)}</td>
-      <td>${formatDateTime(h.pago_em)}</td>
-    `;
-    tbody.appendChild(tr);
-  });
+function preencherLinhaHistorico(tr, h) {
+  const c = tr.cells;
+  c[0].textContent = h.id;
+  c[1].textContent = h.fatura_id;
+  c[2].textContent = h.transportadora;
+  c[3].textContent = h.responsavel ?? "";
+  c[4].textContent = h.numero_fatura;
+  c[5].textContent = formatCurrency(h.valor);
+  c[6].textContent = formatDate(h.data_vencimento);
+  c[7].textContent = formatDateTime(h.pago_em);
 }
 
 function exportarHistorico() {
-  const params = new URLSearchParams();
-  if (filtroTransportadora) params.append("transportadora", filtroTransportadora);
-
-  const url =
-    params.toString().length > 0
-      ? `${API_BASE}/historico_pagamentos/exportar?${params.toString()}`
-      : `${API_BASE}/historico_pagamentos/exportar`;
+  const filtros = {};
+  if (filtroTransportadora) filtros.transportadora = filtroTransportadora;
 
-  window.open(url, "_blank");
+  exportarAssincrono("historico", filtros, document.getElementById("btnExportarHistorico"));
 }
 
 // ============ MENU 3 PONTINHOS (DELEGAÇÃO) ============
@@ -812,7 +1155,7 @@ function setupMenuDelegation() {
       const id = tr ? tr.dataset.faturaId : null;
       if (!id) return;
 
-      const faturaObj = (ultimaListaFaturas || []).find((f) => String(f.id) === String(id));
+      const faturaObj = colecoes.faturas.itens.get(Number(id));
 
       if (acao === "excluir") {
         await excluirFatura(id);
@@ -941,6 +1284,16 @@ async function salvarFatura(e) {
     observacao: document.getElementById("inputObservacao").value || null,
   };
 
+  // mesma tentativa (mesmos dados e arquivos) = mesma chave; mudou algo = chave nova
+  const inputAnexos = document.getElementById("inputAnexos");
+  const arquivos = Array.from(inputAnexos?.files || []).map((f) => `${f.name}:${f.size}:${f.lastModified}`);
+  const assinatura = JSON.stringify([editId, payload, arquivos]);
+  if (form.dataset.idemAssinatura !== assinatura) {
+    form.dataset.idemAssinatura = assinatura;
+    form.dataset.idemChave = novaChaveIdempotencia();
+  }
+  const chave = form.dataset.idemChave;
+
   try {
     let resp;
 
@@ -951,26 +1304,30 @@ async function salvarFatura(e) {
         body: JSON.stringify(payload),
       });
     } else {
-      resp = await apiFetch(`${API_BASE}/faturas`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify(payload),
-      });
+      resp = await fetchIdempotente(
+        `${API_BASE}/faturas`,
+        {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify(payload),
+        },
+        chave
+      );
     }
 
     if (!resp.ok) throw new Error("Erro ao salvar fatura");
 
     const fatura = await resp.json();
 
-    const inputAnexos = document.getElementById("inputAnexos");
     if (inputAnexos && inputAnexos.files && inputAnexos.files.length > 0) {
       const fd = new FormData();
       for (const file of inputAnexos.files) fd.append("files", file);
 
-      const respAnexos = await apiFetch(`${API_BASE}/faturas/${fatura.id}/anexos`, {
-        method: "POST",
-        body: fd,
-      });
+      const respAnexos = await fetchIdempotente(
+        `${API_BASE}/faturas/${fatura.id}/anexos`,
+        { method: "POST", body: fd },
+        `${chave}:anexos`
+      );
 
       if (!respAnexos.ok) {
         let detalhe = "";
@@ -997,6 +1354,8 @@ async function salvarFatura(e) {
 
     form.reset();
     if (form?.dataset?.editId) delete form.dataset.editId;
+    delete form.dataset.idemChave;
+    delete form.dataset.idemAssinatura;
 
     await carregarFaturas();
     await carregarHistorico();
@@ -1048,23 +1407,58 @@ function ativarAba(aba) {
 }
 
 // ============ EXPORTAR EXCEL (CSV) ============
+// O CSV é gerado em background (POST /exportacoes); aqui só acompanha o
+// progresso e baixa pela URL do R2 quando fica pronto.
 
-function exportarExcel() {
-  const params = new URLSearchParams();
-  if (filtroTransportadora) params.append("transportadora", filtroTransportadora);
-  if (filtroNumeroFatura) params.append("numero_fatura", filtroNumeroFatura);
+async function exportarAssincrono(tipo, filtros, botao) {
+  const textoOriginal = botao?.textContent;
+  if (botao) botao.disabled = true;
+
+  try {
+    const resp = await apiFetch(`${API_BASE}/exportacoes`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ tipo, filtros }),
+    });
+    if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+    let exp = await resp.json();
+
+    for (let i = 0; exp.estado === "pendente" || exp.estado === "executando"; i++) {
+      if (botao) {
+        botao.textContent =
+          exp.progresso != null ? `Exportando... ${Math.round(exp.progresso * 100)}%` : "Exportando...";
+      }
+      await esperar(Math.min(1000 + i * 250, 3000));
+      const r = await apiFetch(`${API_BASE}/exportacoes/${exp.id}`);
+      if (!r.ok) throw new Error(`HTTP ${r.status}`);
+      exp = await r.json();
+    }
 
-  const url =
-    params.toString().length > 0
-      ? `${API_BASE}/faturas/exportar?${params.toString()}`
-      : `${API_BASE}/faturas/exportar`;
+    if (exp.estado !== "concluida" || !exp.url) throw new Error(exp.erro || "exportação falhou");
+    window.location.href = exp.url; // Content-Disposition: attachment, não sai da página
+  } catch (err) {
+    console.error(err);
+    alert("Erro ao exportar");
+  } finally {
+    if (botao) {
+      botao.disabled = false;
+      botao.textContent = textoOriginal;
+    }
+  }
+}
+
+function exportarExcel() {
+  const filtros = {};
+  if (filtroTransportadora) filtros.transportadora = filtroTransportadora;
+  if (filtroNumeroFatura) filtros.numero_fatura = filtroNumeroFatura;
 
-  window.open(url, "_blank");
+  exportarAssincrono("faturas", filtros, document.getElementById("btnExportarExcel"));
 }
 
 // ============ INIT ============
 
 document.addEventListener("DOMContentLoaded", async () => {
+  iniciarTabelasVirtuais();
   setupMenuDelegation();
 
   // tabs
@@ -0,0 +1,134 @@
+"""Fixtures dos testes.
+
+As partes em Python puro (balde de fichas, formato colunar, fila da
+auditoria...) rodam sem nada. As que precisam de Postgres usam
+TEST_DATABASE_URL e são puladas sem ele. Os testes criam e APAGAM schemas
+próprios (mshop_testes*) nesse banco; no public só entra a extensão
+unaccent (se houver permissão).
+
+    TEST_DATABASE_URL=postgresql://localhost/mshop_testes python -m pytest -q
+"""
+import os
+import sys
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+# antes do import do main: ele lê a config do ambiente uma vez só
+os.environ.setdefault("SESSION_SECRET", "segredo-dos-testes")
+os.environ.setdefault("PBKDF2_ITERS", "1000")
+os.environ.setdefault("TAREFAS_INPROCESS", "0")
+os.environ.setdefault("LIMITE_ATIVO", "0")
+os.environ.setdefault("CACHE_TTL_S", "0")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine, text  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "").strip()
+
+def preparar_banco(admin):
+    # extensão fica no public (senão a migração 2 instala no primeiro schema
+    # de teste e some com ele); sem permissão a busca só não tira acento
+    try:
+        with admin.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent SCHEMA public"))
+    except Exception:
+        pass
+
+def engine_no_schema(schema: str):
+    # o public fica no search_path pra achar extensões já instaladas (unaccent)
+    return create_engine(
+        TEST_DATABASE_URL,
+        pool_pre_ping=True,
+        connect_args={"options": f"-csearch_path={schema},public"},
+    )
+
+@pytest.fixture
+def schema_vazio(monkeypatch):
+    """Engine do main apontando pra um schema novo e vazio (sem migrações)."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL não configurada")
+    schema = f"mshop_testes_{uuid.uuid4().hex[:8]}"
+    admin = create_engine(TEST_DATABASE_URL)
+    preparar_banco(admin)
+    with admin.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+    eng = engine_no_schema(schema)
+    monkeypatch.setattr(main, "DATABASE_URL", TEST_DATABASE_URL)
+    monkeypatch.setattr(main, "_engine", eng)
+    try:
+        yield eng
+    finally:
+        eng.dispose()
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+        admin.dispose()
+
+@pytest.fixture(scope="session")
+def _engine_migrado():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL não configurada")
+    admin = create_engine(TEST_DATABASE_URL)
+    preparar_banco(admin)
+    with admin.begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS mshop_testes CASCADE"))
+        conn.execute(text("CREATE SCHEMA mshop_testes"))
+    eng = engine_no_schema("mshop_testes")
+    antigo = main._engine
+    main._engine = eng
+    try:
+        main.run_migrations()
+    finally:
+        main._engine = antigo
+    yield eng
+    eng.dispose()
+    admin.dispose()
+
+@pytest.fixture
+def banco(_engine_migrado, monkeypatch):
+    """Engine do main num schema já migrado; as tabelas começam vazias."""
+    monkeypatch.setattr(main, "DATABASE_URL", TEST_DATABASE_URL)
+    monkeypatch.setattr(main, "_engine", _engine_migrado)
+    tabelas = ", ".join(t.name for t in main.Base.metadata.sorted_tables)
+    with _engine_migrado.begin() as conn:
+        conn.execute(text(f"TRUNCATE {tabelas} RESTART IDENTITY CASCADE"))
+    for topico in list(main._caches):
+        main.invalidar_local(topico)
+    yield _engine_migrado
+    main.gravar_auditoria()  # não deixa fila de um teste vazar pro próximo
+
+def criar_usuario(username: str = "ana", role: str = "user") -> int:
+    salt, pwd_hash = main.hash_password("senha-dos-testes")
+    with main.new_session() as db:
+        u = main.UserDB(
+            username=username,
+            role=role,
+            pwd_salt=salt,
+            pwd_hash=pwd_hash,
+            must_change_password=0,
+            password_expires_at=main.agora_br() + timedelta(days=30),
+            created_at=main.agora_br(),
+        )
+        db.add(u)
+        db.commit()
+        return u.id
+
+def entrar(cliente: TestClient, user_id: int, validade_s: int = 3600) -> TestClient:
+    """Cookies de sessão assinados direto (sem passar pelo PBKDF2 do /login)."""
+    agora = int(main.agora_br().timestamp())
+    csrf = main.make_csrf_token()
+    sessao = main.sign_data({"uid": user_id, "iat": agora, "exp": agora + validade_s, "csrf": csrf}, main.SESSION_SECRET)
+    cliente.cookies.set(main.COOKIE_NAME, sessao)
+    cliente.cookies.set(main.CSRF_COOKIE, csrf)
+    cliente.headers["X-CSRF-Token"] = csrf
+    return cliente
+
+@pytest.fixture
+def cliente(banco):
+    """TestClient logado como usuário comum (sem o lifespan: nada de threads)."""
+    return entrar(TestClient(main.app), criar_usuario())
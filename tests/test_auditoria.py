@@ -0,0 +1,135 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+class EngineFalso:
+    """Guarda o que seria o INSERT em lote; falhar=True simula banco fora."""
+
+    def __init__(self):
+        self.lotes = []
+        self.falhar = False
+        self.gravou = threading.Event()
+
+    @contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, stmt, linhas):
+        if self.falhar:
+            raise RuntimeError("banco fora")
+        self.lotes.append(list(linhas))
+        self.gravou.set()
+
+@pytest.fixture
+def fila(monkeypatch):
+    eng = EngineFalso()
+    monkeypatch.setattr(main, "get_engine", lambda: eng)
+    monkeypatch.setattr(main, "_auditoria_pendentes", [])
+    monkeypatch.setattr(main, "_garantir_gravador_auditoria", lambda: None)
+    return eng
+
+def test_diff_so_traz_campos_alterados():
+    antes = {"valor": 10.0, "status": "pendente", "observacao": None}
+    depois = {"valor": 12.5, "status": "pendente", "observacao": None}
+    assert main.diff_fatura(antes, depois) == {"valor": [10.0, 12.5]}
+
+def test_diff_de_criacao_e_remocao():
+    foto = {"numero_fatura": "NF1", "valor": 1.0}
+    assert main.diff_fatura({}, foto) == {"numero_fatura": [None, "NF1"], "valor": [None, 1.0]}
+    assert main.diff_fatura(foto, {}) == {"numero_fatura": ["NF1", None], "valor": [1.0, None]}
+
+def test_foto_converte_decimal_e_data():
+    f = SimpleNamespace(
+        transportadora="DHL", numero_fatura="NF1", valor=Decimal("10.50"),
+        data_vencimento=date(2026, 1, 2), status="pago", observacao=None, data_pagamento=None,
+    )
+    foto = main.foto_fatura(f)
+    assert foto["valor"] == 10.5
+    assert foto["data_vencimento"] == "2026-01-02"
+    assert set(foto) == set(main.AUDITORIA_CAMPOS)
+
+def test_autor_lido_do_usuario():
+    assert main.autor_auditoria(SimpleNamespace(id=7, username="ana")) == (7, "ana")
+    assert main.autor_auditoria(None) == (None, None)
+
+def test_sem_mudanca_nao_entra_na_fila(fila):
+    main.registrar_auditoria(1, "atualizar", {})
+    assert main._auditoria_pendentes == []
+
+def test_grava_a_fila_num_lote_so(fila):
+    main.registrar_auditoria(1, "criar", {"valor": [None, 1.0]}, (7, "ana"))
+    main.registrar_auditoria(2, "atualizar", {"status": ["pendente", "pago"]})
+
+    assert main.gravar_auditoria() == 2
+    assert len(fila.lotes) == 1
+    primeiro, segundo = fila.lotes[0]
+    assert (primeiro["fatura_id"], primeiro["acao"], primeiro["usuario_id"], primeiro["usuario"]) == (1, "criar", 7, "ana")
+    assert (segundo["usuario_id"], segundo["usuario"]) == (None, None)
+    assert main._auditoria_pendentes == []
+    assert main.gravar_auditoria() == 0  # fila vazia não vai ao banco
+    assert len(fila.lotes) == 1
+
+def test_falha_devolve_o_lote_na_frente(fila):
+    main.registrar_auditoria(1, "atualizar", {"valor": [1, 2]})
+    fila.falhar = True
+    assert main.gravar_auditoria() == 0
+    main.registrar_auditoria(2, "atualizar", {"valor": [2, 3]})
+
+    fila.falhar = False
+    assert main.gravar_auditoria() == 2
+    assert [i["fatura_id"] for i in fila.lotes[0]] == [1, 2]
+
+def test_fila_cheia_descarta_os_mais_antigos(fila, monkeypatch):
+    monkeypatch.setattr(main, "AUDITORIA_MAX_PENDENTES", 3)
+    for fid in range(1, 6):
+        main.registrar_auditoria(fid, "atualizar", {"valor": [0, fid]})
+    assert [i["fatura_id"] for i in main._auditoria_pendentes] == [3, 4, 5]
+
+def test_thread_grava_ao_juntar_um_lote(monkeypatch):
+    eng = EngineFalso()
+    monkeypatch.setattr(main, "get_engine", lambda: eng)
+    monkeypatch.setattr(main, "_auditoria_pendentes", [])
+    monkeypatch.setattr(main, "AUDITORIA_FLUSH_S", 30.0)  # só o lote cheio acorda a thread
+    monkeypatch.setattr(main, "AUDITORIA_LOTE", 3)
+    monkeypatch.setattr(main, "_auditoria_acordar", threading.Event())
+    try:
+        for fid in range(3):
+            main.registrar_auditoria(fid, "atualizar", {"valor": [0, 1]})
+        assert eng.gravou.wait(5)
+        assert [i["fatura_id"] for i in eng.lotes[0]] == [0, 1, 2]
+    finally:
+        main.parar_gravador_auditoria()
+
+def test_parar_esvazia_a_fila(monkeypatch):
+    eng = EngineFalso()
+    monkeypatch.setattr(main, "get_engine", lambda: eng)
+    monkeypatch.setattr(main, "_auditoria_pendentes", [])
+    monkeypatch.setattr(main, "AUDITORIA_FLUSH_S", 30.0)
+    main.registrar_auditoria(1, "remover", {"valor": [1, None]})
+    t0 = time.monotonic()
+    main.parar_gravador_auditoria()
+    assert time.monotonic() - t0 < 5
+    assert [i["fatura_id"] for lote in eng.lotes for i in lote] == [1]
+
+def test_api_registra_quem_mudou_o_que(cliente):
+    r = cliente.post("/faturas", json={
+        "transportadora": "DHL", "numero_fatura": "NF1", "valor": 10.5,
+        "data_vencimento": "2030-01-10", "status": "pendente",
+    })
+    assert r.status_code == 200, r.text
+    fid = r.json()["id"]
+    assert cliente.put(f"/faturas/{fid}", json={"valor": 12, "status": "pendente"}).status_code == 200
+    assert cliente.delete(f"/faturas/{fid}").status_code == 200
+
+    trilha = cliente.get(f"/faturas/{fid}/auditoria").json()
+    assert [t["acao"] for t in trilha] == ["remover", "atualizar", "criar"]
+    assert {t["usuario"] for t in trilha} == {"ana"}
+    assert trilha[1]["mudancas"] == {"valor": [10.5, 12.0]}
+    assert trilha[2]["mudancas"]["numero_fatura"] == [None, "NF1"]
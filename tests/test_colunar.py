@@ -0,0 +1,73 @@
+from datetime import date
+
+import orjson
+from starlette.requests import Request
+
+import main
+
+COLUNAS = ("id", "transportadora", "responsavel", "valor", "status")
+
+def requisicao(accept: str = "") -> Request:
+    headers = [(b"accept", accept.encode())] if accept else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "query_string": b""})
+
+def decodificar(corpo: dict) -> list:
+    """O que o app.js faz: índice do dicts[col] volta a ser o valor."""
+    itens = []
+    for row in corpo["rows"]:
+        item = {}
+        for c, v in zip(corpo["columns"], row):
+            if c in corpo["dicts"] and v is not None:
+                v = corpo["dicts"][c][v]
+            item[c] = v
+        itens.append(item)
+    return itens
+
+def test_colunas_repetidas_viram_indice():
+    itens = [
+        {"id": 1, "transportadora": "DHL", "responsavel": "Ana", "valor": 10.5, "status": "pago"},
+        {"id": 2, "transportadora": "GLM", "responsavel": None, "valor": 3.0, "status": "pendente"},
+        {"id": 3, "transportadora": "DHL", "responsavel": "Ana", "valor": 7.0, "status": "pago"},
+    ]
+    corpo = orjson.loads(main.colunar_response(itens, COLUNAS).body)
+
+    assert corpo["columns"] == list(COLUNAS)
+    assert corpo["dicts"] == {"transportadora": ["DHL", "GLM"], "responsavel": ["Ana"], "status": ["pago", "pendente"]}
+    assert corpo["rows"] == [[1, 0, 0, 10.5, 0], [2, 1, None, 3.0, 1], [3, 0, 0, 7.0, 0]]
+    assert decodificar(corpo) == itens
+
+def test_so_codifica_colunas_presentes():
+    itens = [{"id": 1, "pago_em": date(2026, 1, 2), "transportadora": "DHL"}]
+    corpo = orjson.loads(main.colunar_response(itens, ("id", "pago_em", "transportadora")).body)
+    assert set(corpo["dicts"]) == {"transportadora"}
+    assert corpo["rows"] == [[1, "2026-01-02", 0]]
+
+def test_lista_vazia():
+    corpo = orjson.loads(main.colunar_response([], COLUNAS).body)
+    assert corpo["rows"] == []
+    assert corpo["dicts"] == {"transportadora": [], "responsavel": [], "status": []}
+
+def test_resposta_varia_com_accept():
+    resp = main.colunar_response([], COLUNAS)
+    assert resp.headers["vary"] == "Accept"
+    assert resp.media_type == "application/json"
+
+def test_formato_pedido_por_parametro_ou_accept():
+    assert main.quer_colunar(requisicao(), "columns")
+    assert main.quer_colunar(requisicao(), " Columns ")
+    assert not main.quer_colunar(requisicao(main.COLUNAR_MEDIA_TYPE), "json")  # parâmetro manda
+    assert main.quer_colunar(requisicao(f"{main.COLUNAR_MEDIA_TYPE}, application/json"), None)
+    assert not main.quer_colunar(requisicao("application/json"), None)
+
+def test_api_colunar_igual_a_lista(cliente):
+    for i, (transp, status) in enumerate([("DHL", "pendente"), ("GLM", "pago"), ("DHL", "pago")]):
+        r = cliente.post("/faturas", json={
+            "transportadora": transp, "numero_fatura": f"NF{i}", "valor": 10 + i,
+            "data_vencimento": "2030-01-10", "status": status,
+        })
+        assert r.status_code == 200, r.text
+
+    lista = cliente.get("/faturas").json()
+    r = cliente.get("/faturas", params={"format": "columns"})
+    assert r.status_code == 200
+    assert decodificar(r.json()) == lista
@@ -0,0 +1,98 @@
+from datetime import date, datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import text
+
+import main
+
+# (id, transportadora, numero, valor, vencimento, status, pago_em no fuso BR)
+FATURAS = [
+    (1, "DHL", "NF-A", 100, "2030-01-10", "pendente", None),
+    (2, "GLM", "NF-B", 50, "2030-02-10", "atrasado", None),
+    (3, "DHL-SP", "NF-C", 300, "2030-03-10", "pago", datetime(2026, 3, 5, 12, 0)),
+    (4, "Pannan", "NF-D", 200, "2030-04-10", "PAGO", datetime(2026, 3, 6, 23, 30)),  # 02:30 UTC do dia 7
+    (5, "glm", "NF-E", 75, "2030-05-10", "pendente", None),
+]
+
+@pytest.fixture
+def faturas(cliente):
+    with main.get_engine().begin() as conn:
+        for fid, transp, numero, valor, venc, status, pago in FATURAS:
+            conn.execute(text("""
+                INSERT INTO faturas (id, transportadora, numero_fatura, valor, data_vencimento, status, data_pagamento)
+                VALUES (:id, :t, :n, :v, :d, :s, :p)
+            """), {"id": fid, "t": transp, "n": numero, "v": valor, "d": venc, "s": status,
+                   "p": pago.replace(tzinfo=main.BR_TZ) if pago else None})
+    return cliente
+
+def ids(cliente, **params) -> list:
+    r = cliente.get("/faturas", params=params)
+    assert r.status_code == 200, r.text
+    return [f["id"] for f in r.json()]
+
+def test_status_filtro_normaliza_a_lista():
+    assert main.status_filtro(" Pago, pendente ,,PAGO") == ["pago", "pendente"]
+    assert main.status_filtro("") == []
+    assert main.status_filtro(None) == []
+
+def test_data_invalida_e_ignorada():
+    assert main._data_filtro("2030-01-10") == date(2030, 1, 10)
+    assert main._data_filtro("10/01/2030") is None
+    assert main._data_filtro(None) is None
+
+def test_ordenacao_desconhecida_e_422():
+    with pytest.raises(HTTPException) as erro:
+        main.ordenar_faturas(None, "-senha")
+    assert erro.value.status_code == 422
+
+def test_filtro_de_status(faturas):
+    assert set(ids(faturas, status="pendente")) == {1, 5}
+    assert set(ids(faturas, status="pendente,atrasado")) == {1, 2, 5}
+    assert set(ids(faturas, status="Pago")) == {3, 4}  # sem diferenciar maiúsculas
+
+def test_faixa_de_vencimento(faturas):
+    assert set(ids(faturas, de_vencimento="2030-02-10", ate_vencimento="2030-04-10")) == {2, 3, 4}
+    assert len(ids(faturas, de_vencimento="lixo")) == 5
+
+def test_faixa_de_pagamento_no_dia_br(faturas):
+    assert ids(faturas, de_pagamento="2026-03-06", ate_pagamento="2026-03-06") == [4]
+    assert ids(faturas, ate_pagamento="2026-03-05") == [3]
+
+def test_transportadora_e_status_juntos(faturas):
+    assert set(ids(faturas, transportadora="dhl")) == {1, 3}
+    assert ids(faturas, transportadora="dhl", status="pago") == [3]
+
+@pytest.mark.parametrize("ordenar, esperado", [
+    (None, [5, 4, 3, 2, 1]),
+    ("valor", [2, 5, 1, 4, 3]),
+    ("-valor", [3, 4, 1, 5, 2]),
+    ("transportadora", [1, 3, 2, 5, 4]),
+    ("pagamento", [3, 4, 1, 2, 5]),  # sem pagamento vai pro fim
+    ("-pagamento", [4, 3, 5, 2, 1]),
+])
+def test_ordenacao(faturas, ordenar, esperado):
+    params = {"ordenar": ordenar} if ordenar else {}
+    assert ids(faturas, **params) == esperado
+
+def test_ordenacao_invalida_na_api(faturas):
+    r = faturas.get("/faturas", params={"ordenar": "senha"})
+    assert r.status_code == 422
+    assert "valor" in r.json()["detail"]
+
+def test_paginacao_com_total(faturas):
+    r = faturas.get("/faturas", params={"ordenar": "valor", "limit": 2, "offset": 1})
+    assert [f["id"] for f in r.json()] == [5, 1]
+    assert r.headers["X-Total-Count"] == "5"
+
+    r = faturas.get("/faturas", params={"status": "pago", "limit": 1})
+    assert len(r.json()) == 1
+    assert r.headers["X-Total-Count"] == "2"
+
+    assert "X-Total-Count" not in faturas.get("/faturas").headers
+
+def test_exportacao_usa_os_mesmos_filtros(faturas):
+    r = faturas.get("/faturas/exportar", params={"status": "pendente,atrasado"})
+    assert r.status_code == 200
+    linhas = [l for l in r.text.splitlines()[1:] if l.strip()]
+    assert len(linhas) == 3
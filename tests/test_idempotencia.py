@@ -0,0 +1,88 @@
+import hashlib
+
+import orjson
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+import main
+from conftest import criar_usuario, entrar
+
+def corpo_fatura(numero: str = "NF1") -> bytes:
+    return orjson.dumps({
+        "transportadora": "DHL", "numero_fatura": numero, "valor": 10.5,
+        "data_vencimento": "2030-01-10", "status": "pendente",
+    })
+
+def postar(cliente, chave: str, corpo: bytes):
+    return cliente.post(
+        "/faturas",
+        content=corpo,
+        headers={"Idempotency-Key": chave, "Content-Type": "application/json"},
+    )
+
+def qtd_faturas() -> int:
+    with main.get_engine().connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM faturas")).scalar()
+
+def test_repetir_devolve_a_resposta_gravada(cliente):
+    primeira = postar(cliente, "k1", corpo_fatura())
+    segunda = postar(cliente, "k1", corpo_fatura())
+
+    assert primeira.status_code == segunda.status_code == 200
+    assert segunda.headers.get("Idempotent-Replayed") == "true"
+    assert "Idempotent-Replayed" not in primeira.headers
+    assert segunda.json() == primeira.json()
+    assert qtd_faturas() == 1
+
+def test_mesma_chave_com_outro_corpo_e_422(cliente):
+    assert postar(cliente, "k1", corpo_fatura("NF1")).status_code == 200
+    r = postar(cliente, "k1", corpo_fatura("NF2"))
+    assert r.status_code == 422
+    assert qtd_faturas() == 1
+
+def test_em_andamento_e_409(cliente):
+    corpo = corpo_fatura()
+    impressao = hashlib.sha256(b"POST /faturas\n" + corpo).hexdigest()
+    with main.get_engine().connect() as conn:
+        uid = conn.execute(text("SELECT id FROM users WHERE username = 'ana'")).scalar()
+    assert main._idem_reservar(uid, "k1", "/faturas", impressao) is None  # outro worker pegou
+
+    r = postar(cliente, "k1", corpo)
+    assert r.status_code == 409
+    assert r.headers["Retry-After"] == "1"
+    assert qtd_faturas() == 0
+
+def test_erro_libera_a_chave(cliente):
+    invalido = orjson.dumps({"transportadora": "DHL"})
+    assert postar(cliente, "k1", invalido).status_code == 422  # validação da rota
+    with main.get_engine().connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM idempotency_keys")).scalar() == 0
+
+    r = postar(cliente, "k1", corpo_fatura())
+    assert r.status_code == 200
+    assert "Idempotent-Replayed" not in r.headers
+
+def test_chave_e_por_usuario(cliente):
+    outro = entrar(TestClient(main.app), criar_usuario("bia"))
+    assert postar(cliente, "k1", corpo_fatura()).status_code == 200
+    r = postar(outro, "k1", corpo_fatura())
+    assert r.status_code == 200
+    assert "Idempotent-Replayed" not in r.headers
+    assert qtd_faturas() == 2
+
+def test_sessao_vencida_nao_recebe_replay(banco):
+    uid = criar_usuario()
+    valido = entrar(TestClient(main.app), uid)
+    assert postar(valido, "k1", corpo_fatura()).status_code == 200
+
+    vencido = entrar(TestClient(main.app), uid, validade_s=-60)
+    r = postar(vencido, "k1", corpo_fatura())
+    assert r.status_code == 401
+    assert "Idempotent-Replayed" not in r.headers
+
+def test_sem_chave_ou_fora_das_rotas_passa_direto(cliente):
+    assert cliente.post("/faturas", content=corpo_fatura(), headers={"Content-Type": "application/json"}).status_code == 200
+    assert cliente.post("/faturas", content=corpo_fatura(), headers={"Content-Type": "application/json"}).status_code == 200
+    assert qtd_faturas() == 2
+    with main.get_engine().connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM idempotency_keys")).scalar() == 0
@@ -0,0 +1,160 @@
+import threading
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import main
+from conftest import entrar
+
+class Relogio:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+@pytest.fixture
+def relogio(monkeypatch):
+    r = Relogio()
+    monkeypatch.setattr(main.time, "monotonic", r)
+    return r
+
+@pytest.fixture
+def balde(monkeypatch):
+    monkeypatch.setattr(main, "LIMITE_RAJADA", 3.0)
+    monkeypatch.setattr(main, "LIMITE_TAXA", 1.0)
+    monkeypatch.setattr(main, "LIMITE_BACKEND", "memoria")
+    monkeypatch.setattr(main, "_baldes_locais", main.BaldesLocais())
+    return main._baldes_locais
+
+@pytest.fixture
+def limitado(balde, monkeypatch):
+    """Limite ligado só no /health (custo 1), que não precisa de banco."""
+    monkeypatch.setattr(main, "LIMITE_ATIVO", True)
+    monkeypatch.setattr(main, "LIMITE_CUSTOS", {("GET", "/health"): 1.0})
+    monkeypatch.setattr(main, "LIMITE_IP_HEADER", "")
+    monkeypatch.setattr(main, "LIMITE_IP_DIRETO", True)
+    return TestClient(main.app)
+
+def requisicao(headers: dict = None, host: str = "10.0.0.9") -> Request:
+    return Request({
+        "type": "http", "method": "GET", "path": "/", "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": (host, 1234),
+    })
+
+def amostra(metrica, **labels) -> float:
+    return sum(
+        s.value
+        for m in metrica.collect()
+        for s in m.samples
+        if not s.name.endswith(("_bucket", "_sum", "_created")) and all(s.labels.get(k) == v for k, v in labels.items())
+    )
+
+def test_rajada_e_depois_espera(balde, relogio):
+    assert [balde.gastar("u:1", 1) for _ in range(3)] == [0, 0, 0]
+    assert balde.gastar("u:1", 1) == pytest.approx(1.0)
+    assert balde.gastar("u:1", 2) == pytest.approx(2.0)
+
+def test_fichas_voltam_com_o_tempo_ate_a_rajada(balde, relogio):
+    for _ in range(3):
+        balde.gastar("u:1", 1)
+    relogio.t += 2
+    assert balde.gastar("u:1", 2) == 0
+    assert balde.gastar("u:1", 1) > 0
+
+    relogio.t += 3600  # não acumula além da rajada
+    assert balde.gastar("u:1", 3) == 0
+    assert balde.gastar("u:1", 1) > 0
+
+def test_baldes_separados_por_chave(balde, relogio):
+    for _ in range(3):
+        balde.gastar("u:1", 1)
+    assert balde.gastar("u:1", 1) > 0
+    assert balde.gastar("u:2", 1) == 0
+
+def test_poda_so_tira_balde_cheio(balde, relogio, monkeypatch):
+    monkeypatch.setattr(main, "LIMITE_MAX_CHAVES", 2)
+    balde.gastar("a", 3)
+    relogio.t += 10  # "a" encheu de novo
+    balde.gastar("b", 3)
+    balde.gastar("c", 3)  # passou do máximo: poda
+    assert set(balde._baldes) == {"b", "c"}
+
+def test_custo_acima_da_rajada_nao_trava_a_rota(balde, relogio):
+    assert main.gastar_fichas("u:1", 100) == 0
+
+def test_postgres_fora_usa_o_balde_local(balde, relogio, monkeypatch):
+    def quebrar(chave, custo):
+        raise RuntimeError("banco fora")
+
+    monkeypatch.setattr(main, "LIMITE_BACKEND", "postgres")
+    monkeypatch.setattr(main, "_gastar_postgres", quebrar)
+    assert [main.gastar_fichas("u:1", 1) for _ in range(4)][-1] > 0
+
+def test_ip_do_cliente(monkeypatch):
+    monkeypatch.setattr(main, "LIMITE_IP_HEADER", "X-Forwarded-For")
+    monkeypatch.setattr(main, "LIMITE_IP_DIRETO", False)
+    assert main.ip_cliente(requisicao({"X-Forwarded-For": "1.1.1.1, 2.2.2.2"})) == "2.2.2.2"
+    assert main.ip_cliente(requisicao()) is None  # header configurado mas ausente
+
+    monkeypatch.setattr(main, "LIMITE_IP_HEADER", "")
+    assert main.ip_cliente(requisicao()) is None  # sem config: não confia no client.host
+    monkeypatch.setattr(main, "LIMITE_IP_DIRETO", True)
+    assert main.ip_cliente(requisicao()) == "10.0.0.9"
+
+def test_middleware_responde_429_com_retry_after(limitado):
+    antes = amostra(main.HTTP_LATENCIA, route="/health", status="429")
+    codigos = [limitado.get("/health").status_code for _ in range(4)]
+    assert codigos == [200, 200, 200, 429]
+
+    r = limitado.get("/health")
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    # métricas ficam por fora do limite: o 429 também é medido
+    assert amostra(main.HTTP_LATENCIA, route="/health", status="429") == antes + 2
+
+def test_rota_sem_custo_nao_gasta(limitado, monkeypatch):
+    monkeypatch.setattr(main, "LIMITE_CUSTOS", {})
+    assert {limitado.get("/health").status_code for _ in range(10)} == {200}
+
+def test_anonimo_sem_ip_confiavel_nao_e_limitado(limitado, monkeypatch):
+    monkeypatch.setattr(main, "LIMITE_IP_DIRETO", False)
+    assert {limitado.get("/health").status_code for _ in range(10)} == {200}
+
+def test_um_balde_por_usuario(limitado):
+    ana = entrar(TestClient(main.app), 1)
+    bia = entrar(TestClient(main.app), 2)
+    assert [ana.get("/health").status_code for _ in range(4)] == [200, 200, 200, 429]
+    assert bia.get("/health").status_code == 200
+    assert set(main._baldes_locais._baldes) == {"u:1", "u:2"}
+
+def test_bulkhead_sem_vaga_e_429(monkeypatch):
+    monkeypatch.setitem(main.BULKHEADS, "teste", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(main, "BULKHEAD_ESPERA_S", 0.01)
+
+    with main.bulkhead("teste"):
+        with pytest.raises(HTTPException) as erro:
+            with main.bulkhead("teste"):
+                pass
+    assert erro.value.status_code == 429
+    assert erro.value.headers["Retry-After"]
+
+    with main.bulkhead("teste"):  # a vaga volta ao sair
+        pass
+
+def test_bulkhead_devolve_a_vaga_mesmo_com_erro(monkeypatch):
+    monkeypatch.setitem(main.BULKHEADS, "teste", threading.BoundedSemaphore(1))
+    with pytest.raises(ValueError):
+        with main.bulkhead("teste"):
+            raise ValueError("falhou dentro")
+    assert main.BULKHEADS["teste"].acquire(blocking=False)
+
+def test_balde_no_postgres(banco, monkeypatch):
+    monkeypatch.setattr(main, "LIMITE_RAJADA", 3.0)
+    monkeypatch.setattr(main, "LIMITE_TAXA", 0.001)
+    assert [main._gastar_postgres("u:1", 1) for _ in range(3)] == [0, 0, 0]
+    assert main._gastar_postgres("u:1", 1) > 0
+    assert main._gastar_postgres("u:2", 1) == 0
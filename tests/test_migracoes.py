@@ -0,0 +1,78 @@
+import pytest
+from sqlalchemy import inspect, text
+
+import main
+
+BASELINE = {"faturas", "anexos", "historico_pagamentos", "users", "transportadoras", "password_resets"}
+
+def versoes(eng) -> list:
+    with eng.connect() as conn:
+        return [v for (v,) in conn.execute(text("SELECT version FROM schema_migrations ORDER BY version"))]
+
+def contando(monkeypatch, extra=()):
+    """Troca MIGRATIONS por cópias que contam quantas vezes cada uma rodou."""
+    chamadas = []
+
+    def embrulhar(versao, fn):
+        def rodar(conn):
+            chamadas.append(versao)
+            fn(conn)
+        return rodar
+
+    lista = [(v, d, embrulhar(v, fn)) for v, d, fn in list(main.MIGRATIONS) + list(extra)]
+    monkeypatch.setattr(main, "MIGRATIONS", lista)
+    return chamadas
+
+def test_banco_novo_aplica_todas_em_ordem(schema_vazio, monkeypatch):
+    chamadas = contando(monkeypatch)
+    main.run_migrations()
+
+    esperadas = [v for v, _, _ in main.MIGRATIONS]
+    assert chamadas == esperadas
+    assert versoes(schema_vazio) == esperadas
+
+    insp = inspect(schema_vazio)
+    tabelas = set(insp.get_table_names())
+    for t in main.Base.metadata.sorted_tables:
+        assert t.name in tabelas
+        colunas = {c["name"] for c in insp.get_columns(t.name)}
+        assert {c.name for c in t.columns} <= colunas, t.name
+
+def test_segunda_vez_nao_roda_nada(schema_vazio, monkeypatch):
+    main.run_migrations()
+    chamadas = contando(monkeypatch)
+    main.run_migrations()
+    assert chamadas == []
+
+def test_migracao_nova_roda_uma_vez(schema_vazio, monkeypatch):
+    main.run_migrations()
+    ultima = main.MIGRATIONS[-1][0]
+    nova = (ultima + 1, "teste", lambda conn: conn.execute(text("CREATE TABLE teste_migracao (id INTEGER)")))
+    chamadas = contando(monkeypatch, extra=[nova])
+
+    main.run_migrations()
+    main.run_migrations()
+
+    assert chamadas == [ultima + 1]
+    assert versoes(schema_vazio)[-1] == ultima + 1
+
+def test_baseline_cria_so_as_seis_tabelas_originais(schema_vazio, monkeypatch):
+    monkeypatch.setattr(main, "MIGRATIONS", main.MIGRATIONS[:1])
+    main.run_migrations()
+    tabelas = set(inspect(schema_vazio).get_table_names()) - {"schema_migrations"}
+    assert tabelas == BASELINE
+    # atualizado_em é da migração 9, não da 001
+    assert "atualizado_em" not in {c["name"] for c in inspect(schema_vazio).get_columns("faturas")}
+
+def test_falha_desfaz_a_rodada_inteira(schema_vazio, monkeypatch):
+    def quebrar(conn):
+        raise RuntimeError("migração com defeito")
+
+    monkeypatch.setattr(main, "MIGRATIONS", main.MIGRATIONS[:2] + [(99, "quebrada", quebrar)])
+    with pytest.raises(RuntimeError):
+        main.run_migrations()
+    assert "faturas" not in inspect(schema_vazio).get_table_names()
+
+    monkeypatch.setattr(main, "MIGRATIONS", main.MIGRATIONS[:2])
+    main.run_migrations()
+    assert versoes(schema_vazio) == [1, 2]
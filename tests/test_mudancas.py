@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+import main
+
+@pytest.fixture(autouse=True)
+def sem_margem(monkeypatch):
+    # com a margem padrão tudo que mudou no último minuto volta de novo
+    monkeypatch.setattr(main, "MUDANCAS_MARGEM_S", 0)
+
+def criar(cliente, numero: str, status: str = "pendente") -> int:
+    r = cliente.post("/faturas", json={
+        "transportadora": "DHL", "numero_fatura": numero, "valor": 10,
+        "data_vencimento": "2030-01-10", "status": status,
+    })
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+def test_sem_cursor_vem_tudo(cliente):
+    ids = {criar(cliente, "NF1"), criar(cliente, "NF2")}
+    r = cliente.get("/faturas/mudancas").json()
+    assert r["resetar"] is True
+    assert {i["id"] for i in r["itens"]} == ids
+    assert r["removidos"] == []
+    assert r["cursor"]
+
+@pytest.mark.parametrize("desde", [
+    "lixo",
+    "2026-01-01T00:00:00",  # sem fuso
+    (datetime.now(timezone.utc) - timedelta(days=400)).isoformat(),  # além da retenção
+])
+def test_cursor_invalido_ou_velho_recarrega_tudo(cliente, desde):
+    criar(cliente, "NF1")
+    r = cliente.get("/faturas/mudancas", params={"desde": desde}).json()
+    assert r["resetar"] is True
+    assert len(r["itens"]) == 1
+
+def test_com_cursor_vem_so_o_que_mudou(cliente):
+    parada = criar(cliente, "NF1")
+    editada = criar(cliente, "NF2")
+    apagada = criar(cliente, "NF3")
+    cursor = cliente.get("/faturas/mudancas").json()["cursor"]
+
+    assert cliente.put(f"/faturas/{editada}", json={"valor": 99}).status_code == 200
+    assert cliente.delete(f"/faturas/{apagada}").status_code == 200
+    nova = criar(cliente, "NF4")
+
+    r = cliente.get("/faturas/mudancas", params={"desde": cursor}).json()
+    assert r["resetar"] is False
+    assert {i["id"] for i in r["itens"]} == {editada, nova}
+    assert parada not in {i["id"] for i in r["itens"]}
+    assert r["removidos"] == [apagada]
+
+    vazio = cliente.get("/faturas/mudancas", params={"desde": r["cursor"]}).json()
+    assert vazio["itens"] == [] and vazio["removidos"] == []
+
+def test_historico_pagamentos_e_estornos(cliente):
+    paga = criar(cliente, "NF1", status="pago")
+    cursor = cliente.get("/historico/mudancas").json()["cursor"]
+
+    outra = criar(cliente, "NF2")
+    assert cliente.put(f"/faturas/{outra}", json={"status": "pago"}).status_code == 200
+    assert cliente.put(f"/faturas/{paga}", json={"status": "pendente"}).status_code == 200
+
+    r = cliente.get("/historico/mudancas", params={"desde": cursor}).json()
+    assert r["resetar"] is False
+    assert [i["fatura_id"] for i in r["itens"]] == [outra]
+    with main.get_engine().connect() as conn:
+        estornado = conn.execute(text("SELECT registro_id FROM remocoes WHERE tabela = 'historico_pagamentos'")).scalar()
+    assert r["removidos"] == [estornado]
+
+def test_troca_de_particao_nao_vira_remocao(banco):
+    futuro = main.agora_br() + timedelta(days=31 * (main.HISTORICO_PARTICOES_FUTURAS + 2))
+    with main.get_engine().begin() as conn:
+        conn.execute(text("""
+            INSERT INTO historico_pagamentos (pago_em, transportadora, numero_fatura, valor, data_vencimento)
+            VALUES (:p, 'DHL', 'NF1', 1, '2030-01-10')
+        """), {"p": futuro})
+        assert conn.execute(text("SELECT count(*) FROM historico_pagamentos_default")).scalar() == 1
+
+        main.garantir_particoes_historico(conn, meses_futuros=main.HISTORICO_PARTICOES_FUTURAS + 3)
+
+        assert conn.execute(text("SELECT count(*) FROM historico_pagamentos_default")).scalar() == 0
+        assert conn.execute(text("SELECT count(*) FROM remocoes")).scalar() == 0
+        # apagar de verdade, na mesma transação, continua registrando
+        conn.execute(text("DELETE FROM historico_pagamentos"))
+        assert conn.execute(text("SELECT count(*) FROM remocoes")).scalar() == 1